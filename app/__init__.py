@@ -1,5 +1,6 @@
 import logging
 import os
+import time
 
 # A configuração de log precisa vir antes dos imports abaixo, e não de dentro do
 # create_app(). O services.py escreve o diagnóstico do modelo no momento em que é
@@ -19,6 +20,7 @@ from sqlalchemy import inspect as sa_inspect, text
 from config import config_by_name
 from .seeder import seed_all, ensure_demo_pending_student
 from .models import db
+from .prontidao import NO_BOOT as MODELO_NO_BOOT, estado as estado_do_modelo
 from .routes import api
 from .auth import auth
 from .admin import admin_bp
@@ -40,16 +42,32 @@ _COLUNAS_NOVAS = {
         ('consentimento_versao', 'VARCHAR(20)', False),
         ('email', 'VARCHAR(255)', False),
     ),
+    'student_risk_analysis': (
+        ('score_sum', 'FLOAT', False),
+        ('sentiment_sum', 'FLOAT', False),
+        ('sentiment_count', 'INTEGER', False),
+    ),
     'feedback': (
         ('explicacao_iniciada_em', 'TIMESTAMP', False),
         ('deleted_at', 'TIMESTAMP', False),
         ('avisado_em', 'TIMESTAMP', False),
+        ('lime_modo', 'VARCHAR(20)', False),
+        ('previa_attributions_json', 'TEXT', False),
+        ('lime_parcial_json', 'TEXT', False),
     ),
 }
 
 
+# Restrições únicas acrescentadas depois da tabela, pelo mesmo motivo: o
+# create_all() só as cria junto com a tabela. Viram índices únicos, que o ON
+# CONFLICT aceita do mesmo jeito nos dois bancos.
+_UNICOS_NOVOS = (
+    ('student_risk_analysis', 'uq_risco_aluno_disciplina', ('student_id', 'subject_id')),
+)
+
+
 def run_lightweight_migrations():
-    """Acrescenta colunas que faltam, em SQLite ou Postgres."""
+    """Acrescenta colunas e restrições únicas que faltam, em SQLite ou Postgres."""
     e_sqlite = db.engine.url.get_backend_name().startswith('sqlite')
 
     for tabela, colunas_esperadas in _COLUNAS_NOVAS.items():
@@ -72,6 +90,46 @@ def run_lightweight_migrations():
             db.session.commit()
             logger.info('Coluna %s adicionada à tabela %s.', nome, tabela)
 
+    for tabela, nome, colunas in _UNICOS_NOVOS:
+        try:
+            inspetor = sa_inspect(db.engine)
+            existentes = (
+                [tuple(i['column_names']) for i in inspetor.get_indexes(tabela) if i.get('unique')]
+                + [tuple(u['column_names']) for u in inspetor.get_unique_constraints(tabela)]
+            )
+        except Exception:
+            continue
+        if colunas in existentes:
+            continue
+
+        # As duplicadas que a falta da restrição deixou passar: fica a mais
+        # recente de cada par, e o recálculo abaixo acerta as contas dela.
+        lista = ', '.join(colunas)
+        removidas = db.session.execute(text(
+            f'DELETE FROM "{tabela}" WHERE id NOT IN '
+            f'(SELECT MAX(id) FROM "{tabela}" GROUP BY {lista})'
+        )).rowcount
+        db.session.execute(text(f'CREATE UNIQUE INDEX IF NOT EXISTS {nome} ON "{tabela}" ({lista})'))
+        db.session.commit()
+        logger.info('Índice único %s criado na tabela %s (%s duplicada(s) removida(s)).',
+                    nome, tabela, removidas)
+
+    _preencher_somas_do_risco()
+
+
+def _preencher_somas_do_risco():
+    """Recalcula, uma vez, as análises de risco gravadas antes das somas."""
+    from .feedbacks import update_student_risk_analysis
+    from .models import StudentRiskAnalysis
+
+    pares = (db.session.query(StudentRiskAnalysis.student_id, StudentRiskAnalysis.subject_id)
+             .filter(StudentRiskAnalysis.score_sum.is_(None)).all())
+    for student_id, subject_id in pares:
+        update_student_risk_analysis(student_id, subject_id, commit=False)
+    if pares:
+        db.session.commit()
+        logger.info('Somas preenchidas em %s análise(s) de risco.', len(pares))
+
 
 def _validar_producao(app):
     """Falha o boot em vez de subir inseguro ou com o frontend bloqueado."""
@@ -97,6 +155,7 @@ def _validar_producao(app):
 def create_app(config_name=None):
     # Padrão 'production': esquecer a variável no host não pode ligar o DEBUG,
     # expor o console do Werkzeug nem semear contas de demonstração.
+    inicio = time.perf_counter()
     config_name = config_name or os.environ.get('FLASK_CONFIG', 'production')
     if config_name not in config_by_name:
         raise RuntimeError(
@@ -129,12 +188,17 @@ def create_app(config_name=None):
             seed_all()
             ensure_demo_pending_student()
 
+    # Sem o modelo, que carrega depois, à parte; ver prontidao.py.
+    logger.info('App criado em %.1fs.', time.perf_counter() - inicio)
     return app
 
 def register_extensions(app):
     db.init_app(app)
     origins = [o.strip() for o in (app.config.get('CORS_ORIGINS') or '').split(',') if o.strip()] or ['http://localhost:3000']
-    CORS(app, resources={r"/*": {"origins": origins}}, supports_credentials=True)
+    # Retry-After exposto: sem isso o navegador esconde o cabeçalho da tela
+    # numa chamada de outra origem (ver admissao.py).
+    CORS(app, resources={r"/*": {"origins": origins}}, supports_credentials=True,
+         expose_headers=['Retry-After', 'X-Next-Cursor'])
     jwt = JWTManager(app)
 
     @jwt.expired_token_loader
@@ -180,6 +244,26 @@ def register_health(app):
         modelo, para responder rápido durante o cold start."""
         return jsonify({'status': 'ok'}), 200
 
+    @app.route('/ready')
+    def ready():
+        """Sonda de prontidão: modelo carregado e aquecido, banco respondendo.
+
+        Responde 503 enquanto faltar alguma das três, com o corpo dizendo qual.
+        Com MODELO_NO_BOOT=0 o modelo só carrega no primeiro uso, e o /ready
+        não espera por ele."""
+        corpo = estado_do_modelo()
+        try:
+            db.session.execute(text('SELECT 1'))
+            corpo['banco'] = True
+        except Exception:
+            db.session.rollback()
+            corpo['banco'] = False
+            logger.warning('/ready: banco indisponível.', exc_info=True)
+
+        pronto = corpo['banco'] and (corpo['aquecido'] or not MODELO_NO_BOOT)
+        corpo['status'] = 'pronto' if pronto else 'aguardando'
+        return jsonify(corpo), 200 if pronto else 503
+
 
 def register_cli(app):
     from .cli import register_commands
@@ -71,3 +71,19 @@ def assign_subject_to_professor(subject_id):
         return jsonify({"error": "Um erro inesperado ocorreu no servidor."}), 500
 
     return jsonify({"message": f"Matéria '{subject.name}' associada com sucesso ao professor '{professor.username}'."}), 200
+
+
+@admin_bp.route("/inferencia", methods=["GET"])
+@jwt_required()
+@requires_role(User.COORDENADOR)
+def estado_da_inferencia():
+    """Espera e vazão de cada faixa do escalonador, das filas e do cache, neste
+    processo, e as vagas e recusas das rotas caras. Não carrega o modelo só
+    para responder: antes dele, só há os números da admissão."""
+    from . import admissao
+    from .prontidao import carregar_modelo, estado
+
+    if not estado()['modelo_carregado']:
+        return jsonify({'modelo_carregado': False, 'admissao': admissao.estatisticas()}), 200
+    return jsonify(dict(carregar_modelo().estatisticas_da_inferencia(),
+                        modelo_carregado=True, admissao=admissao.estatisticas())), 200
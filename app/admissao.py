@@ -0,0 +1,273 @@
+"""Controle de admissão das rotas caras: recusar rápido em vez de enfileirar sem fim.
+
+Num pico da turma inteira, o /analyze aceitava quantos envios chegassem. Os
+que não cabiam nas threads do gunicorn ficavam na fila dele e do Caddy até os
+timeouts de 300 s, e o scripts/testar_carga.py já avisava: acima de 120 s a
+tela desiste. O aluno esperava dois minutos para ver um erro.
+
+Agora cada classe de rota tem um limite de pedidos em curso e uma fila curta
+de espera, medida em pedidos e em segundos:
+
+    analise       POST /analyze: grava o feedback e passa pelo modelo
+    explicacao    POST /feedbacks/<id>/explicacao: só põe na fila, mas a fila
+                  das tarefas tem teto (ver tarefas.espera_por_vaga_na_fila)
+    eventos       GET /feedbacks/<id>/explicacao/eventos e /estado: esperam
+                  parados o andamento da explicação (ver progresso.py), sem
+                  fila de espera
+
+Cheio o limite e a fila, ou vencida a espera, a rota responde na hora 503 com
+`Retry-After`. Os segundos saem da vazão atual: quantos pedidos estão na
+frente, divididos por quantos a rota conclui por segundo. Nada foi gravado num
+pedido recusado, e a tela pode repetir o mesmo pedido depois da espera (ver
+frontend/src/services/api.js).
+
+Os padrões deixam sempre uma thread do gunicorn livre: com WEB_THREADS=4, dois
+/analyze em curso e um esperando. Uma thread esperando vaga é uma thread a
+menos para responder aos outros, inclusive para recusar.
+
+Os eventos seguram a thread por até EXPLICACOES_EVENTOS_ESPERA_S. No mesmo
+servidor do /analyze, ficam só com o que os /analyze em curso deixam, menos
+uma: com 4 threads, uma espera de andamento só, e os outros alunos recebem 503
+e voltam depois do Retry-After. Por isso, em produção, as esperas vão para um
+servidor próprio (o serviço `eventos` do docker-compose.yml, para onde o
+Caddyfile manda as duas rotas): o mesmo app, sem modelo e sem trabalhador,
+com SERVIDOR_DE_EVENTOS=1 e dezenas de threads que só esperam. Ali a classe
+eventos fica com todas as threads menos uma, e nenhuma espera tira vaga de um
+/analyze.
+
+Os contadores vão para o log: um resumo a cada tantas admissões, e um aviso a
+cada recusa, no máximo um a cada dez segundos por classe. O GET
+/admin/inferencia mostra os mesmos números.
+
+    ADMISSAO=1                           com 0, nenhuma rota recusa nada
+    ADMISSAO_ANALISE_SIMULTANEAS=2       padrão: metade das WEB_THREADS
+    ADMISSAO_ANALISE_FILA=1              padrão: as threads que sobram, menos uma
+    ADMISSAO_ANALISE_ESPERA_S=10         espera máxima por uma vaga
+    ADMISSAO_EXPLICACAO_SIMULTANEAS=2
+    ADMISSAO_EXPLICACAO_FILA=1
+    ADMISSAO_EXPLICACAO_ESPERA_S=5
+    ADMISSAO_EVENTOS_SIMULTANEAS=1       padrão: as threads que sobram, menos uma;
+                                         com SERVIDOR_DE_EVENTOS=1, todas menos uma
+"""
+
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import jsonify
+
+logger = logging.getLogger(__name__)
+
+LIGADO = os.environ.get('ADMISSAO', '1').lower() not in ('0', 'false', 'nao', 'não')
+
+SERVIDOR_DE_EVENTOS = os.environ.get('SERVIDOR_DE_EVENTOS', '0').lower() in ('1', 'true', 'sim')
+
+_THREADS = max(1, int(os.environ.get('WEB_THREADS', 4)))
+_SIMULTANEAS_PADRAO = max(1, _THREADS // 2)
+_FILA_PADRAO = max(0, _THREADS - _SIMULTANEAS_PADRAO - 1)
+# Num servidor só de eventos, as threads são todas das esperas; dividindo o
+# processo com o /analyze, só as que ele deixa.
+_EVENTOS_PADRAO = max(1, _THREADS - 1 if SERVIDOR_DE_EVENTOS else _THREADS - _SIMULTANEAS_PADRAO - 1)
+
+# O Retry-After fica entre estes limites: abaixo de um segundo a tela repetiria
+# em rajada, e acima de dois minutos o aluno já teria desistido.
+RETRY_MINIMO = 1
+RETRY_MAXIMO = 120
+
+# Duração dos últimos pedidos, para a vazão.
+_AMOSTRAS = 200
+
+_RESUMO_A_CADA = 200
+_AVISO_A_CADA_S = 10
+
+
+class Recusado(Exception):
+    """Pedido recusado por falta de vaga; `retry_after` em segundos inteiros."""
+
+    def __init__(self, motivo, retry_after):
+        super().__init__(motivo)
+        self.motivo = motivo
+        self.retry_after = retry_after
+
+
+def segundos_de_espera(na_frente, por_segundo, padrao):
+    """Retry-After para quem tem `na_frente` pedidos antes, na vazão dada."""
+    if not por_segundo:
+        return padrao
+    return min(RETRY_MAXIMO, max(RETRY_MINIMO, math.ceil(na_frente / por_segundo)))
+
+
+class Admissao:
+    """Limite de pedidos em curso de uma classe de rotas, com fila curta."""
+
+    def __init__(self, nome, simultaneas, fila, espera):
+        self.nome = nome
+        self.simultaneas = simultaneas
+        self.fila = fila
+        self.espera = espera
+        self._condicao = threading.Condition()
+        self._em_curso = 0
+        self._na_fila = 0
+        self._admitidos = 0
+        self._recusados = {'fila_cheia': 0, 'espera_vencida': 0, 'fila_de_tarefas': 0}
+        self._espera_total = 0.0
+        self._duracoes = deque(maxlen=_AMOSTRAS)
+        self._ultimo_aviso = 0.0
+
+    def entrar(self):
+        """Ocupa uma vaga e devolve o instante da entrada, para `sair`.
+
+        Sem vaga, levanta Recusado. Para quando a vaga dura mais que a chamada
+        da rota, como numa resposta em fluxo; no resto, `vaga`.
+        """
+        chegada = time.monotonic()
+        with self._condicao:
+            if self._em_curso >= self.simultaneas:
+                if self._na_fila >= self.fila:
+                    raise self._recusar('fila_cheia')
+                self._na_fila += 1
+                try:
+                    prazo = chegada + self.espera
+                    while self._em_curso >= self.simultaneas:
+                        restante = prazo - time.monotonic()
+                        if restante <= 0:
+                            raise self._recusar('espera_vencida')
+                        self._condicao.wait(restante)
+                finally:
+                    self._na_fila -= 1
+            self._em_curso += 1
+            self._admitidos += 1
+            self._espera_total += time.monotonic() - chegada
+            resumir = self._admitidos % _RESUMO_A_CADA == 0
+
+        if resumir:
+            logger.info('admissao %s: %s', self.nome, self.estatisticas())
+        return time.monotonic()
+
+    def sair(self, comeco):
+        with self._condicao:
+            self._em_curso -= 1
+            self._duracoes.append(time.monotonic() - comeco)
+            self._condicao.notify()
+
+    @contextmanager
+    def vaga(self):
+        """Segura uma vaga durante o bloco, ou levanta Recusado."""
+        comeco = self.entrar()
+        try:
+            yield
+        finally:
+            self.sair(comeco)
+
+    def recusar(self, retry_after, motivo='fila_de_tarefas'):
+        """Conta e avisa uma recusa decidida fora do limite, como a fila de tarefas cheia."""
+        with self._condicao:
+            self._recusados[motivo] += 1
+            self._avisar(motivo, retry_after)
+        return Recusado(motivo, retry_after)
+
+    def por_segundo(self):
+        """Pedidos que a classe conclui por segundo, com as vagas todas ocupadas."""
+        with self._condicao:
+            return self._por_segundo()
+
+    def estatisticas(self):
+        with self._condicao:
+            return {
+                'simultaneas': self.simultaneas,
+                'fila': self.fila,
+                'espera_s': self.espera,
+                'em_curso': self._em_curso,
+                'na_fila': self._na_fila,
+                'admitidos': self._admitidos,
+                'recusados': dict(self._recusados),
+                'espera_media_ms': (
+                    round(1000 * self._espera_total / self._admitidos, 1) if self._admitidos else None
+                ),
+                'duracao_media_ms': (
+                    round(1000 * sum(self._duracoes) / len(self._duracoes), 1)
+                    if self._duracoes else None
+                ),
+                'por_segundo': round(self._por_segundo() or 0, 2),
+            }
+
+    # ---------------------------------------------------------------- interno
+
+    def _por_segundo(self):
+        if not self._duracoes:
+            return None
+        media = sum(self._duracoes) / len(self._duracoes)
+        return self.simultaneas / media if media > 0 else None
+
+    def _recusar(self, motivo):
+        """Chamado com a condição travada."""
+        self._recusados[motivo] += 1
+        retry_after = segundos_de_espera(
+            self._em_curso + self._na_fila + 1 - self.simultaneas,
+            self._por_segundo(), math.ceil(self.espera) or RETRY_MINIMO,
+        )
+        self._avisar(motivo, retry_after)
+        return Recusado(motivo, retry_after)
+
+    def _avisar(self, motivo, retry_after):
+        agora = time.monotonic()
+        if agora - self._ultimo_aviso < _AVISO_A_CADA_S:
+            return
+        self._ultimo_aviso = agora
+        logger.warning(
+            'admissao %s: recusado por %s, Retry-After %ss; em curso %s/%s, na fila %s/%s, '
+            'admitidos %s, recusados %s',
+            self.nome, motivo, retry_after, self._em_curso, self.simultaneas,
+            self._na_fila, self.fila, self._admitidos, self._recusados,
+        )
+
+
+def _classe(nome, simultaneas, fila, espera):
+    prefixo = f'ADMISSAO_{nome.upper()}'
+    return Admissao(
+        nome,
+        max(1, int(os.environ.get(f'{prefixo}_SIMULTANEAS', simultaneas))),
+        max(0, int(os.environ.get(f'{prefixo}_FILA', fila))),
+        float(os.environ.get(f'{prefixo}_ESPERA_S', espera)),
+    )
+
+
+ANALISE = _classe('analise', _SIMULTANEAS_PADRAO, _FILA_PADRAO, 10)
+EXPLICACAO = _classe('explicacao', _SIMULTANEAS_PADRAO, _FILA_PADRAO, 5)
+# Quem espera o andamento não tem por que esperar também por uma vaga.
+EVENTOS = _classe('eventos', _EVENTOS_PADRAO, 0, 0)
+
+
+def resposta_de_recusa(recusa):
+    """503 com Retry-After no cabeçalho e no corpo; o corpo a tela sempre lê."""
+    corpo = {
+        'error': 'O servidor está com muitos pedidos agora. '
+                 f'Tente de novo em {recusa.retry_after} segundo(s).',
+        'retry_after': recusa.retry_after,
+    }
+    return jsonify(corpo), 503, {'Retry-After': str(recusa.retry_after)}
+
+
+def admitir(admissao):
+    """Decorador de rota: só entra com vaga; sem vaga, responde 503 na hora."""
+    def decorador(rota):
+        @wraps(rota)
+        def envolvida(*args, **kwargs):
+            if not LIGADO:
+                return rota(*args, **kwargs)
+            try:
+                with admissao.vaga():
+                    return rota(*args, **kwargs)
+            except Recusado as recusa:
+                return resposta_de_recusa(recusa)
+        return envolvida
+    return decorador
+
+
+def estatisticas():
+    return {admissao.nome: admissao.estatisticas() for admissao in (ANALISE, EXPLICACAO, EVENTOS)}
@@ -0,0 +1,208 @@
+"""Pontos de retomada das explicações e o que fica deles para a pesquisa.
+
+Uma tarefa interrompida no meio, pela instância que o Cloud Run derrubou ou
+pela concessão que venceu, voltava do zero na tentativa seguinte: sorteava de
+novo as máscaras do LIME, e o cache de predições só poupava as passagens cujas
+entradas calhassem de ser as mesmas, e só na mesma máquina. Agora o cálculo
+grava, de tempos em tempos, o que já fez de cada comentário:
+
+    lime_dados            as máscaras do LIME, uma linha por amostra, bit a bit
+    lime_probabilidades   a saída do modelo para cada máscara distinta, float32
+    shap_probabilidades   a saída para cada coalizão do SHAP exato, float32
+
+O que ainda não passou pelo modelo fica como NaN. A tentativa seguinte reusa as
+mesmas máscaras e só infere o que falta. As máscaras distintas não são
+gravadas: saem de novo das amostras, e as coalizões do SHAP exato, do número
+de tokens. O SHAP por partição, que decide cada avaliação pelas anteriores,
+não tem ponto de retomada; as passagens dele continuam no cache de predições.
+
+Concluído, o artefato fica. Com as máscaras e as probabilidades, a regressão
+do LIME pode ser refeita com outro número de palavras, outra largura do kernel
+ou outra classe em milissegundos, sem carregar o modelo:
+
+    flask reajustar-lime 42 --palavras 5 --kernel 15 --classe NEG
+
+Um artefato vale para um feedback e uma identidade do modelo, a mesma do cache
+de predições. Num comentário de cinquenta palavras, com as 5.000 amostras,
+ocupa uns 100 KB; nos curtos, enumerados, poucos KB. Sai junto com o feedback
+retirado ou apagado.
+
+    ARTEFATOS_EXPLICACAO=1    grava e retoma; com 0, nem uma coisa nem outra
+"""
+
+import datetime
+import hashlib
+import io
+import logging
+import os
+
+import numpy as np
+from sqlalchemy.exc import IntegrityError
+
+from .models import ArtefatoDeExplicacao, db
+
+logger = logging.getLogger(__name__)
+
+LIGADO = os.environ.get('ARTEFATOS_EXPLICACAO', '1').lower() not in ('0', 'false', 'nao', 'não')
+
+FORMATO = 1
+
+CLASSES = ('NEG', 'NEU', 'POS')
+
+
+def impressao_do_texto(texto):
+    """Hash do comentário, para não retomar perturbações de um texto que mudou."""
+    return hashlib.sha256(texto.encode('utf-8')).hexdigest()[:16]
+
+
+def empacotar(estado):
+    """Bytes do artefato, a partir do estado de um comentário.
+
+    `estado` é o dicionário de `services.explicar_em_lote`: `texto`, e
+    `lime_modo`, `lime_amostras`, `lime_dados`, `lime_probabilidades` e
+    `shap_probabilidades` quando houver.
+    """
+    arrays = {
+        'formato': np.array(FORMATO),
+        'texto': np.array(impressao_do_texto(estado['texto'])),
+    }
+    if estado.get('lime_dados') is not None:
+        dados = np.asarray(estado['lime_dados'], dtype=bool)
+        arrays['lime_modo'] = np.array(estado['lime_modo'])
+        arrays['lime_amostras'] = np.array(estado['lime_amostras'])
+        arrays['lime_forma'] = np.array(dados.shape)
+        arrays['lime_dados'] = np.packbits(dados, axis=1)
+        arrays['lime_probabilidades'] = np.asarray(estado['lime_probabilidades'], dtype=np.float32)
+    if estado.get('shap_probabilidades') is not None:
+        arrays['shap_probabilidades'] = np.asarray(estado['shap_probabilidades'], dtype=np.float32)
+
+    destino = io.BytesIO()
+    np.savez_compressed(destino, **arrays)
+    return destino.getvalue()
+
+
+def desempacotar(conteudo):
+    """O estado gravado por `empacotar`, com as máscaras de volta a 0 e 1."""
+    with np.load(io.BytesIO(conteudo)) as arquivo:
+        if int(arquivo['formato']) != FORMATO:
+            return None
+        estado = {'texto': str(arquivo['texto'])}
+        if 'lime_dados' in arquivo:
+            linhas, palavras = arquivo['lime_forma']
+            estado['lime_modo'] = str(arquivo['lime_modo'])
+            estado['lime_amostras'] = int(arquivo['lime_amostras'])
+            estado['lime_dados'] = np.unpackbits(
+                arquivo['lime_dados'], axis=1, count=int(palavras),
+            )[:int(linhas)].astype(float)
+            estado['lime_probabilidades'] = arquivo['lime_probabilidades']
+        if 'shap_probabilidades' in arquivo:
+            estado['shap_probabilidades'] = arquivo['shap_probabilidades']
+    return estado
+
+
+def _contagem(estado):
+    """(calculadas, total) das entradas do estado."""
+    calculadas = total = 0
+    for chave in ('lime_probabilidades', 'shap_probabilidades'):
+        probabilidades = estado.get(chave)
+        if probabilidades is not None:
+            calculadas += int(np.count_nonzero(~np.isnan(probabilidades[:, 0])))
+            total += len(probabilidades)
+    return calculadas, total
+
+
+def carregar(feedback_id, modelo, texto):
+    """O estado gravado deste feedback neste modelo, ou None.
+
+    Um artefato de outro texto, ou num formato que esta versão não lê, é
+    ignorado e será sobrescrito.
+    """
+    if not LIGADO:
+        return None
+    artefato = ArtefatoDeExplicacao.query.filter_by(feedback_id=feedback_id, modelo=modelo).first()
+    if artefato is None:
+        return None
+    try:
+        estado = desempacotar(artefato.conteudo)
+    except Exception:
+        logger.warning('Artefato do feedback %s ilegível, ignorado.', feedback_id, exc_info=True)
+        return None
+    if estado is None or estado['texto'] != impressao_do_texto(texto):
+        return None
+    estado['texto'] = texto
+    return estado
+
+
+def gravar(feedback_id, modelo, estado):
+    """Grava ou substitui o artefato deste feedback neste modelo. Faz commit.
+
+    Devolve (calculadas, total).
+    """
+    conteudo = empacotar(estado)
+    calculadas, total = _contagem(estado)
+    valores = {
+        'conteudo': conteudo,
+        'calculadas': calculadas,
+        'total': total,
+        'atualizado_em': datetime.datetime.utcnow(),
+    }
+
+    filtro = {'feedback_id': feedback_id, 'modelo': modelo}
+    try:
+        if not ArtefatoDeExplicacao.query.filter_by(**filtro).update(valores):
+            db.session.add(ArtefatoDeExplicacao(**filtro, **valores))
+        db.session.commit()
+    except IntegrityError:
+        # Outro trabalhador criou a linha entre a consulta e o INSERT, o que só
+        # acontece com a concessão vencida, ou o feedback foi apagado: nos
+        # dois casos, este ponto não tem onde ficar.
+        db.session.rollback()
+    except Exception:
+        db.session.rollback()
+        raise
+    return calculadas, total
+
+
+def apagar(ids_de_feedbacks):
+    """Apaga os artefatos destes feedbacks. Não faz commit."""
+    if ids_de_feedbacks:
+        ArtefatoDeExplicacao.query.filter(
+            ArtefatoDeExplicacao.feedback_id.in_(ids_de_feedbacks)
+        ).delete(synchronize_session=False)
+
+
+def reajustar_lime(estado, num_features, kernel_width, classe='POS'):
+    """A regressão do LIME refeita sobre as perturbações gravadas, sem o modelo.
+
+    O explicador é o de services.lime_explainer, com o kernel pedido. Devolve a
+    lista (palavra, peso) do `Explanation.as_list`, ainda sem a normalização da
+    tela.
+    """
+    from lime.lime_text import LimeTextExplainer
+
+    from . import lime_por_mascaras
+
+    if estado.get('lime_dados') is None:
+        raise ValueError('o artefato não tem as perturbações do LIME')
+    probabilidades = estado['lime_probabilidades']
+    faltando = int(np.count_nonzero(np.isnan(probabilidades[:, 0])))
+    if faltando:
+        raise ValueError(f'o artefato está incompleto: faltam {faltando} de {len(probabilidades)} '
+                         'entradas do LIME')
+
+    explicador = LimeTextExplainer(
+        kernel_width=kernel_width, class_names=list(CLASSES), random_state=42,
+    )
+    indexado = lime_por_mascaras.indexar(explicador, estado['texto'])
+    dados = estado['lime_dados']
+    if estado['lime_modo'] == 'enumeracao':
+        frequencias = lime_por_mascaras.enumerar(dados.shape[1], estado['lime_amostras'])[1]
+        inverso = np.arange(len(dados))
+    else:
+        frequencias = None
+        inverso = lime_por_mascaras.distintas(dados)[1]
+
+    return lime_por_mascaras.ajustar(
+        explicador, indexado, dados, probabilidades[inverso].astype(float),
+        CLASSES.index(classe), num_features, frequencias=frequencias,
+    )
@@ -0,0 +1,194 @@
+"""Onde roda a passagem pelo modelo de sentimento.
+
+O `_predict_proba` pedia tudo ao modelo do pysentimiento em fp32, no torch. É
+essa a origem dos cerca de 1,3 GB que o Dockerfile cita e, ao mesmo tempo, do
+custo de cada uma das 5.000 perturbações do LIME. Este módulo deixa escolher a
+forma de executar os mesmos pesos, por variável de ambiente:
+
+    BACKEND_INFERENCIA=torch-fp32   o modelo como vem, a referência (padrão)
+    BACKEND_INFERENCIA=torch-int8   quantização dinâmica das camadas lineares
+    BACKEND_INFERENCIA=torch-bf16   pesos e ativações em bfloat16
+    BACKEND_INFERENCIA=onnx         grafo exportado, executado pelo onnxruntime
+
+Nenhuma das alternativas é exata. Por isso o services.py compara cada uma com a
+referência em fp32 antes de aceitá-la, e recusa subir se a diferença passar do
+tolerado. Ver `_verificar_paridade` lá.
+
+O onnxruntime não está no requirements.txt: só quem escolhe o backend onnx
+precisa dele, e a ausência falha o boot com a instrução de instalação, em vez de
+cair em silêncio em outro backend.
+"""
+
+import copy
+import hashlib
+import json
+import logging
+import os
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+REFERENCIA = 'torch-fp32'
+BACKENDS = (REFERENCIA, 'torch-int8', 'torch-bf16', 'onnx')
+
+ESCOLHIDO = os.environ.get('BACKEND_INFERENCIA', REFERENCIA).strip().lower()
+
+# O grafo exportado fica junto dos pesos baixados na build, para ser reaproveitado
+# entre reinícios. Sem HF_HOME, fica na pasta de instância do app. Ao lado dele,
+# em ARQUIVO_ONNX + '.identidade', a impressão dos pesos que o geraram: outro
+# modelo, ou os mesmos pesos depois de outra conversão, exportam de novo.
+ARQUIVO_ONNX = os.environ.get(
+    'ONNX_ARQUIVO',
+    os.path.join(
+        os.environ.get('HF_HOME')
+        or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance'),
+        'voz-discente', 'sentimento.onnx',
+    ),
+)
+
+
+class BackendTorch:
+    """O modelo do transformers chamado diretamente, em qualquer precisão."""
+
+    def __init__(self, nome, modelo):
+        self.nome = nome
+        self.modelo = modelo.eval()
+        self.dispositivo = next(modelo.parameters()).device
+
+    def logits(self, entrada):
+        entrada = {chave: valor.to(self.dispositivo) for chave, valor in entrada.items()}
+        # Sempre em float32 na saída: o softmax e tudo o que vem depois não
+        # precisam saber em que precisão a passagem foi feita.
+        return self.modelo(**entrada).logits.float()
+
+
+class BackendOnnx:
+    """O grafo exportado do mesmo modelo, executado pelo onnxruntime na CPU."""
+
+    def __init__(self, caminho):
+        try:
+            import onnxruntime
+        except ImportError as erro:
+            raise RuntimeError(
+                'BACKEND_INFERENCIA=onnx exige o onnxruntime: pip install onnxruntime'
+            ) from erro
+
+        opcoes = onnxruntime.SessionOptions()
+        opcoes.intra_op_num_threads = torch.get_num_threads()
+        self.sessao = onnxruntime.InferenceSession(
+            caminho, sess_options=opcoes, providers=['CPUExecutionProvider'],
+        )
+        self.nome = 'onnx'
+        self.dispositivo = torch.device('cpu')
+        self._entradas = {e.name for e in self.sessao.get_inputs()}
+
+    def logits(self, entrada):
+        alimentacao = {
+            chave: valor.cpu().numpy()
+            for chave, valor in entrada.items() if chave in self._entradas
+        }
+        return torch.from_numpy(self.sessao.run(['logits'], alimentacao)[0]).float()
+
+
+class _SoLogits(torch.nn.Module):
+    """Envoltório para a exportação: o grafo recebe tensores posicionais e
+    devolve só os logits, sem o objeto de saída do transformers."""
+
+    def __init__(self, modelo, nomes):
+        super().__init__()
+        self.modelo = modelo
+        self.nomes = nomes
+
+    def forward(self, *tensores):
+        return self.modelo(**dict(zip(self.nomes, tensores))).logits
+
+
+def _impressao_dos_pesos(modelo):
+    """Hash dos tensores, da configuração e da versão do torch que exportaria.
+
+    O nome do modelo não basta: o pysentimiento não fixa a revisão, e os
+    mesmos nomes podem vir com outros pesos depois de um novo download.
+    """
+    impressao = hashlib.sha256()
+    impressao.update(torch.__version__.encode('utf-8'))
+    configuracao = json.dumps(modelo.config.to_dict(), sort_keys=True, default=str)
+    impressao.update(configuracao.encode('utf-8'))
+    for nome, tensor in modelo.state_dict().items():
+        tensor = tensor.detach().cpu().contiguous().reshape(-1)
+        impressao.update(f'{nome}|{tensor.numel()}|{tensor.dtype}'.encode('utf-8'))
+        impressao.update(tensor.view(torch.uint8).numpy())
+    return impressao.hexdigest()
+
+
+def _identidade_gravada(caminho):
+    try:
+        with open(caminho + '.identidade', encoding='utf-8') as arquivo:
+            return arquivo.read().strip()
+    except OSError:
+        return None
+
+
+def _exportar_onnx(modelo, tokenizador, caminho, identidade):
+    dispositivo = next(modelo.parameters()).device
+    exemplo = tokenizador(['A aula de hoje foi boa.'], return_tensors='pt').to(dispositivo)
+    nomes = list(exemplo.keys())
+    eixos = {nome: {0: 'lote', 1: 'sequencia'} for nome in nomes}
+    eixos['logits'] = {0: 'lote'}
+
+    os.makedirs(os.path.dirname(caminho), exist_ok=True)
+    provisorio = f'{caminho}.{os.getpid()}.exportando'
+
+    # Gravado com outro nome e renomeado no fim: uma exportação interrompida não
+    # pode deixar para o próximo boot um arquivo pela metade com o nome certo.
+    with torch.no_grad():
+        torch.onnx.export(
+            _SoLogits(modelo.eval(), nomes),
+            tuple(exemplo[nome] for nome in nomes),
+            provisorio,
+            input_names=nomes,
+            output_names=['logits'],
+            dynamic_axes=eixos,
+            opset_version=17,
+        )
+    os.replace(provisorio, caminho)
+
+    # A identidade vem depois do grafo: interrompido entre um e outro, o boot
+    # seguinte encontra a identidade antiga e exporta de novo.
+    with open(provisorio, 'w', encoding='utf-8') as arquivo:
+        arquivo.write(identidade)
+    os.replace(provisorio, caminho + '.identidade')
+    logger.info('Modelo exportado para ONNX em %s', caminho)
+
+
+def carregar(nome, modelo, tokenizador):
+    """O backend pedido, construído a partir do modelo fp32 já carregado.
+
+    O modelo recebido não é alterado: as variantes são cópias, para que a
+    referência continue disponível na verificação de paridade.
+    """
+    if nome not in BACKENDS:
+        raise RuntimeError(
+            f'BACKEND_INFERENCIA inválido: {nome!r}. Use um de: {", ".join(BACKENDS)}.'
+        )
+
+    if nome == REFERENCIA:
+        return BackendTorch(nome, modelo)
+
+    if nome == 'torch-int8':
+        # Quantização dinâmica só vale para CPU, e só nas camadas lineares, que
+        # são a maior parte dos pesos e do custo de um transformer.
+        quantizado = torch.ao.quantization.quantize_dynamic(
+            copy.deepcopy(modelo).cpu(), {torch.nn.Linear}, dtype=torch.qint8, inplace=True,
+        )
+        return BackendTorch(nome, quantizado)
+
+    if nome == 'torch-bf16':
+        return BackendTorch(nome, copy.deepcopy(modelo).to(torch.bfloat16))
+
+    identidade = _impressao_dos_pesos(modelo)
+    if not os.path.exists(ARQUIVO_ONNX) or _identidade_gravada(ARQUIVO_ONNX) != identidade:
+        if os.path.exists(ARQUIVO_ONNX):
+            logger.info('O grafo em %s é de outros pesos; exportando de novo.', ARQUIVO_ONNX)
+        _exportar_onnx(modelo, tokenizador, ARQUIVO_ONNX, identidade)
+    return BackendOnnx(ARQUIVO_ONNX)
@@ -0,0 +1,288 @@
+"""Cache das probabilidades do modelo, em memória e em disco.
+
+O `_predict_proba` já descartava texto repetido dentro de uma mesma chamada, mas
+nada sobrevivia entre uma chamada e outra. O LIME infere as perturbações de um
+comentário, o SHAP infere boa parte das mesmas logo depois, e o
+`calcular-explicacoes`, o seeder e o `perfilar.py` repetem tudo a cada execução.
+Texto igual no mesmo modelo dá a mesma saída, então guardar o resultado é exato.
+
+São dois níveis. O primeiro é um LRU em memória, limitado em número de entradas,
+que atende as repetições dentro do mesmo processo. O segundo é um arquivo SQLite
+local, também limitado, que sobrevive a reinícios e é compartilhado entre os
+processos da mesma máquina.
+
+A chave é o hash do texto exato junto com a identidade do modelo, a mesma que
+`descrever_modelo()` informa. Se o modelo mudar, as entradas antigas deixam de
+ser encontradas: uma probabilidade calculada por outros pesos nunca é servida
+como se fosse deste. Elas não são apagadas na abertura, porque o arquivo pode
+ser de mais de um modelo ao mesmo tempo (o servidor e o `flask
+worker-explicacoes` com backends diferentes, por exemplo), e um apagaria o do
+outro a cada boot. A coluna `modelo` só filtra; as entradas que ninguém mais
+usa saem pelo despejo do LRU do disco.
+
+O LRU em memória tem a própria trava, e o disco outra. Um acerto em memória
+nunca espera a leitura ou a gravação do SQLite de outra thread.
+
+Configuração, toda opcional:
+
+    CACHE_PREDICOES=0                  desliga os dois níveis
+    CACHE_PREDICOES_MEMORIA=50000      entradas no LRU em memória
+    CACHE_PREDICOES_DISCO=500000       entradas no arquivo; 0 desliga o disco
+    CACHE_PREDICOES_ARQUIVO=caminho    padrão: app/instance/predicoes.sqlite3
+
+Uma falha no disco nunca derruba a inferência: o cache passa a funcionar só em
+memória e o motivo vai para o log.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+LIGADO = os.environ.get('CACHE_PREDICOES', '1').lower() not in ('0', 'false', 'nao', 'não')
+MAXIMO_EM_MEMORIA = int(os.environ.get('CACHE_PREDICOES_MEMORIA', 50_000))
+MAXIMO_EM_DISCO = int(os.environ.get('CACHE_PREDICOES_DISCO', 500_000))
+CAMINHO_PADRAO = os.environ.get(
+    'CACHE_PREDICOES_ARQUIVO',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'predicoes.sqlite3'),
+)
+
+# Ao estourar o teto do disco, apaga um décimo a mais do que o excesso. Despejar
+# só o excedente faria toda gravação seguinte disparar outra faxina.
+_FOLGA_DO_DESPEJO = 0.1
+
+
+class CacheDePredicoes:
+    """Probabilidades já calculadas, por texto, para um modelo determinado."""
+
+    def __init__(self, identidade, caminho=CAMINHO_PADRAO,
+                 maximo_em_memoria=MAXIMO_EM_MEMORIA, maximo_em_disco=MAXIMO_EM_DISCO):
+        self.modelo = hashlib.sha256(identidade.encode('utf-8')).hexdigest()[:16]
+        self.maximo_em_memoria = maximo_em_memoria
+        self.maximo_em_disco = maximo_em_disco
+
+        self._memoria = OrderedDict()
+        # `_trava` guarda o LRU e os contadores de acerto; `_trava_do_disco`, a
+        # conexão SQLite, que não pode ser usada por duas threads ao mesmo
+        # tempo, e o que se conta do arquivo (`_no_disco`, `despejados`).
+        self._trava = threading.Lock()
+        self._trava_do_disco = threading.Lock()
+
+        self._caminho = caminho if maximo_em_disco > 0 else None
+        self._conexao = None
+        self._pid = None
+        self._no_disco = 0
+
+        self.acertos_em_memoria = 0
+        self.acertos_em_disco = 0
+        self.faltas = 0
+        self.despejados = 0
+
+        if self._caminho:
+            self._abrir()
+
+    # ------------------------------------------------------------------ chaves
+
+    def _chave(self, texto):
+        """Hash do texto prefixado pelo modelo.
+
+        O prefixo é o que separa as entradas de modelos diferentes que dividem
+        o arquivo. Aceita bytes para quem já tem a entrada do modelo
+        em outra forma que não texto.
+        """
+        dados = texto if isinstance(texto, bytes) else texto.encode('utf-8')
+        return hashlib.sha256(self.modelo.encode('ascii') + b'\0' + dados).digest()
+
+    # ------------------------------------------------------------------- disco
+
+    def _abrir(self):
+        try:
+            os.makedirs(os.path.dirname(self._caminho), exist_ok=True)
+            conexao = sqlite3.connect(
+                self._caminho, timeout=5, check_same_thread=False, isolation_level=None,
+            )
+            conexao.execute('PRAGMA journal_mode=WAL')
+            conexao.execute('PRAGMA synchronous=NORMAL')
+            conexao.execute(
+                'CREATE TABLE IF NOT EXISTS predicao ('
+                ' chave BLOB PRIMARY KEY,'
+                ' modelo TEXT NOT NULL,'
+                ' valores BLOB NOT NULL,'
+                ' usado_em REAL NOT NULL)'
+            )
+            conexao.execute('CREATE INDEX IF NOT EXISTS predicao_usado_em ON predicao (usado_em)')
+            self._no_disco = conexao.execute('SELECT COUNT(*) FROM predicao').fetchone()[0]
+        except (sqlite3.Error, OSError):
+            logger.warning('Cache de predições sem disco, só em memória: %s',
+                           self._caminho, exc_info=True)
+            self._caminho = None
+            return
+
+        self._conexao = conexao
+        self._pid = os.getpid()
+
+        logger.info('Cache de predições: %s entradas em %s', self._no_disco, self._caminho)
+
+    def _disco(self):
+        """A conexão deste processo. Chamar com `_trava_do_disco`.
+
+        Conexão SQLite não atravessa fork: um worker do gunicorn que herdasse a
+        do processo pai corromperia o arquivo. Quem muda de pid abre a própria.
+        """
+        if self._caminho is None:
+            return None
+        if self._pid != os.getpid():
+            self._abrir()
+        return self._conexao
+
+    def _desligar_disco(self):
+        logger.warning('Cache de predições: falha no disco, seguindo só em memória.',
+                       exc_info=True)
+        self._caminho = None
+        self._conexao = None
+
+    # -------------------------------------------------------------- interface
+
+    def buscar(self, textos):
+        """Dicionário texto -> probabilidades, só com os textos já conhecidos."""
+        encontrados = {}
+        chaves = {}
+
+        with self._trava:
+            for texto in textos:
+                chave = self._chave(texto)
+                valores = self._memoria.get(chave)
+                if valores is not None:
+                    self._memoria.move_to_end(chave)
+                    encontrados[texto] = valores
+                    self.acertos_em_memoria += 1
+                else:
+                    chaves[chave] = texto
+
+        if not chaves:
+            return encontrados
+
+        with self._trava_do_disco:
+            do_disco = self._ler_do_disco(list(chaves))
+
+        with self._trava:
+            for chave, valores in do_disco.items():
+                encontrados[chaves[chave]] = valores
+                self._lembrar(chave, valores)
+            self.acertos_em_disco += len(do_disco)
+            self.faltas += len(chaves) - len(do_disco)
+
+        return encontrados
+
+    def guardar(self, textos, probabilidades):
+        """Registra as probabilidades de um lote recém-calculado."""
+        linhas = []
+        agora = time.time()
+
+        with self._trava:
+            for texto, valores in zip(textos, probabilidades):
+                valores = np.asarray(valores, dtype=np.float64)
+                chave = self._chave(texto)
+                self._lembrar(chave, valores)
+                linhas.append((chave, self.modelo, valores.tobytes(), agora))
+
+        with self._trava_do_disco:
+            self._gravar_no_disco(linhas)
+
+    def estatisticas(self):
+        # `_no_disco` e `despejados` mudam junto com o arquivo, sob a trava do
+        # disco; os acertos e o LRU, sob a outra. Cada grupo é lido sob a sua.
+        with self._trava_do_disco:
+            em_disco = self._no_disco if self._caminho else None
+            despejados = self.despejados
+        with self._trava:
+            consultas = self.acertos_em_memoria + self.acertos_em_disco + self.faltas
+            return {
+                'consultas': consultas,
+                'acertos_em_memoria': self.acertos_em_memoria,
+                'acertos_em_disco': self.acertos_em_disco,
+                'faltas': self.faltas,
+                'taxa_de_acerto': round(
+                    (self.acertos_em_memoria + self.acertos_em_disco) / consultas, 4
+                ) if consultas else None,
+                'em_memoria': len(self._memoria),
+                'em_disco': em_disco,
+                'despejados': despejados,
+            }
+
+    # ---------------------------------------------------------------- interno
+
+    def _lembrar(self, chave, valores):
+        self._memoria[chave] = valores
+        self._memoria.move_to_end(chave)
+        while len(self._memoria) > self.maximo_em_memoria:
+            self._memoria.popitem(last=False)
+
+    def _ler_do_disco(self, chaves):
+        conexao = self._disco()
+        if conexao is None:
+            return {}
+
+        encontrados = {}
+        try:
+            # O SQLite limita o número de parâmetros por instrução; 501 fica
+            # abaixo do teto de qualquer versão em uso.
+            for inicio in range(0, len(chaves), 500):
+                parte = chaves[inicio:inicio + 500]
+                marcadores = ','.join('?' * len(parte))
+                for chave, valores in conexao.execute(
+                    f'SELECT chave, valores FROM predicao '
+                    f'WHERE modelo = ? AND chave IN ({marcadores})', [self.modelo, *parte],
+                ):
+                    encontrados[bytes(chave)] = np.frombuffer(valores, dtype=np.float64).copy()
+
+            if encontrados:
+                agora = time.time()
+                conexao.executemany(
+                    'UPDATE predicao SET usado_em = ? WHERE chave = ?',
+                    [(agora, chave) for chave in encontrados],
+                )
+        except sqlite3.Error:
+            self._desligar_disco()
+            return {}
+
+        return encontrados
+
+    def _gravar_no_disco(self, linhas):
+        conexao = self._disco()
+        if conexao is None or not linhas:
+            return
+
+        try:
+            antes = conexao.total_changes
+            conexao.executemany(
+                'INSERT OR IGNORE INTO predicao (chave, modelo, valores, usado_em) '
+                'VALUES (?, ?, ?, ?)',
+                linhas,
+            )
+            self._no_disco += conexao.total_changes - antes
+
+            # A contagem local só enxerga as gravações deste processo. Antes de
+            # apagar qualquer coisa, confere o total de verdade no arquivo.
+            if self._no_disco > self.maximo_em_disco:
+                self._no_disco = conexao.execute('SELECT COUNT(*) FROM predicao').fetchone()[0]
+
+            if self._no_disco > self.maximo_em_disco:
+                excesso = self._no_disco - self.maximo_em_disco
+                quantos = excesso + int(self.maximo_em_disco * _FOLGA_DO_DESPEJO)
+                apagadas = conexao.execute(
+                    'DELETE FROM predicao WHERE chave IN '
+                    '(SELECT chave FROM predicao ORDER BY usado_em LIMIT ?)',
+                    (quantos,),
+                ).rowcount
+                self._no_disco -= apagadas
+                self.despejados += apagadas
+        except sqlite3.Error:
+            self._desligar_disco()
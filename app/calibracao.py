@@ -0,0 +1,189 @@
+"""Calibração do tamanho do lote e das threads do torch para a máquina em uso.
+
+PREDICT_BATCH_SIZE e TORCH_THREADS foram acertados à mão para o Cloud Run, onde
+`os.cpu_count()` informa os núcleos do host e não a cota do contêiner. Em outra
+máquina, ou com outra cota, os mesmos números podem ficar longe do melhor.
+
+`flask calibrar-inferencia` mede uma grade de tamanhos de lote e de números de
+threads sobre textos fixos, parecidos com as perturbações do LIME, e grava a
+combinação mais rápida num arquivo pequeno. A entrada é indexada pela
+impressão digital da máquina: modelo da CPU, núcleos disponíveis, cota do
+cgroup e identidade do modelo. No boot seguinte, o services.py carrega a
+calibração que corresponder à máquina atual; uma imagem levada para outro host
+simplesmente não encontra a sua e fica com os padrões.
+
+Variável de ambiente explícita sempre vence a calibração. Configuração:
+
+    CALIBRACAO_ARQUIVO=caminho   padrão: app/instance/calibracao.json
+    CALIBRAR_NO_BOOT=1           calibra ao subir, se não houver calibração
+                                 para esta máquina (atrasa o primeiro boot)
+"""
+
+import hashlib
+import json
+import logging
+import math
+import os
+import platform
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ARQUIVO = os.environ.get(
+    'CALIBRACAO_ARQUIVO',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'calibracao.json'),
+)
+CALIBRAR_NO_BOOT = os.environ.get('CALIBRAR_NO_BOOT', '0').lower() in ('1', 'true', 'sim')
+
+LOTES = (8, 16, 32, 64, 128)
+
+# Comentários de partida dos textos de calibração. Têm o comprimento dos
+# comentários reais; as perturbações saem deles removendo palavras, como o LIME.
+_BASES = (
+    'A aula foi boa e consegui acompanhar.',
+    'Não entendi nada, estou perdido e desmotivado.',
+    'Aula mediana. Alguns pontos ficaram confusos, mas vou rever o material.',
+    'O professor explicou muito bem e o ambiente foi acolhedor.',
+    'As tarefas estão muito difíceis e já estou atrasado em várias delas.',
+    'Achei a aula proveitosa, ainda que alguns trechos tenham ficado corridos. '
+    'Vou revisar os exemplos em casa e trazer as dúvidas na próxima semana.',
+)
+
+
+def cota_de_cpu():
+    """Núcleos que o cgroup permite a este processo, ou None se não houver limite."""
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as arquivo:
+            cota, periodo = arquivo.read().split()[:2]
+        if cota != 'max':
+            return int(cota) / int(periodo)
+        return None
+    except (OSError, ValueError):
+        pass
+
+    # cgroup v1, ainda comum em hosts mais antigos.
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as arquivo:
+            cota = int(arquivo.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as arquivo:
+            periodo = int(arquivo.read())
+        if cota > 0:
+            return cota / periodo
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def nucleos_disponiveis():
+    """Núcleos que este processo pode de fato usar: afinidade limitada pela cota."""
+    if hasattr(os, 'sched_getaffinity'):
+        nucleos = len(os.sched_getaffinity(0))
+    else:
+        nucleos = os.cpu_count() or 1
+
+    cota = cota_de_cpu()
+    if cota:
+        nucleos = min(nucleos, math.ceil(cota))
+    return max(1, nucleos)
+
+
+def _modelo_da_cpu():
+    try:
+        with open('/proc/cpuinfo') as arquivo:
+            for linha in arquivo:
+                if linha.startswith('model name'):
+                    return linha.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or 'desconhecida'
+
+
+def impressao_digital(identidade):
+    """Chave da calibração: esta máquina, esta cota e este modelo."""
+    partes = {
+        'arquitetura': platform.machine(),
+        'cpu': _modelo_da_cpu(),
+        'nucleos': nucleos_disponiveis(),
+        'cota': cota_de_cpu(),
+        'modelo': identidade,
+    }
+    return hashlib.sha256(json.dumps(partes, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def _ler():
+    try:
+        with open(ARQUIVO, encoding='utf-8') as arquivo:
+            return json.load(arquivo)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError):
+        logger.warning('Calibração ilegível em %s, ignorada.', ARQUIVO, exc_info=True)
+        return {}
+
+
+def carregar(digital):
+    """A calibração gravada para esta impressão digital, ou None."""
+    return _ler().get(digital)
+
+
+def gravar(digital, configuracao):
+    """Registra a calibração desta máquina, preservando as de outras."""
+    calibracoes = _ler()
+    calibracoes[digital] = configuracao
+
+    os.makedirs(os.path.dirname(ARQUIVO), exist_ok=True)
+    provisorio = ARQUIVO + '.gravando'
+    with open(provisorio, 'w', encoding='utf-8') as arquivo:
+        json.dump(calibracoes, arquivo, indent=2, sort_keys=True)
+    os.replace(provisorio, ARQUIVO)
+
+
+def textos_de_calibracao(quantidade=256):
+    """Textos fixos no formato das perturbações do LIME.
+
+    Cada um é um dos comentários de partida com um número sorteado de palavras
+    removidas. A semente é fixa: toda calibração mede sobre os mesmos textos.
+    """
+    gerador = np.random.RandomState(0)
+    textos = []
+    for i in range(quantidade):
+        palavras = _BASES[i % len(_BASES)].split()
+        removidas = gerador.randint(0, len(palavras))
+        ficam = np.sort(gerador.choice(len(palavras), len(palavras) - removidas, replace=False))
+        textos.append(' '.join(palavras[j] for j in ficam))
+    return textos
+
+
+def grade_de_threads(nucleos=None):
+    """1, 2, 4... até os núcleos disponíveis, e os próprios núcleos."""
+    nucleos = nucleos or nucleos_disponiveis()
+    grade = {nucleos}
+    n = 1
+    while n < nucleos:
+        grade.add(n)
+        n *= 2
+    return tuple(sorted(grade))
+
+
+def calibrar(medir, lotes=LOTES, threads=None, repeticoes=2):
+    """Mede cada combinação e devolve (melhor, tabela).
+
+    `medir(lote, threads)` infere os textos de calibração com aquela
+    configuração e devolve quantos textos por segundo. Vale a melhor de
+    `repeticoes` medições, para que uma interrupção do sistema não decida.
+    """
+    threads = threads or grade_de_threads()
+    tabela = []
+    for n in threads:
+        for lote in lotes:
+            melhor = max(medir(lote, n) for _ in range(repeticoes))
+            tabela.append({'tamanho_do_lote': lote, 'threads': n,
+                           'textos_por_segundo': round(melhor, 1)})
+            logger.info('calibracao: lote %s, %s threads, %.1f textos/s', lote, n, melhor)
+
+    vencedor = max(tabela, key=lambda linha: linha['textos_por_segundo'])
+    melhor = dict(vencedor, medido_em=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  nucleos=nucleos_disponiveis(), cota=cota_de_cpu())
+    return melhor, tabela
@@ -12,10 +12,14 @@ provisória e obrigação de defini-la no primeiro acesso.
     flask redefinir-senha --username marina
     flask definir-email --username marina --email marina@unifei.edu.br
     flask preencher-emails
+    flask worker-explicacoes
+    flask recalcular-risco --conferir
 """
 
+import logging
 import secrets
 import string
+import time
 
 import click
 from flask.cli import with_appcontext
@@ -24,6 +28,8 @@ from werkzeug.security import generate_password_hash
 from .emails import email_valido
 from .models import Subject, User, db
 
+logger = logging.getLogger(__name__)
+
 SENHA_PROVISORIA_PADRAO = '123'
 ALFABETO = string.ascii_letters + string.digits
 
@@ -448,8 +454,8 @@ def estado_dos_feedbacks(username, quantos):
         elif not f.additional_comment:
             situacao = 'sem comentário, nada a explicar'
         elif not f.explicacao_calculada:
-            situacao = ('cálculo em curso' if f.explicacao_em_curso
-                        else 'SEM explicação, e sem cálculo em curso')
+            situacao = (f'SEM explicação, tarefa {f.tarefa.estado}' if f.tarefa
+                        else 'SEM explicação, e sem tarefa na fila')
         elif f.avisado_em:
             situacao = f'avisado em {f.avisado_em:%d/%m %H:%M}'
         elif not usuario.email:
@@ -488,46 +494,169 @@ def resetar_consentimento(username):
 @click.command('calcular-explicacoes')
 @click.option('--sem-email', is_flag=True,
               help='Calcula sem avisar ninguém. Útil para testar.')
+@click.option('--lote', default=8, show_default=True, type=click.IntRange(min=1),
+              help='Comentários explicados juntos, dividindo as passagens pelo modelo. '
+                   '1 explica um de cada vez.')
+@click.option('--enfileirar', 'so_enfileirar', is_flag=True,
+              help='Não calcula aqui: põe os pendentes na fila, atrás dos pedidos dos '
+                   'alunos, para o worker-explicacoes calcular.')
 @with_appcontext
-def calcular_explicacoes(sem_email):
+def calcular_explicacoes(sem_email, lote, so_enfileirar):
     """Calcula LIME e SHAP dos comentários que ficaram sem explicação.
 
     Serve para os feedbacks cuja requisição caiu antes de as atribuições serem
     gravadas: o comentário e o sentimento estão salvos, o destaque não.
+
+    Os comentários são explicados em grupos de --lote. As perturbações do grupo
+    inteiro passam juntas pelo modelo, sem repetição entre comentários, o que
+    enche os lotes que um comentário curto sozinho deixaria quase vazios. Cada
+    comentário é gravado no seu próprio commit: uma queda perde no máximo o
+    cálculo do grupo em curso.
+
+    Comentário com texto igual a um já explicado com o mesmo modelo recebe a
+    explicação guardada, e cada texto distinto é calculado uma vez só (ver
+    explicacoes_por_texto.py).
+
+    Com --enfileirar, os pendentes viram tarefas de prioridade baixa na fila
+    das explicações, e o trabalhador as calcula depois das dos alunos.
     """
+    import datetime
     import json
 
     from .emails import configurado, notificar
-    from .models import Feedback
-    from .services import explain_sentiment_lime, explain_sentiment_shap
+    from .models import Feedback, TarefaDeExplicacao
+    from .tarefas import enfileirar
 
     if not sem_email and not configurado():
         click.echo('Aviso: SMTP não configurado, ninguém será avisado por e-mail.')
         click.echo('As explicações são calculadas assim mesmo.\n')
 
+    # O que um trabalhador está calculando agora fica de fora, para não ser
+    # calculado duas vezes.
+    em_curso = db.session.query(TarefaDeExplicacao.feedback_id).filter(
+        TarefaDeExplicacao.estado == TarefaDeExplicacao.EM_CURSO,
+        TarefaDeExplicacao.concessao_ate >= datetime.datetime.utcnow(),
+    )
     pendentes = Feedback.ativos().filter(
         Feedback.additional_comment.isnot(None),
         Feedback.additional_comment != '',
         Feedback.token_attributions_json.is_(None),
+        Feedback.id.notin_(em_curso.scalar_subquery()),
     ).order_by(Feedback.id).all()
 
+    if so_enfileirar:
+        for feedback in pendentes:
+            enfileirar(feedback, TarefaDeExplicacao.PRIORIDADE_DA_VARREDURA)
+        click.echo(f'{len(pendentes)} comentário(s) postos na fila das explicações.')
+        return
+
     avisados = 0
 
     if pendentes:
-        click.echo(f'{len(pendentes)} comentário(s) sem explicação. Cada um leva alguns minutos.\n')
-
-        for posicao, feedback in enumerate(pendentes, 1):
-            trecho = feedback.additional_comment[:50]
-            click.echo(f'[{posicao}/{len(pendentes)}] {trecho}...', nl=False)
+        # Só aqui, e não no topo: enfileirar, ou não ter o que calcular, não
+        # deve pagar o carregamento do modelo.
+        from . import explicacoes_por_texto as reuso
+        from .escalonador_de_inferencia import VARREDURA
+        from .prontidao import carregar_modelo
+        from .tarefas import CONCESSAO, nome_do_trabalhador
+
+        services = carregar_modelo()
+        modelo = services.IDENTIDADE_DO_MODELO
+        dono = nome_do_trabalhador('varredura')
+        total = len(pendentes)
+
+        # Comentário igual a um já explicado com este modelo sai pronto.
+        reaproveitados = 0
+        if reuso.LIGADO:
+            restantes = []
+            for feedback in pendentes:
+                if reuso.reaproveitar(feedback, modelo):
+                    db.session.commit()
+                    reaproveitados += 1
+                else:
+                    restantes.append(feedback)
+            pendentes = restantes
+            if reaproveitados:
+                click.echo(f'{reaproveitados} comentário(s) com texto já explicado, reaproveitados.')
+
+        # Um cálculo por texto distinto, gravado em todos os feedbacks com ele.
+        grupos = {}
+        for feedback in pendentes:
+            grupos.setdefault(
+                reuso.chave(feedback.additional_comment) if reuso.LIGADO else feedback.id, [],
+            ).append(feedback)
+
+        click.echo(f'{len(pendentes)} comentário(s) sem explicação, {len(grupos)} texto(s) '
+                   f'distinto(s), em grupos de {lote}.\n')
+        inicio = time.perf_counter()
+        posicao = reaproveitados
+        em_outro = 0
+
+        chaves = list(grupos)
+        for comeco in range(0, len(chaves), lote):
+            parte = chaves[comeco:comeco + lote]
+            if reuso.LIGADO:
+                # O texto que um trabalhador está calculando fica com ele; o
+                # feedback recebe a explicação na próxima varredura.
+                reservadas = [c for c in parte if reuso.reservar(c, modelo, dono, CONCESSAO)]
+                em_outro += sum(len(grupos[c]) for c in parte if c not in reservadas)
+                parte = reservadas
+            if not parte:
+                continue
 
+            textos = [reuso.normalizar(grupos[c][0].additional_comment) for c in parte]
             try:
-                feedback.token_attributions_json = json.dumps(explain_sentiment_lime(feedback.additional_comment))
-                feedback.shap_attributions_json = json.dumps(explain_sentiment_shap(feedback.additional_comment))
-                db.session.commit()
-                click.echo(' ok')
-            except Exception as erro:
-                db.session.rollback()
-                click.echo(f' falhou: {erro}')
+                resultados = services.explicar_em_lote(textos, VARREDURA)
+
+                for c, texto, resultado in zip(parte, textos, resultados):
+                    erros = [erro for _, erro, _ in resultado.values() if erro is not None]
+                    tempo_lime, tempo_shap = resultado['lime'][2], resultado['shap'][2]
+                    if reuso.LIGADO and not erros:
+                        reuso.concluir(c, modelo, resultado['lime'][0],
+                                       services.modo_lime(texto), resultado['shap'][0])
+
+                    for feedback in grupos[c]:
+                        posicao += 1
+                        click.echo(f'[{posicao}/{total}] {feedback.additional_comment[:50]}...',
+                                   nl=False)
+                        try:
+                            if erros:
+                                raise erros[0]
+                            feedback.token_attributions_json = json.dumps(resultado['lime'][0])
+                            feedback.lime_modo = services.modo_lime(texto)
+                            feedback.shap_attributions_json = json.dumps(resultado['shap'][0])
+                            db.session.commit()
+                            click.echo(f' ok (lime {tempo_lime:.1f}s, shap {tempo_shap:.1f}s)')
+                            logger.info(
+                                'explicacao feedback=%s caracteres=%s lime=%.1fs shap=%.1fs '
+                                'total=%.1fs backend=%s trabalhador=%s',
+                                feedback.id, len(texto), tempo_lime, tempo_shap,
+                                max(tempo_lime, tempo_shap), services.descrever_modelo()['backend'],
+                                dono,
+                            )
+                        except Exception as erro:
+                            db.session.rollback()
+                            click.echo(f' falhou: {erro}')
+            finally:
+                if reuso.LIGADO:
+                    reuso.desistir(parte, modelo, dono)
+
+        decorrido = time.perf_counter() - inicio
+        calculados = len(pendentes) - em_outro
+        if calculados:
+            click.echo(f'\n{calculados} comentário(s) em {decorrido:.0f}s, '
+                       f'{decorrido / calculados:.1f}s por comentário.')
+        if em_outro:
+            click.echo(f'{em_outro} comentário(s) com o texto em cálculo por um trabalhador; '
+                       'ficam para a próxima varredura.')
+
+        # Comentário repetido entre alunos, ou já calculado numa rodada anterior,
+        # sai do cache em vez de passar pelo modelo. A taxa mostra quanto disso
+        # aconteceu nesta varredura.
+        cache = services.estatisticas_do_cache()
+        if cache and cache['consultas']:
+            click.echo(f"\nCache de predições: {cache['taxa_de_acerto']:.0%} de acerto "
+                       f"em {cache['consultas']} consulta(s).")
     else:
         click.echo('Nenhum comentário pendente de explicação.')
 
@@ -589,6 +718,7 @@ def apagar_contas_de_teste(prefixo, sim):
     digitação não alcance a turma. E mostra o que vai apagar antes de apagar.
     """
     from .models import Feedback, StudentRiskAnalysis
+    from .tarefas import apagar_do_aluno
 
     prefixo = (prefixo or '').strip()
     if len(prefixo) < 4:
@@ -620,6 +750,7 @@ def apagar_contas_de_teste(prefixo, sim):
 
     StudentRiskAnalysis.query.filter(StudentRiskAnalysis.student_id.in_(ids)).delete(
         synchronize_session=False)
+    apagar_do_aluno(ids)
     Feedback.query.filter(Feedback.student_id.in_(ids)).delete(synchronize_session=False)
     User.query.filter(User.id.in_(ids)).delete(synchronize_session=False)
     db.session.commit()
@@ -627,10 +758,211 @@ def apagar_contas_de_teste(prefixo, sim):
     click.echo(f'\nPronto. {len(contas)} conta(s) e {feedbacks} feedback(s) apagados.')
 
 
+@click.command('worker-explicacoes')
+@click.option('--por-vez', default=None, type=click.IntRange(min=1),
+              help='Tarefas pegas de uma vez e explicadas em lote. '
+                   'Padrão: EXPLICACOES_POR_VEZ, ou 4.')
+@click.option('--ate-esvaziar', is_flag=True,
+              help='Termina quando a fila ficar vazia, em vez de esperar por mais.')
+@click.option('--processos', default=None, type=click.IntRange(min=1),
+              help='Processos filhos calculando em paralelo sobre uma cópia só do '
+                   'modelo, cada um com uma fatia dos núcleos. '
+                   'Padrão: EXPLICACOES_PROCESSOS, ou 1.')
+@with_appcontext
+def worker_explicacoes(por_vez, ate_esvaziar, processos):
+    """Calcula as explicações que a rota põe na fila, até ser interrompido.
+
+    Pode rodar em quantas máquinas for, ao lado ou no lugar da thread embutida
+    no servidor web (EXPLICACOES_NO_PROCESSO): cada tarefa é de um trabalhador
+    só, e a de quem cair volta para a fila quando a concessão vencer.
+
+    Com --processos acima de 1, o modelo é carregado uma vez e compartilhado
+    por fork entre os filhos; a memória e a vazão de cada um vão para o log.
+    """
+    from flask import current_app
+
+    from . import processos_de_explicacao, tarefas
+    from .models import TarefaDeExplicacao
+
+    abertas = TarefaDeExplicacao.query.filter(
+        TarefaDeExplicacao.estado.in_((TarefaDeExplicacao.PENDENTE, TarefaDeExplicacao.EM_CURSO))
+    ).count()
+    processos = processos or processos_de_explicacao.PROCESSOS
+    por_vez = por_vez or tarefas.POR_VEZ
+
+    if processos > 1:
+        click.echo(f'{processos} processos, {abertas} tarefa(s) abertas na fila. '
+                   'Ctrl+C para parar.')
+        execucao = processos_de_explicacao.ProcessosDeExplicacao(
+            current_app._get_current_object(), processos, por_vez, ate_esvaziar,
+        )
+        execucao.executar()
+        final = execucao.estatisticas()
+        click.echo(f"\n{final['concluidas']} explicação(ões) concluídas, "
+                   f"{final['por_minuto']} por minuto.")
+        return
+
+    nome = tarefas.nome_do_trabalhador()
+    click.echo(f'Trabalhador {nome}: {abertas} tarefa(s) abertas na fila. Ctrl+C para parar.')
+
+    try:
+        tarefas.trabalhar(nome, por_vez, ate_esvaziar=ate_esvaziar)
+    except KeyboardInterrupt:
+        # O que estava em curso volta para a fila quando a concessão vencer.
+        click.echo('\nInterrompido.')
+
+
+def _inteiros(texto):
+    return tuple(int(parte) for parte in texto.split(',') if parte.strip())
+
+
+@click.command('calibrar-inferencia')
+@click.option('--lotes', default=None,
+              help='Tamanhos de lote a medir, separados por vírgula. Padrão: 8,16,32,64,128.')
+@click.option('--threads', default=None,
+              help='Números de threads a medir, separados por vírgula. '
+                   'Padrão: potências de 2 até os núcleos disponíveis.')
+@click.option('--sem-gravar', is_flag=True,
+              help='Só mede e mostra, sem gravar a calibração.')
+@with_appcontext
+def calibrar_inferencia(lotes, threads, sem_gravar):
+    """Mede lote e threads do torch nesta máquina e grava a combinação mais rápida.
+
+    A medição respeita a cota de CPU do contêiner, e não os núcleos do host. O
+    resultado vale a partir do próximo boot, para esta máquina e este modelo;
+    PREDICT_BATCH_SIZE e TORCH_THREADS no ambiente continuam tendo a palavra
+    final.
+    """
+    from . import calibracao
+    from .prontidao import carregar_modelo
+
+    calibrar = carregar_modelo().calibrar_inferencia
+
+    click.echo(f'Núcleos disponíveis: {calibracao.nucleos_disponiveis()} '
+               f'(cota do cgroup: {calibracao.cota_de_cpu() or "sem limite"}).')
+    click.echo('Medindo. Leva alguns minutos.\n')
+
+    melhor, tabela = calibrar(
+        lotes=_inteiros(lotes) if lotes else calibracao.LOTES,
+        threads=_inteiros(threads) if threads else None,
+        gravar=not sem_gravar,
+    )
+
+    click.echo(f'{"threads":>8} {"lote":>6} {"textos/s":>10}')
+    for linha in tabela:
+        vencedora = (linha['threads'], linha['tamanho_do_lote']) == (
+            melhor['threads'], melhor['tamanho_do_lote'])
+        marca = '  <- melhor' if vencedora else ''
+        click.echo(f"{linha['threads']:>8} {linha['tamanho_do_lote']:>6} "
+                   f"{linha['textos_por_segundo']:>10.1f}{marca}")
+
+    if sem_gravar:
+        click.echo('\nNada foi gravado.')
+    else:
+        click.echo(f'\nGravado em {calibracao.ARQUIVO}. Vale a partir do próximo boot.')
+
+
+@click.command('reajustar-lime')
+@click.argument('feedback_id', type=int)
+@click.option('--palavras', default=10, show_default=True, type=click.IntRange(min=1),
+              help='num_features da regressão.')
+@click.option('--kernel', default=25.0, show_default=True, type=click.FloatRange(min=0, min_open=True),
+              help='Largura do kernel do LIME.')
+@click.option('--classe', default='POS', show_default=True,
+              type=click.Choice(['NEG', 'NEU', 'POS']), help='Classe explicada.')
+@click.option('--modelo', default=None,
+              help='Identidade do modelo do artefato. Padrão: o gravado por último.')
+@with_appcontext
+def reajustar_lime(feedback_id, palavras, kernel, classe, modelo):
+    """Refaz a regressão do LIME de um feedback sobre as perturbações gravadas.
+
+    Usa as máscaras e as probabilidades do artefato da explicação (ver
+    artefatos.py), sem carregar o modelo: muda o número de palavras, a largura
+    do kernel ou a classe e responde em milissegundos. Nada é gravado.
+    """
+    from . import artefatos
+    from .models import ArtefatoDeExplicacao, Feedback
+
+    feedback = db.session.get(Feedback, feedback_id)
+    if feedback is None:
+        raise click.ClickException(f'Feedback {feedback_id} não encontrado.')
+
+    consulta = ArtefatoDeExplicacao.query.filter_by(feedback_id=feedback_id)
+    if modelo:
+        consulta = consulta.filter_by(modelo=modelo)
+    artefato = consulta.order_by(ArtefatoDeExplicacao.atualizado_em.desc()).first()
+    if artefato is None:
+        raise click.ClickException(f'O feedback {feedback_id} não tem artefato de explicação.')
+
+    estado = artefatos.carregar(feedback_id, artefato.modelo, feedback.additional_comment)
+    if estado is None:
+        raise click.ClickException('O artefato não corresponde ao comentário ou não pôde ser lido.')
+
+    inicio = time.perf_counter()
+    try:
+        pesos = artefatos.reajustar_lime(estado, palavras, kernel, classe)
+    except ValueError as erro:
+        raise click.ClickException(str(erro))
+    decorrido = time.perf_counter() - inicio
+
+    click.echo(f'Feedback {feedback_id}, modelo {artefato.modelo}, {estado["lime_modo"]}, '
+               f'{len(estado["lime_dados"])} amostras.')
+    click.echo(f'Classe {classe}, {palavras} palavras, kernel {kernel:g}: {1000 * decorrido:.0f} ms.\n')
+    for palavra, peso in pesos:
+        click.echo(f'  {palavra:<24} {peso:+.4f}')
+
+
+_NIVEIS = {None: '(sem linha)', 'baixo': 'baixo', 'medio': 'médio', 'alto': 'alto'}
+
+
+@click.command('recalcular-risco')
+@click.option('--conferir', is_flag=True,
+              help='Confere cada par com o cálculo linha a linha e, se algum divergir, '
+                   'falha sem gravar nada.')
+@with_appcontext
+def recalcular_risco(conferir):
+    """Recalcula a análise de risco de todos os alunos, em cada disciplina.
+
+    Para depois de mudar os pesos ou os limiares de StudentRiskAnalysis: uma
+    consulta agregada, o risco de todos os pares de uma vez e um UPSERT em lote,
+    numa transação só. Mostra quantos pares mudaram de nível. Com --conferir,
+    uma divergência desfaz a transação inteira.
+    """
+    from .feedbacks import recalcular_riscos
+
+    resumo = recalcular_riscos(conferir=conferir)
+    click.echo(f"\n{resumo['pares']} par(es) aluno e disciplina recalculado(s) "
+               f"em {resumo['segundos']:.2f}s; {resumo['removidas']} linha(s) sem "
+               'feedback ativo removida(s).')
+
+    if resumo['mudancas']:
+        click.echo('\nMudanças de nível:')
+        for (antes, depois), quantos in sorted(resumo['mudancas'].items(),
+                                               key=lambda item: -item[1]):
+            click.echo(f'  {_NIVEIS[antes]:>12} -> {_NIVEIS[depois]:<12} {quantos}')
+    else:
+        click.echo('Nenhum par mudou de nível.')
+
+    if conferir:
+        divergencias = resumo['divergencias']
+        if divergencias:
+            for divergencia in divergencias[:10]:
+                click.echo(f"  aluno {divergencia['student_id']}, disciplina "
+                           f"{divergencia['subject_id']}: linha a linha "
+                           f"{divergencia['linha_a_linha']}, em lote {divergencia['em_lote']}")
+            raise click.ClickException(
+                f'{len(divergencias)} par(es) com o cálculo em lote diferente do linha a linha. '
+                'Nada foi gravado.'
+            )
+        click.echo('\nConferido: o cálculo em lote é idêntico ao linha a linha em todos os pares.')
+    click.echo()
+
+
 def register_commands(app):
     for comando in (criar_coordenador, criar_professor, criar_disciplina,
                     criar_aluno, criar_alunos, vincular_professor, listar_usuarios,
                     redefinir_senha, definir_email, preencher_emails,
                     estado_dos_feedbacks, resetar_consentimento,
-                    calcular_explicacoes, apagar_contas_de_teste):
+                    calcular_explicacoes, worker_explicacoes, calibrar_inferencia,
+                    reajustar_lime, apagar_contas_de_teste, recalcular_risco):
         app.cli.add_command(comando)
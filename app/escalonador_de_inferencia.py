@@ -0,0 +1,176 @@
+"""A vez de cada passagem pelo modelo, por ordem de prioridade.
+
+As filas de fila_de_inferencia.py juntam pedidos em lotes, mas cada uma tem a
+sua thread e chamava o modelo quando bem entendesse. O sentimento de um envio
+no /analyze, um texto só, disputava os núcleos com as milhares de máscaras do
+LIME de outro aluno. O torch já usa todos os núcleos numa passagem; duas ao
+mesmo tempo dividem os mesmos núcleos com o dobro de threads, e as duas
+ficam mais lentas do que se tivessem ido uma depois da outra.
+
+Agora toda passagem pede a vez a este escalonador, com a sua faixa:
+
+    analise       o sentimento do /analyze, que o aluno espera na tela
+    explicacao    LIME e SHAP que um aluno pediu
+    varredura     o que ninguém está esperando: calcular-explicacoes, o seeder,
+                  as tarefas de prioridade baixa da fila
+
+Só SIMULTANEAS passagens rodam de cada vez. Quando uma termina, a vez vai para
+a faixa de maior prioridade que estiver esperando. Uma passagem em curso não é
+interrompida: a troca de faixa acontece entre lotes, e o que o /analyze espera
+no pior caso é o fim de uma passagem da explicação em curso, que o
+ORCAMENTO_DE_TOKENS limita. Uma explicação de mil passagens, por outro lado,
+cede a vez mil vezes.
+
+A prioridade é estrita: a varredura só passa quando não há explicação de
+aluno esperando, e as explicações, quando não há análise. É o que se quer
+aqui, em que a faixa de cima é pequena e chega aos poucos.
+
+Cada faixa guarda quanto esperou pela vez, a média e o p99 das últimas
+esperas, e quanto passou pelo modelo: passagens, itens e itens por segundo de
+modelo. O GET /admin/inferencia e o perfilar.py mostram os números, e o
+medir_prioridade.py compara a latência do /analyze com e sem o escalonador.
+
+    INFERENCIA_SIMULTANEAS=1    passagens pelo modelo ao mesmo tempo; com 0,
+                                cada uma vai direto, como antes
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+ANALISE = 'analise'
+EXPLICACAO = 'explicacao'
+VARREDURA = 'varredura'
+
+# Da maior prioridade para a menor.
+FAIXAS = (ANALISE, EXPLICACAO, VARREDURA)
+
+SIMULTANEAS = int(os.environ.get('INFERENCIA_SIMULTANEAS', 1))
+
+# Esperas guardadas por faixa para o p99. Mil passagens cobrem alguns minutos de
+# explicação, e uma manhã de /analyze.
+_AMOSTRAS = 1000
+
+# Um resumo a cada tantas passagens no nível INFO, como nas filas.
+_RESUMO_A_CADA = 200
+
+
+def _percentil(valores, fracao):
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(fracao * len(ordenados)))]
+
+
+class _Faixa:
+    __slots__ = ('nome', 'prioridade', 'esperando', 'passagens', 'itens', 'ocupado',
+                 'espera_total', 'maior_espera', 'esperas')
+
+    def __init__(self, nome, prioridade):
+        self.nome = nome
+        self.prioridade = prioridade
+        self.esperando = 0
+        self.passagens = 0
+        self.itens = 0
+        self.ocupado = 0.0
+        self.espera_total = 0.0
+        self.maior_espera = 0.0
+        self.esperas = deque(maxlen=_AMOSTRAS)
+
+
+class EscalonadorDeInferencia:
+    """Dá a vez no modelo a uma passagem de cada vez, da faixa mais prioritária."""
+
+    def __init__(self, simultaneas=SIMULTANEAS, faixas=FAIXAS):
+        self.simultaneas = simultaneas
+        # A prioridade é a posição ao contrário: a primeira faixa é a maior.
+        self._faixas = {nome: _Faixa(nome, len(faixas) - i) for i, nome in enumerate(faixas)}
+        self._condicao = threading.Condition()
+        self._em_curso = 0
+        self._passagens = 0
+        self._inicio = time.monotonic()
+
+    @contextmanager
+    def vez(self, faixa, itens=0):
+        """Segura uma vez no modelo durante o bloco; `itens` entra na vazão da faixa."""
+        faixa = self._faixas[faixa]
+        chegada = time.monotonic()
+
+        if self.simultaneas > 0:
+            with self._condicao:
+                faixa.esperando += 1
+                try:
+                    while not self._e_a_vez(faixa):
+                        self._condicao.wait()
+                finally:
+                    faixa.esperando -= 1
+                self._em_curso += 1
+
+        comeco = time.monotonic()
+        try:
+            yield
+        finally:
+            fim = time.monotonic()
+            with self._condicao:
+                if self.simultaneas > 0:
+                    self._em_curso -= 1
+                    self._condicao.notify_all()
+                espera = comeco - chegada
+                faixa.passagens += 1
+                faixa.itens += itens
+                faixa.ocupado += fim - comeco
+                faixa.espera_total += espera
+                faixa.maior_espera = max(faixa.maior_espera, espera)
+                faixa.esperas.append(espera)
+                self._passagens += 1
+                resumir = self._passagens % _RESUMO_A_CADA == 0
+
+            if resumir:
+                logger.info('escalonador de inferência: %s', self.estatisticas())
+
+    def estatisticas(self):
+        """Espera pela vez e vazão de cada faixa desde o início do processo."""
+        with self._condicao:
+            decorrido = time.monotonic() - self._inicio
+            faixas = {}
+            for faixa in self._faixas.values():
+                esperas = list(faixa.esperas)
+                faixas[faixa.nome] = {
+                    'passagens': faixa.passagens,
+                    'itens': faixa.itens,
+                    'esperando': faixa.esperando,
+                    'espera_media_ms': (
+                        round(1000 * faixa.espera_total / faixa.passagens, 2)
+                        if faixa.passagens else None
+                    ),
+                    'espera_p99_ms': (
+                        round(1000 * _percentil(esperas, 0.99), 2) if esperas else None
+                    ),
+                    'maior_espera_ms': round(1000 * faixa.maior_espera, 2),
+                    'itens_por_segundo_no_modelo': (
+                        round(faixa.itens / faixa.ocupado, 1) if faixa.ocupado else None
+                    ),
+                    'fracao_do_tempo_no_modelo': (
+                        round(faixa.ocupado / decorrido, 3) if decorrido else None
+                    ),
+                }
+            return {
+                'simultaneas': self.simultaneas,
+                'em_curso': self._em_curso,
+                'faixas': faixas,
+            }
+
+    # ---------------------------------------------------------------- interno
+
+    def _e_a_vez(self, faixa):
+        if self._em_curso >= self.simultaneas:
+            return False
+        return not any(
+            outra.esperando and outra.prioridade > faixa.prioridade
+            for outra in self._faixas.values()
+        )
@@ -0,0 +1,185 @@
+"""Explicações reaproveitadas entre comentários iguais, calculadas uma vez só.
+
+"Gostei." e "A aula foi boa." aparecem em turmas e semestres diferentes, e cada
+cópia pagava LIME e SHAP inteiros. O seeder já reaproveitava as atribuições
+pelo texto exato; aqui o mesmo vale para a produção. Com o sorteio do LIME
+começando da mesma semente em cada comentário (ver services.SEMENTE_LIME), a
+explicação depende só do texto e do modelo, e reaproveitar é exato.
+
+A chave é o hash do texto normalizado junto com a identidade do modelo, a
+mesma do cache de predições. A normalização é a que não muda nada do que o
+modelo e os explicadores veem: a forma Unicode (NFC) e os espaços nas pontas.
+Quem calcula explica o texto já normalizado, para que a explicação guardada
+seja exatamente a da chave. Caixa e pontuação continuam distinguindo textos:
+"gostei" e "Gostei." dão explicações diferentes.
+
+Pedidos simultâneos do mesmo texto viram um cálculo só. Antes de calcular, o
+trabalhador reserva a chave no banco, com prazo, renovado junto com a concessão
+das tarefas. Quem encontrar a chave reservada devolve a tarefa para a fila com
+uma pequena espera, sem gastar tentativa, e na volta encontra a explicação
+pronta. Vale entre threads, processos e instâncias, porque quem decide é o
+banco.
+
+O texto não é guardado, só o hash; as palavras das atribuições, sim. Apagar os
+dados de um aluno apaga as explicações guardadas dos textos dele; outro aluno
+com o mesmo comentário continua com a sua, no próprio feedback.
+
+    EXPLICACOES_REUSO=1             consulta e grava; com 0, cada feedback
+                                    calcula a sua, como antes
+    EXPLICACOES_REUSO_ESPERA_S=5    espera da tarefa cujo texto outro
+                                    trabalhador está calculando
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import unicodedata
+
+from sqlalchemy.exc import IntegrityError
+
+from .models import ExplicacaoDeTexto, db
+
+LIGADO = os.environ.get('EXPLICACOES_REUSO', '1').lower() not in ('0', 'false', 'nao', 'não')
+ESPERA = datetime.timedelta(seconds=float(os.environ.get('EXPLICACOES_REUSO_ESPERA_S', 5)))
+
+
+def normalizar(texto):
+    return unicodedata.normalize('NFC', texto).strip()
+
+
+def chave(texto):
+    return hashlib.sha256(normalizar(texto).encode('utf-8')).hexdigest()
+
+
+def prontas(textos, modelo):
+    """{chave: ExplicacaoDeTexto} dos textos que já têm explicação neste modelo."""
+    chaves = {chave(texto) for texto in textos}
+    if not chaves:
+        return {}
+    return {
+        explicacao.chave: explicacao
+        for explicacao in ExplicacaoDeTexto.query.filter(
+            ExplicacaoDeTexto.chave.in_(chaves),
+            ExplicacaoDeTexto.modelo == modelo,
+            ExplicacaoDeTexto.calculada_em.isnot(None),
+        )
+    }
+
+
+def usar(explicacao):
+    """O resultado guardado, no formato de `services.explicar_em_lote`.
+
+    Conta o uso na mesma transação de quem grava o feedback. Não faz commit.
+    """
+    ExplicacaoDeTexto.query.filter_by(id=explicacao.id).update(
+        {'usos': ExplicacaoDeTexto.usos + 1}, synchronize_session=False,
+    )
+    return {
+        'lime': (json.loads(explicacao.token_attributions_json), None, 0.0),
+        'shap': (json.loads(explicacao.shap_attributions_json), None, 0.0),
+    }
+
+
+def reaproveitar(feedback, modelo):
+    """Preenche o feedback com a explicação guardada do mesmo texto, se houver.
+
+    Devolve se preencheu. Não faz commit.
+    """
+    explicacao = prontas([feedback.additional_comment], modelo).get(
+        chave(feedback.additional_comment))
+    if explicacao is None:
+        return False
+    resultado = usar(explicacao)
+    feedback.token_attributions = resultado['lime'][0]
+    feedback.shap_attributions = resultado['shap'][0]
+    feedback.lime_modo = explicacao.lime_modo
+    return True
+
+
+def reservar(chave_, modelo, dono, prazo):
+    """Reserva o cálculo deste texto para `dono`. Faz commit.
+
+    Devolve False se outro tem a reserva em dia ou a explicação já ficou pronta.
+    """
+    agora = datetime.datetime.utcnow()
+    livre = db.or_(
+        ExplicacaoDeTexto.reservada_ate.is_(None),
+        ExplicacaoDeTexto.reservada_ate < agora,
+        ExplicacaoDeTexto.reservada_por == dono,
+    )
+    try:
+        reservadas = ExplicacaoDeTexto.query.filter(
+            ExplicacaoDeTexto.chave == chave_,
+            ExplicacaoDeTexto.modelo == modelo,
+            ExplicacaoDeTexto.calculada_em.is_(None),
+            livre,
+        ).update({'reservada_ate': agora + prazo, 'reservada_por': dono},
+                 synchronize_session=False)
+        if not reservadas:
+            if ExplicacaoDeTexto.query.filter_by(chave=chave_, modelo=modelo).count():
+                db.session.commit()
+                return False
+            db.session.add(ExplicacaoDeTexto(
+                chave=chave_, modelo=modelo, reservada_ate=agora + prazo, reservada_por=dono,
+            ))
+        db.session.commit()
+        return True
+    except IntegrityError:
+        # Outro criou a linha entre a consulta e o INSERT: a reserva é dele.
+        db.session.rollback()
+        return False
+
+
+def renovar(chaves, modelo, dono, prazo):
+    """Estende as reservas de `dono` nestas chaves. Faz commit."""
+    if chaves:
+        ExplicacaoDeTexto.query.filter(
+            ExplicacaoDeTexto.chave.in_(chaves),
+            ExplicacaoDeTexto.modelo == modelo,
+            ExplicacaoDeTexto.reservada_por == dono,
+            ExplicacaoDeTexto.calculada_em.is_(None),
+        ).update({'reservada_ate': datetime.datetime.utcnow() + prazo},
+                 synchronize_session=False)
+    db.session.commit()
+
+
+def concluir(chave_, modelo, lime, lime_modo, shap):
+    """Guarda a explicação calculada e solta a reserva. Faz commit.
+
+    Grava mesmo que a reserva tenha passado a outro: o resultado seria o mesmo.
+    """
+    ExplicacaoDeTexto.query.filter(
+        ExplicacaoDeTexto.chave == chave_,
+        ExplicacaoDeTexto.modelo == modelo,
+        ExplicacaoDeTexto.calculada_em.is_(None),
+    ).update({
+        'token_attributions_json': json.dumps(lime),
+        'shap_attributions_json': json.dumps(shap),
+        'lime_modo': lime_modo,
+        'calculada_em': datetime.datetime.utcnow(),
+        'reservada_ate': None,
+        'reservada_por': None,
+    }, synchronize_session=False)
+    db.session.commit()
+
+
+def desistir(chaves, modelo, dono):
+    """Solta as reservas de `dono` que não chegaram a um resultado. Faz commit."""
+    if chaves:
+        ExplicacaoDeTexto.query.filter(
+            ExplicacaoDeTexto.chave.in_(chaves),
+            ExplicacaoDeTexto.modelo == modelo,
+            ExplicacaoDeTexto.reservada_por == dono,
+            ExplicacaoDeTexto.calculada_em.is_(None),
+        ).update({'reservada_ate': None, 'reservada_por': None}, synchronize_session=False)
+    db.session.commit()
+
+
+def apagar(textos):
+    """Apaga as explicações guardadas destes textos, em todos os modelos. Não faz commit."""
+    chaves = {chave(texto) for texto in textos if texto}
+    if chaves:
+        ExplicacaoDeTexto.query.filter(
+            ExplicacaoDeTexto.chave.in_(chaves)
+        ).delete(synchronize_session=False)
@@ -0,0 +1,413 @@
+"""Registro de feedbacks e análise de risco dos alunos.
+
+Estava no services.py, que importa torch, transformers, shap e lime e carrega o
+modelo no próprio import. Qualquer rota que só precisasse do índice de risco, e
+o painel do professor precisa, obrigava o processo a carregar tudo isso antes. O
+que aqui depende do modelo, o sentimento do comentário, pede o services.py na
+hora do uso, por prontidao.carregar_modelo.
+"""
+
+import datetime
+import logging
+import time
+from collections import Counter
+
+import numpy as np
+from sqlalchemy import tuple_, update
+from sqlalchemy.dialects.postgresql import insert as insert_postgres
+from sqlalchemy.dialects.sqlite import insert as insert_sqlite
+
+from .models import db, Feedback, StudentRiskAnalysis, Subject, User
+from .prontidao import carregar_modelo
+
+logger = logging.getLogger(__name__)
+
+
+def create_feedback(student_id, subject_id, answers, additional_comment=None):
+    sentiment_scores = None
+    previa = None
+    if additional_comment and additional_comment.strip():
+        modelo = carregar_modelo()
+        sentiment_scores = modelo.analyze_sentiment_text(additional_comment)
+        # Depois do sentimento, para achar o texto inteiro já no cache. Sem a
+        # prévia o envio continua valendo: o destaque chega com o LIME e o SHAP.
+        try:
+            previa = modelo.previa_por_oclusao(additional_comment)
+        except Exception:
+            logger.warning('Prévia do destaque não calculada.', exc_info=True)
+
+    new_feedback = Feedback(
+        student_id=student_id,
+        subject_id=subject_id,
+        active_participation=answers['active_participation'],
+        task_completion=answers['task_completion'],
+        motivation_interest=answers['motivation_interest'],
+        welcoming_environment=answers['welcoming_environment'],
+        comprehension_effort=answers['comprehension_effort'],
+        content_connection=answers['content_connection'],
+        additional_comment=additional_comment
+    )
+    
+    if sentiment_scores:
+        new_feedback.compound = sentiment_scores['compound']
+        new_feedback.neg = sentiment_scores['neg']
+        new_feedback.neu = sentiment_scores['neu']
+        new_feedback.pos = sentiment_scores['pos']
+    new_feedback.previa_attributions = previa
+    
+    new_feedback.overall_score = new_feedback.calculate_overall_score()
+    
+    # O feedback e a análise de risco do par entram no mesmo commit.
+    db.session.add(new_feedback)
+    ajustar_risco(student_id, subject_id, new_feedback.overall_score, new_feedback.compound)
+    db.session.commit()
+    
+    return new_feedback
+
+# As colunas que um feedback soma ao par, e o INSERT com ON CONFLICT de cada
+# banco. Nos dois, o conflito é a restrição única (student_id, subject_id).
+_SOMAS = ('feedback_count', 'score_sum', 'sentiment_sum', 'sentiment_count')
+_INSERT_COM_CONFLITO = {'postgresql': insert_postgres, 'sqlite': insert_sqlite}
+
+
+def _upsert(student_id, subject_id, somas, acumular):
+    """INSERT ... ON CONFLICT DO UPDATE da linha do par, devolvendo as somas gravadas.
+
+    Com `acumular`, as somas da linha existente recebem as dadas; sem, são
+    trocadas por elas. Na linha nova, médias e risco já saem certos; na
+    existente, quem chamou os atualiza a partir das somas devolvidas.
+    """
+    tabela = StudentRiskAnalysis.__table__
+    inicial = StudentRiskAnalysis(**somas)
+    inicial.aplicar_somas()
+    agora = datetime.datetime.utcnow()
+
+    comando = _INSERT_COM_CONFLITO[db.engine.dialect.name](tabela).values(
+        student_id=student_id, subject_id=subject_id, last_updated=agora,
+        average_score=inicial.average_score, average_sentiment=inicial.average_sentiment,
+        risk_score=inicial.risk_score, risk_level=inicial.risk_level, **somas,
+    )
+    comando = comando.on_conflict_do_update(
+        index_elements=['student_id', 'subject_id'],
+        set_={
+            'last_updated': agora,
+            **{coluna: (tabela.c[coluna] + comando.excluded[coluna]) if acumular
+               else comando.excluded[coluna] for coluna in _SOMAS},
+        },
+    ).returning(tabela.c.id, *(tabela.c[coluna] for coluna in _SOMAS))
+    return db.session.execute(comando).one()
+
+
+def _gravar_medias(linha):
+    analise = StudentRiskAnalysis(**{coluna: getattr(linha, coluna) for coluna in _SOMAS})
+    analise.aplicar_somas()
+    db.session.execute(
+        update(StudentRiskAnalysis.__table__)
+        .where(StudentRiskAnalysis.__table__.c.id == linha.id)
+        .values(average_score=analise.average_score, average_sentiment=analise.average_sentiment,
+                risk_score=analise.risk_score, risk_level=analise.risk_level)
+    )
+
+
+def ajustar_risco(student_id, subject_id, overall_score, compound, sinal=1):
+    """Soma (sinal 1) ou tira (sinal -1) um feedback da análise de risco do par.
+
+    Um UPSERT atômico das somas e um UPDATE das médias, na transação de quem
+    grava ou retira o feedback, para que os dois entrem juntos. O custo não
+    depende de quantos feedbacks o aluno já tem. Linha sem somas, anterior a
+    elas, ou contagem que não fecha passam pelo recálculo completo. Não faz
+    commit.
+
+    A primeira linha do par também é recalculada: é uma consulta sobre um
+    feedback só, e garante que a linha nasça com o que está no banco.
+    """
+    student_id, subject_id = int(student_id), int(subject_id)
+    if db.engine.dialect.name not in _INSERT_COM_CONFLITO:
+        return update_student_risk_analysis(student_id, subject_id, commit=False)
+
+    com_sentimento = compound is not None
+    linha = _upsert(student_id, subject_id, {
+        'feedback_count': sinal,
+        'score_sum': sinal * overall_score,
+        'sentiment_sum': sinal * compound if com_sentimento else 0.0,
+        'sentiment_count': sinal if com_sentimento else 0,
+    }, acumular=True)
+
+    if linha.score_sum is None or linha.sentiment_sum is None or linha.feedback_count <= 1:
+        return update_student_risk_analysis(student_id, subject_id, commit=False)
+    _gravar_medias(linha)
+
+
+def update_student_risk_analysis(student_id, subject_id, commit=True):
+    """Recálculo completo do par, a partir dos feedbacks ativos.
+
+    Uma consulta agregada e o mesmo UPSERT, com as somas trocadas em vez de
+    acumuladas. É o caminho das linhas anteriores às somas e de quem quiser
+    conferir os agregados; o envio e a retirada usam `ajustar_risco`.
+    """
+    # Feedback retirado pelo aluno sai da conta. Sem isso, o índice de risco
+    # continuaria refletindo uma resposta que ele pediu para não usar.
+    contagem, soma_das_notas, soma_dos_sentimentos, com_sentimento = (
+        Feedback.ativos()
+        .filter_by(student_id=student_id, subject_id=subject_id)
+        .with_entities(
+            db.func.count(Feedback.id), db.func.sum(Feedback.overall_score),
+            db.func.sum(Feedback.compound), db.func.count(Feedback.compound),
+        )
+        .one()
+    )
+
+    analise = None
+    if not contagem:
+        StudentRiskAnalysis.query.filter_by(
+            student_id=student_id, subject_id=subject_id,
+        ).delete(synchronize_session=False)
+    else:
+        somas = {
+            'feedback_count': contagem,
+            'score_sum': soma_das_notas,
+            'sentiment_sum': soma_dos_sentimentos or 0.0,
+            'sentiment_count': com_sentimento,
+        }
+        if db.engine.dialect.name in _INSERT_COM_CONFLITO:
+            _gravar_medias(_upsert(student_id, subject_id, somas, acumular=False))
+        else:
+            analise = StudentRiskAnalysis.query.filter_by(
+                student_id=student_id, subject_id=subject_id,
+            ).first()
+            if analise is None:
+                analise = StudentRiskAnalysis(student_id=student_id, subject_id=subject_id)
+                db.session.add(analise)
+            for coluna, valor in somas.items():
+                setattr(analise, coluna, valor)
+            analise.aplicar_somas()
+
+    if commit:
+        db.session.commit()
+    if analise is None and contagem:
+        analise = StudentRiskAnalysis.query.filter_by(
+            student_id=student_id, subject_id=subject_id,
+        ).populate_existing().first()
+    return analise
+
+# Linhas por DELETE na remoção dos pares sem feedback ativo, abaixo do limite
+# de parâmetros por comando do SQLite.
+_REMOCAO_POR_VEZ = 1000
+
+
+def recalcular_riscos(conferir=False):
+    """Recálculo completo da análise de risco de todos os pares. Faz commit.
+
+    Pelo `update_student_risk_analysis`, par a par, eram algumas consultas e um
+    commit para cada aluno em cada disciplina. Aqui é uma consulta agregada com
+    GROUP BY para todos, o risco de todos de uma vez em arrays do NumPy
+    (`StudentRiskAnalysis.riscos_em_lote`) e um UPSERT em lote, na mesma
+    transação em que saem as linhas dos pares sem feedback ativo. É o que roda
+    depois de mudar os pesos ou os limiares do risco, e no fim do seeder.
+
+    Com `conferir`, depois do UPSERT e antes do commit, cada par, inclusive
+    os que perderam a linha, passa também pelo `update_student_risk_analysis`,
+    que relê os feedbacks do par. Os que divergirem do vetorizado são
+    devolvidos e, havendo algum, nada é gravado: a transação volta inteira.
+    scripts/conferir_recalculo_do_risco.py faz a mesma comparação num banco de
+    teste, sem tocar no de verdade.
+
+    Devolve um resumo: pares, linhas removidas, {(nível antes, nível depois):
+    quantos}, com None para linha que não existia ou deixou de existir, as
+    divergências, se gravou e os segundos.
+    """
+    inicio = time.perf_counter()
+    agregados = (
+        Feedback.ativos()
+        .with_entities(
+            Feedback.student_id, Feedback.subject_id,
+            db.func.count(Feedback.id), db.func.sum(Feedback.overall_score),
+            db.func.sum(Feedback.compound), db.func.count(Feedback.compound),
+        )
+        .group_by(Feedback.student_id, Feedback.subject_id)
+        .all()
+    )
+    anteriores = {
+        (aluno, disciplina): (id_, nivel)
+        for id_, aluno, disciplina, nivel in db.session.query(
+            StudentRiskAnalysis.id, StudentRiskAnalysis.student_id,
+            StudentRiskAnalysis.subject_id, StudentRiskAnalysis.risk_level,
+        )
+    }
+
+    pares = [(aluno, disciplina) for aluno, disciplina, *_ in agregados]
+    contagens = np.array([linha[2] for linha in agregados], dtype=np.int64)
+    somas_das_notas = np.array([linha[3] for linha in agregados], dtype=float)
+    somas_dos_sentimentos = np.array([linha[4] or 0.0 for linha in agregados], dtype=float)
+    com_sentimento = np.array([linha[5] for linha in agregados], dtype=np.int64)
+
+    medias_das_notas = somas_das_notas / contagens
+    medias_dos_sentimentos = np.full(len(pares), np.nan)
+    np.divide(somas_dos_sentimentos, com_sentimento, out=medias_dos_sentimentos,
+              where=com_sentimento > 0)
+    riscos, niveis = StudentRiskAnalysis.riscos_em_lote(
+        medias_das_notas, medias_dos_sentimentos, contagens,
+    )
+
+    agora = datetime.datetime.utcnow()
+    linhas = [
+        {
+            'student_id': aluno, 'subject_id': disciplina, 'last_updated': agora,
+            'feedback_count': int(contagens[i]),
+            'score_sum': float(somas_das_notas[i]),
+            'sentiment_sum': float(somas_dos_sentimentos[i]),
+            'sentiment_count': int(com_sentimento[i]),
+            'average_score': float(medias_das_notas[i]),
+            'average_sentiment': (
+                float(medias_dos_sentimentos[i]) if com_sentimento[i] else None
+            ),
+            'risk_score': float(riscos[i]),
+            'risk_level': str(niveis[i]),
+        }
+        for i, (aluno, disciplina) in enumerate(pares)
+    ]
+
+    mudancas = Counter()
+    for linha in linhas:
+        antes = anteriores.pop((linha['student_id'], linha['subject_id']), (None, None))[1]
+        if antes != linha['risk_level']:
+            mudancas[(antes, linha['risk_level'])] += 1
+    # O que sobrou em `anteriores` é par sem feedback ativo: a linha sai.
+    for _, nivel in anteriores.values():
+        mudancas[(nivel, None)] += 1
+
+    try:
+        orfas = [id_ for id_, _ in anteriores.values()]
+        for comeco in range(0, len(orfas), _REMOCAO_POR_VEZ):
+            StudentRiskAnalysis.query.filter(
+                StudentRiskAnalysis.id.in_(orfas[comeco:comeco + _REMOCAO_POR_VEZ]),
+            ).delete(synchronize_session=False)
+
+        if linhas and db.engine.dialect.name in _INSERT_COM_CONFLITO:
+            tabela = StudentRiskAnalysis.__table__
+            comando = _INSERT_COM_CONFLITO[db.engine.dialect.name](tabela)
+            comando = comando.on_conflict_do_update(
+                index_elements=['student_id', 'subject_id'],
+                set_={coluna: comando.excluded[coluna] for coluna in linhas[0]
+                      if coluna not in ('student_id', 'subject_id')},
+            )
+            db.session.execute(comando, linhas)
+        else:
+            for aluno, disciplina in pares:
+                update_student_risk_analysis(aluno, disciplina, commit=False)
+
+        divergencias = _conferir_recalculo(linhas, anteriores) if conferir else []
+        if divergencias:
+            db.session.rollback()
+        else:
+            db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return {
+        'pares': len(linhas),
+        'removidas': len(anteriores),
+        'mudancas': dict(mudancas),
+        'divergencias': divergencias,
+        'gravado': not divergencias,
+        'segundos': time.perf_counter() - inicio,
+    }
+
+
+def _conferir_recalculo(linhas, orfas):
+    """Refaz cada par pelo `update_student_risk_analysis`, na mesma transação.
+
+    Ele relê os feedbacks ativos do par e grava por cima do que o lote gravou;
+    sem divergência, o que fica é o mesmo. Os pares de `orfas` perderam a
+    linha no lote e têm de perdê-la também aqui. Devolve as divergências.
+    """
+    colunas = ('feedback_count', 'average_score', 'average_sentiment', 'risk_score', 'risk_level')
+    divergencias = []
+    for linha in linhas:
+        analise = update_student_risk_analysis(linha['student_id'], linha['subject_id'],
+                                               commit=False)
+        linha_a_linha = (
+            tuple(getattr(analise, coluna) for coluna in colunas) if analise is not None else None
+        )
+        em_lote = tuple(linha[coluna] for coluna in colunas)
+        if linha_a_linha != em_lote:
+            divergencias.append({
+                'student_id': linha['student_id'], 'subject_id': linha['subject_id'],
+                'linha_a_linha': linha_a_linha, 'em_lote': em_lote,
+            })
+    for aluno, disciplina in orfas:
+        analise = update_student_risk_analysis(aluno, disciplina, commit=False)
+        if analise is not None:
+            divergencias.append({
+                'student_id': aluno, 'subject_id': disciplina,
+                'linha_a_linha': tuple(getattr(analise, coluna) for coluna in colunas),
+                'em_lote': None,
+            })
+    return divergencias
+
+_NIVEIS_A_PARTIR_DE = {
+    'baixo': ['baixo', 'medio', 'alto'],
+    'medio': ['medio', 'alto'],
+    'alto': ['alto']
+}
+
+
+def get_students_at_risk(subject_ids=None, min_risk_level='medio', limit=None, depois_de=None):
+    """Análises de risco das disciplinas dadas, da maior para a menor, já em dicionário.
+
+    Uma consulta só, qualquer que seja o número de disciplinas e de alunos: o
+    filtro por `subject_id IN`, e o nome do aluno e o da disciplina por JOIN,
+    só as colunas que a resposta usa. Era uma consulta por disciplina, e mais
+    duas por linha no to_dict, para carregar `student` e `subject`. `subject_ids`
+    None é todas as disciplinas. scripts/conferir_consultas_do_risco.py confere
+    a contagem em volumes crescentes.
+
+    Paginação por chave, não por OFFSET: `depois_de` é o (risk_score, id) da
+    última linha da página anterior, e a ordem tem o id para desempatar. Uma
+    linha que entre ou saia entre uma página e outra não faz outra se repetir
+    ou sumir, e a página 50 custa o mesmo que a primeira.
+
+    Devolve (linhas, chave da próxima página, ou None na última).
+    """
+    consulta = (
+        db.session.query(
+            StudentRiskAnalysis.id, StudentRiskAnalysis.student_id,
+            StudentRiskAnalysis.subject_id, StudentRiskAnalysis.average_score,
+            StudentRiskAnalysis.average_sentiment, StudentRiskAnalysis.feedback_count,
+            StudentRiskAnalysis.risk_score, StudentRiskAnalysis.risk_level,
+            StudentRiskAnalysis.last_updated,
+            User.username, User.first_name, User.last_name, Subject.name,
+        )
+        .join(User, User.id == StudentRiskAnalysis.student_id)
+        .join(Subject, Subject.id == StudentRiskAnalysis.subject_id)
+        .filter(StudentRiskAnalysis.risk_level.in_(
+            _NIVEIS_A_PARTIR_DE.get(min_risk_level, ['alto'])
+        ))
+    )
+    if subject_ids is not None:
+        consulta = consulta.filter(StudentRiskAnalysis.subject_id.in_(subject_ids))
+    if depois_de is not None:
+        consulta = consulta.filter(
+            tuple_(StudentRiskAnalysis.risk_score, StudentRiskAnalysis.id) < tuple_(*depois_de)
+        )
+    consulta = consulta.order_by(StudentRiskAnalysis.risk_score.desc(),
+                                 StudentRiskAnalysis.id.desc())
+    # Uma a mais que o limite diz se há próxima página, sem contar.
+    if limit is not None:
+        consulta = consulta.limit(limit + 1)
+    resultado = consulta.all()
+
+    proxima = None
+    if limit is not None and len(resultado) > limit:
+        resultado = resultado[:limit]
+        proxima = (resultado[-1].risk_score, resultado[-1].id)
+
+    linhas = [
+        StudentRiskAnalysis.dict_da_linha(
+            linha, User.nome_de_exibicao(linha.username, linha.first_name, linha.last_name),
+            linha.name,
+        )
+        for linha in resultado
+    ]
+    return linhas, proxima
@@ -0,0 +1,332 @@
+"""Agrupamento de pedidos de inferência vindos de requisições diferentes.
+
+Cada `POST /analyze` pedia ao modelo um lote de um texto só. No dia 3, trinta
+alunos enviam no mesmo minuto contra as quatro threads do gunicorn, e quatro
+passagens de um texto custam quase quatro vezes uma passagem de quatro textos:
+o custo fixo de cada chamada ao modelo domina quando o lote é minúsculo.
+
+A fila segura cada pedido por alguns milissegundos, junta os que chegarem nesse
+intervalo e faz uma única chamada para todos. Cada chamador recebe de volta só
+as linhas dele, na ordem em que pediu. Quem chega sozinho paga no máximo a
+espera configurada, que é pequena perto do tempo de uma passagem pelo modelo.
+
+Um pedido grande é repartido: o que não cabe no lote atual segue no próximo,
+ao lado do que tiver chegado nesse meio tempo. É o que deixa o LIME e o SHAP de
+uma mesma explicação, rodando em paralelo, dividirem lotes cheios em vez de se
+revezarem no modelo, o primeiro com milhares de máscaras e o segundo com
+chamadas de poucas dezenas.
+
+Um pedido pode trazer um Event de cancelamento. Sinalizado, o que ainda não
+foi enviado ao modelo sai da fila no próximo lote, e quem pediu recebe
+PedidoCancelado: uma explicação interrompida deixa de ocupar o modelo em no
+máximo um lote.
+
+Quem executa é uma thread dedicada, criada no primeiro pedido e recriada se o
+processo tiver sido bifurcado: thread não atravessa fork, e um worker do
+gunicorn que herdasse a fila do processo pai esperaria para sempre.
+
+Nenhum chamador espera para sempre. Uma falha da thread, dentro ou fora da
+chamada ao modelo, devolve o erro a todos os pedidos pendentes, e não só aos do
+lote. Quem espera também desiste, com FilaParada, se a thread morreu ou se a
+fila passou FILA_TEMPO_LIMITE_S segundos (padrão 120) sem entregar lote algum:
+o prazo conta desde o último lote ou a chegada do pedido, e não desde o início
+da espera, para que as milhares de máscaras de um LIME não estourem só por
+serem muitas.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Um resumo a cada tantos lotes no nível INFO. Lote a lote fica no DEBUG, que em
+# produção é silencioso.
+_RESUMO_A_CADA = 50
+
+# De quanto em quanto tempo, em segundos, um pedido cancelável confere o sinal
+# enquanto espera.
+_CONFERIR_CANCELAMENTO = 0.5
+
+TEMPO_LIMITE = float(os.environ.get('FILA_TEMPO_LIMITE_S', 120))
+
+
+class PedidoCancelado(Exception):
+    """O pedido foi cancelado por quem o fez antes de sair todo do modelo."""
+
+
+class FilaParada(RuntimeError):
+    """A thread da fila morreu ou deixou de entregar lotes enquanto o pedido esperava."""
+
+
+class _Pedido:
+    __slots__ = ('itens', 'enviados', 'partes', 'faltam', 'chegada', 'espera',
+                 'resultado', 'erro', 'pronto', 'cancelamento')
+
+    def __init__(self, itens, cancelamento=None):
+        self.itens = itens
+        self.cancelamento = cancelamento
+        self.enviados = 0
+        self.partes = []
+        self.faltam = len(itens)
+        self.chegada = time.monotonic()
+        self.espera = None
+        self.resultado = None
+        self.erro = None
+        self.pronto = threading.Event()
+
+    @property
+    def restantes(self):
+        return len(self.itens) - self.enviados
+
+    @property
+    def cancelado(self):
+        return self.cancelamento is not None and self.cancelamento.is_set()
+
+
+class FilaDeInferencia:
+    """Junta pedidos concorrentes em uma chamada só a `executar`.
+
+    `executar` recebe a lista concatenada dos itens e devolve um array com uma
+    linha por item, nunca mais de `lote_maximo` de cada vez. Um pedido maior
+    que o lote é repartido em chamadas sucessivas, e quem pediu recebe as
+    linhas reunidas, na ordem original.
+    """
+
+    def __init__(self, executar, lote_maximo, espera, nome='inferencia',
+                 tempo_limite=TEMPO_LIMITE):
+        self._executar = executar
+        self.lote_maximo = max(1, lote_maximo)
+        self.espera = max(0.0, espera)
+        self.nome = nome
+        self.tempo_limite = tempo_limite
+
+        self._pendentes = deque()
+        self._condicao = threading.Condition()
+        self._trabalhador = None
+        self._pid = None
+        self._ultimo_lote = time.monotonic()
+
+        self._lotes = 0
+        self._pedidos = 0
+        self._itens = 0
+        self._maior_lote = 0
+        self._espera_total = 0.0
+        self._maior_espera = 0.0
+
+    def prever(self, itens, cancelamento=None):
+        """Uma linha por item. Com `cancelamento` sinalizado, levanta PedidoCancelado
+        em vez de mandar ao modelo o que faltar."""
+        pedido = _Pedido(list(itens), cancelamento)
+        if pedido.cancelado:
+            raise PedidoCancelado()
+        if not pedido.itens:
+            return self._executar([])
+
+        with self._condicao:
+            self._garantir_trabalhador()
+            self._pendentes.append(pedido)
+            self._condicao.notify_all()
+
+        # Quem espera confere de tempos em tempos: a fila pode estar parada
+        # esperando a vez no modelo, e o pedido cancelado não deve ficar preso
+        # atrás disso; nem nenhum pedido atrás de uma thread que já morreu.
+        while not pedido.pronto.wait(_CONFERIR_CANCELAMENTO):
+            with self._condicao:
+                if pedido.cancelado:
+                    self._descartar_cancelados()
+                elif self._parada(pedido):
+                    self._abandonar(pedido)
+        if pedido.erro is not None:
+            raise pedido.erro
+        return pedido.resultado
+
+    def estatisticas(self):
+        with self._condicao:
+            return {
+                'fila': self.nome,
+                'lotes': self._lotes,
+                'pedidos': self._pedidos,
+                'pedidos_por_lote': round(self._pedidos / self._lotes, 2) if self._lotes else None,
+                'itens_por_lote': round(self._itens / self._lotes, 2) if self._lotes else None,
+                'maior_lote': self._maior_lote,
+                'espera_media_ms': (
+                    round(1000 * self._espera_total / self._pedidos, 2) if self._pedidos else None
+                ),
+                'maior_espera_ms': round(1000 * self._maior_espera, 2),
+                'pendentes': len(self._pendentes),
+            }
+
+    # ---------------------------------------------------------------- interno
+
+    def _garantir_trabalhador(self):
+        if self._pid == os.getpid() and self._trabalhador.is_alive():
+            return
+        self._pid = os.getpid()
+        self._trabalhador = threading.Thread(
+            target=self._laco, name=f'fila-{self.nome}', daemon=True,
+        )
+        self._trabalhador.start()
+
+    def _parada(self, pedido):
+        """A thread morreu, ou nenhum lote saiu no prazo. Chamar com `_condicao`."""
+        if not self._trabalhador.is_alive():
+            return True
+        desde = max(pedido.chegada, self._ultimo_lote)
+        return time.monotonic() - desde > self.tempo_limite
+
+    def _abandonar(self, pedido):
+        """Tira o pedido da fila e o encerra com FilaParada. Chamar com `_condicao`."""
+        if pedido in self._pendentes:
+            self._pendentes.remove(pedido)
+        logger.error('fila %s: sem lote há mais de %.0f s ou sem thread; pedido abandonado.',
+                     self.nome, self.tempo_limite)
+        pedido.erro = FilaParada(f'fila {self.nome} parada')
+        pedido.pronto.set()
+
+    def _pendentes_em_itens(self):
+        return sum(p.restantes for p in self._pendentes)
+
+    def _coletar(self):
+        """Espera o primeiro pedido e, depois dele, até encher o lote ou acabar o prazo."""
+        with self._condicao:
+            while True:
+                self._descartar_cancelados()
+                if self._pendentes:
+                    break
+                self._condicao.wait()
+
+            prazo = self._pendentes[0].chegada + self.espera
+            while self._pendentes_em_itens() < self.lote_maximo:
+                restante = prazo - time.monotonic()
+                if restante <= 0:
+                    break
+                self._condicao.wait(restante)
+
+            self._descartar_cancelados()
+            if not self._pendentes:
+                return []
+
+            # Fatias (pedido, início, fim) até encher o lote. Um pedido que não
+            # coube inteiro volta para o fim da fila: quem chegar enquanto isso
+            # entra no próximo lote, em vez de esperar as milhares de máscaras
+            # do LIME passarem todas.
+            lote = []
+            quantos = 0
+            adiado = None
+            while self._pendentes and quantos < self.lote_maximo:
+                pedido = self._pendentes.popleft()
+                inicio = pedido.enviados
+                fim = inicio + min(pedido.restantes, self.lote_maximo - quantos)
+                lote.append((pedido, inicio, fim))
+                pedido.enviados = fim
+                quantos += fim - inicio
+                if pedido.restantes:
+                    adiado = pedido
+            if adiado is not None:
+                self._pendentes.append(adiado)
+
+            agora = time.monotonic()
+            for pedido, inicio, _ in lote:
+                if inicio == 0:
+                    pedido.espera = agora - pedido.chegada
+
+            return lote
+
+    def _descartar_cancelados(self):
+        """Tira da fila os pedidos cancelados e devolve o erro a quem os fez."""
+        for pedido in [p for p in self._pendentes if p.cancelado]:
+            self._pendentes.remove(pedido)
+            pedido.erro = PedidoCancelado()
+            pedido.pronto.set()
+
+    def _laco(self):
+        while True:
+            lote = []
+            try:
+                lote = self._coletar()
+                if lote:
+                    self._servir(lote)
+            except BaseException as erro:
+                # Fora da chamada ao modelo não há como saber o que ficou pela
+                # metade: ninguém pendente recebe mais resposta desta volta.
+                logger.exception('fila %s: falha na thread; pendentes encerrados.', self.nome)
+                self._falhar_todos(lote, erro)
+                if not isinstance(erro, Exception):
+                    raise
+
+    def _servir(self, lote):
+        itens = [item for pedido, inicio, fim in lote for item in pedido.itens[inicio:fim]]
+
+        try:
+            saida = np.asarray(self._executar(itens))
+            if len(saida) != len(itens):
+                raise RuntimeError(f'{len(saida)} linhas para {len(itens)} itens')
+        except Exception as erro:
+            self._falhar(lote, erro)
+            return
+        finally:
+            with self._condicao:
+                self._ultimo_lote = time.monotonic()
+
+        posicao = 0
+        for pedido, inicio, fim in lote:
+            pedido.partes.append(saida[posicao:posicao + fim - inicio])
+            posicao += fim - inicio
+            pedido.faltam -= fim - inicio
+            if not pedido.faltam and pedido.erro is None:
+                pedido.resultado = (
+                    pedido.partes[0] if len(pedido.partes) == 1 else np.concatenate(pedido.partes)
+                )
+                pedido.pronto.set()
+
+        self._registrar(lote, len(itens))
+
+    def _falhar(self, lote, erro):
+        """Devolve o erro a quem estava no lote, e tira da fila o que sobrou deles."""
+        with self._condicao:
+            for pedido, _, _ in lote:
+                if pedido in self._pendentes:
+                    self._pendentes.remove(pedido)
+        for pedido, _, _ in lote:
+            pedido.erro = erro
+            pedido.pronto.set()
+
+    def _falhar_todos(self, lote, erro):
+        """Devolve o erro a quem estava no lote e a todos os pendentes."""
+        with self._condicao:
+            pedidos = [pedido for pedido, _, _ in lote]
+            pedidos += [p for p in self._pendentes if p not in pedidos]
+            self._pendentes.clear()
+        for pedido in pedidos:
+            if not pedido.pronto.is_set():
+                pedido.erro = erro
+                pedido.pronto.set()
+
+    def _registrar(self, lote, itens):
+        # A espera de um pedido conta uma vez, no lote em que a primeira fatia
+        # dele saiu.
+        estreantes = [pedido for pedido, inicio, _ in lote if inicio == 0]
+        maior_espera = max((p.espera for p in estreantes), default=0.0)
+
+        with self._condicao:
+            self._lotes += 1
+            self._pedidos += len(estreantes)
+            self._itens += itens
+            # Em itens, como o lote máximo ao lado dele no /admin/inferencia.
+            self._maior_lote = max(self._maior_lote, itens)
+            for pedido in estreantes:
+                self._espera_total += pedido.espera
+            self._maior_espera = max(self._maior_espera, maior_espera)
+            resumir = self._lotes % _RESUMO_A_CADA == 0
+
+        logger.debug(
+            'fila %s: lote de %s pedido(s), %s item(ns), maior espera %.1f ms',
+            self.nome, len(lote), itens, 1000 * maior_espera,
+        )
+        if resumir:
+            logger.info('fila %s: %s', self.nome, self.estatisticas())
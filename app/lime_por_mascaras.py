@@ -0,0 +1,213 @@
+"""O LIME de texto reescrito sobre as máscaras de palavras, e não sobre strings.
+
+O `LimeTextExplainer.explain_instance` monta 5.000 strings perturbadas, e o
+`_predict_proba` depois faz hash de cada uma, descarta as repetidas, tokeniza e
+aplica padding do zero. Tudo isso dentro do laço das amostras, e na maior parte
+para nada: num comentário de dez palavras, 81% das amostras repetem uma máscara
+já sorteada.
+
+Aqui o sorteio é o mesmo, feito com o mesmo gerador e na mesma ordem que a
+biblioteca usa, mas o que se guarda é a matriz binária de palavras presentes.
+As máscaras repetidas são descartadas antes de existir qualquer string. O
+comentário original é tokenizado uma única vez, palavra por palavra, e a
+entrada do modelo de cada máscara distinta é montada juntando os tokens das
+palavras que ficaram. A regressão local no fim é a do próprio LIME, chamada com
+os mesmos dados, rótulos e distâncias que o `explain_instance` teria produzido.
+Com um gerador no mesmo estado, os pesos são os que o `explain_instance` daria.
+
+Montar pelos tokens só é exato quando o tokenizador trata cada palavra de forma
+independente das vizinhas. Isso é conferido para cada comentário, comparando a
+montagem com a tokenização de verdade do texto inteiro, de cada remoção de uma
+palavra e da remoção de todas. Se qualquer uma diferir, o comentário segue pelo
+caminho das strings, que continua sem repetição, mas volta a tokenizar cada
+texto distinto. O resultado é o mesmo pelos dois caminhos; muda só o custo.
+
+Comentário curto dispensa o sorteio. Com poucas palavras, as 2^n máscaras
+possíveis cabem no orçamento de amostras, e `enumerar` devolve todas, cada uma
+uma vez, com a frequência esperada que teria no sorteio. A regressão ponderada
+por essas frequências é a que as 5.000 amostras estimam, sem o ruído delas.
+"""
+
+from math import comb
+
+import numpy as np
+import scipy.sparse
+import sklearn.metrics
+from lime.lime_base import LimeBase
+from lime.lime_text import IndexedString
+
+
+def indexar(explicador, texto):
+    """O texto dividido em palavras exatamente como o explicador dividiria."""
+    return IndexedString(
+        texto,
+        bow=explicador.bow,
+        split_expression=explicador.split_expression,
+        mask_string=explicador.mask_string,
+    )
+
+
+def sortear(explicador, indexado, num_samples, gerador=None):
+    """Matriz de máscaras, uma linha por amostra, 1 para palavra presente.
+
+    Reproduz o sorteio de `LimeTextExplainer.__data_labels_distances` chamada a
+    chamada: primeiro quantas palavras remover em cada amostra, depois quais.
+    A primeira linha é o texto original. Sem `gerador`, consome o do explicador
+    na mesma ordem que a biblioteca; com um gerador novo de mesma semente, as
+    máscaras são as do primeiro comentário que um explicador recém-criado
+    explicaria.
+    """
+    palavras = indexado.num_words()
+    gerador = explicador.random_state if gerador is None else gerador
+
+    tamanhos = gerador.randint(1, palavras + 1, num_samples - 1)
+    dados = np.ones((num_samples, palavras))
+    posicoes = range(palavras)
+    for linha, tamanho in enumerate(tamanhos, start=1):
+        inativas = gerador.choice(posicoes, tamanho, replace=False)
+        dados[linha, inativas] = 0
+    return dados
+
+
+def enumerar(palavras, num_samples):
+    """Todas as máscaras possíveis e a frequência esperada de cada uma no sorteio.
+
+    O sorteio de `sortear` escolhe quantas palavras remover, uniforme entre 1 e
+    n, e depois quais, uniforme entre as combinações daquele tamanho. Cada
+    máscara com k palavras removidas sai então com probabilidade
+    1 / (n * C(n, k)) em cada uma das num_samples - 1 amostras sorteadas. A
+    primeira linha é o texto original, que o LIME sempre inclui uma vez. As
+    frequências somam num_samples, a mesma massa das amostras sorteadas.
+
+    Não consome o gerador do explicador.
+    """
+    codigos = np.arange(2 ** palavras - 1, -1, -1)
+    dados = ((codigos[:, None] >> np.arange(palavras)) & 1).astype(float)
+
+    removidas = palavras - dados.sum(axis=1).astype(int)
+    frequencias = np.array([
+        (num_samples - 1) / (palavras * comb(palavras, k)) if k else 1.0
+        for k in removidas
+    ])
+    return dados, frequencias
+
+
+def mascaras_distintas_esperadas(palavras, num_samples):
+    """Quantas máscaras distintas o sorteio de `sortear` produz, em média.
+
+    Cada uma das C(n, k) máscaras com k palavras removidas aparece pelo menos
+    uma vez nas num_samples - 1 amostras com probabilidade
+    1 - (1 - 1 / (n * C(n, k)))^(num_samples - 1); o texto original soma uma.
+    É o número de passagens pelo modelo que sortear custa, já que as
+    repetidas não vão ao modelo.
+    """
+    return 1 + sum(
+        comb(palavras, k) * (1 - (1 - 1 / (palavras * comb(palavras, k))) ** (num_samples - 1))
+        for k in range(1, palavras + 1)
+    )
+
+
+def distancias(dados):
+    """Distância de cada amostra ao original, na escala que o LIME usa."""
+    esparsa = scipy.sparse.csr_matrix(dados)
+    return sklearn.metrics.pairwise.pairwise_distances(
+        esparsa, esparsa[0], metric='cosine',
+    ).ravel() * 100
+
+
+def distintas(dados):
+    """Máscaras sem repetição e, para cada amostra, o índice da sua máscara."""
+    unicas, inverso = np.unique(dados.astype(bool), axis=0, return_inverse=True)
+    return unicas, inverso.ravel()
+
+
+def texto_da_mascara(indexado, mascara):
+    return indexado.inverse_removing(np.flatnonzero(~mascara))
+
+
+class Alinhamento:
+    """Tokens de cada pedaço do comentário, para montar a entrada de qualquer máscara.
+
+    `pedacos` são os trechos em que o LIME divide o texto, palavras e
+    separadores intercalados. Um separador fica sempre; uma palavra fica se a
+    máscara a mantiver.
+    """
+
+    def __init__(self, tokenizador, indexado, comprimento_maximo):
+        self.tokenizador = tokenizador
+        self.comprimento_maximo = comprimento_maximo
+        self.especiais = tokenizador.num_special_tokens_to_add(pair=False)
+        self.com_tipos = 'token_type_ids' in tokenizador.model_input_names
+
+        palavra_do_pedaco = np.full(len(indexado.as_list), -1)
+        for palavra, posicoes in enumerate(indexado.positions):
+            palavra_do_pedaco[posicoes] = palavra
+        self.palavra_do_pedaco = palavra_do_pedaco
+
+        self.tokens_do_pedaco = [
+            tokenizador(pedaco, add_special_tokens=False)['input_ids']
+            for pedaco in indexado.as_list
+        ]
+
+    def ids(self, mascara):
+        """Entrada do modelo, já com tokens especiais e truncada como o tokenizador truncaria."""
+        conteudo = []
+        for pedaco, palavra in enumerate(self.palavra_do_pedaco):
+            if palavra < 0 or mascara[palavra]:
+                conteudo.extend(self.tokens_do_pedaco[pedaco])
+        conteudo = conteudo[:self.comprimento_maximo - self.especiais]
+        return self.tokenizador.build_inputs_with_special_tokens(conteudo)
+
+    def codificacao(self, mascara):
+        ids = self.ids(mascara)
+        codificacao = {'input_ids': ids, 'attention_mask': [1] * len(ids)}
+        if self.com_tipos:
+            codificacao['token_type_ids'] = [0] * len(ids)
+        return codificacao
+
+    def confere(self, indexado):
+        """Se a montagem coincide com a tokenização de verdade nos casos de controle."""
+        palavras = indexado.num_words()
+        mascaras = [np.ones(palavras, dtype=bool), np.zeros(palavras, dtype=bool)]
+        for palavra in range(palavras):
+            mascara = np.ones(palavras, dtype=bool)
+            mascara[palavra] = False
+            mascaras.append(mascara)
+
+        for mascara in mascaras:
+            real = self.tokenizador(
+                texto_da_mascara(indexado, mascara),
+                truncation=True,
+                max_length=self.comprimento_maximo,
+            )['input_ids']
+            if list(real) != self.ids(mascara):
+                return False
+        return True
+
+
+def alinhar(tokenizador, indexado, comprimento_maximo):
+    """O alinhamento palavra-tokens do comentário, ou None se ele não for exato."""
+    alinhamento = Alinhamento(tokenizador, indexado, comprimento_maximo)
+    return alinhamento if alinhamento.confere(indexado) else None
+
+
+def ajustar(explicador, indexado, dados, rotulos, rotulo, num_features, frequencias=None):
+    """A regressão local do LIME, com os mesmos argumentos do explain_instance.
+
+    Com `frequencias`, cada linha pesa o kernel vezes a sua frequência, como se
+    aparecesse aquele número de vezes entre as amostras. A regressão continua
+    sendo a do LIME: a base recebe os pesos prontos no lugar das distâncias.
+
+    Devolve a lista (palavra, peso) que `Explanation.as_list` devolveria.
+    """
+    base, entrada = explicador.base, distancias(dados)
+    if frequencias is not None:
+        entrada = base.kernel_fn(entrada) * frequencias
+        base = LimeBase(lambda pesos: pesos, random_state=base.random_state)
+
+    _, pesos, _, _ = base.explain_instance_with_data(
+        dados, rotulos, entrada, rotulo, num_features,
+        model_regressor=None,
+        feature_selection=explicador.feature_selection,
+    )
+    return [(indexado.word(palavra), peso) for palavra, peso in pesos]
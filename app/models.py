@@ -2,6 +2,8 @@ from flask_sqlalchemy import SQLAlchemy
 import datetime
 import json
 
+import numpy as np
+
 db = SQLAlchemy()
 
 user_subjects = db.Table('user_subjects',
@@ -47,9 +49,14 @@ class User(db.Model):
 
     @property
     def display_name(self):
-        if self.first_name:
-            return f"{self.first_name} {self.last_name}".strip()
-        return self.username
+        return self.nome_de_exibicao(self.username, self.first_name, self.last_name)
+
+    @staticmethod
+    def nome_de_exibicao(username, first_name, last_name):
+        """O display_name a partir das colunas, para consultas que não carregam o User."""
+        if first_name:
+            return f"{first_name} {last_name}".strip()
+        return username
     
     subjects = db.relationship('Subject', secondary=user_subjects, lazy='subquery',
         backref=db.backref('professors', lazy=True))
@@ -107,11 +114,30 @@ class Feedback(db.Model):
     token_attributions_json = db.Column(db.Text, nullable=True)
     shap_attributions_json  = db.Column(db.Text, nullable=True)
 
-    # Instante em que o cálculo da explicação começou. Serve para reconhecer um
-    # cálculo em curso: sem isso, um segundo pedido para o mesmo feedback vê que
-    # nada foi gravado ainda, conclui que falta calcular e refaz o trabalho
-    # inteiro. Foi o que aconteceu no teste de 19 de agosto, com o mesmo
-    # comentário processado duas vezes em paralelo.
+    # Como o LIME chegou aos pesos deste comentário: 'amostragem', pelas 5.000
+    # perturbações sorteadas, ou 'enumeracao', por todas as máscaras possíveis
+    # de um comentário curto. As duas estimam a mesma coisa, mas só a segunda é
+    # exata, e quem comparar explicações entre feedbacks precisa saber qual é
+    # qual. Nulo nas explicações anteriores a essa distinção, todas sorteadas.
+    lime_modo = db.Column(db.String(20), nullable=True)
+
+    # Prévia do destaque, calculada no envio pela oclusão de uma palavra por
+    # vez (ver services.previa_por_oclusao). Vale até o LIME e o SHAP chegarem;
+    # fica gravada depois deles, para comparar a prévia com o resultado.
+    previa_attributions_json = db.Column(db.Text, nullable=True)
+
+    # A etapa mais recente do LIME em curso: {'amostras', 'pesos',
+    # 'estabilidade'}, esta a concordância das dez palavras de maior peso com a
+    # etapa anterior (ver services.LIME_ETAPAS). Substitui a prévia enquanto o
+    # cálculo anda, e é apagada quando a explicação completa é gravada.
+    lime_parcial_json = db.Column(db.Text, nullable=True)
+
+    # Instante em que um trabalhador pegou a explicação para calcular. Era a
+    # reserva do cálculo, feita pela própria rota; desde que a explicação passou
+    # a ser uma tarefa na fila (ver TarefaDeExplicacao), quem reserva é a
+    # concessão da tarefa, e esta coluna ficou só como informação para a tela.
+    # Foi a reserva por ela que evitou o comentário processado duas vezes em
+    # paralelo no teste de 19 de agosto.
     explicacao_iniciada_em = db.Column(db.DateTime, nullable=True)
 
     # Quando o aluno retirou este feedback. Preenchido, a linha deixa de existir
@@ -156,6 +182,26 @@ class Feedback(db.Model):
     def shap_attributions(self, value):
         self.shap_attributions_json = None if value is None else json.dumps(value)
 
+    @property
+    def previa_attributions(self):
+        if self.previa_attributions_json is None:
+            return None
+        return json.loads(self.previa_attributions_json)
+
+    @previa_attributions.setter
+    def previa_attributions(self, value):
+        self.previa_attributions_json = None if value is None else json.dumps(value)
+
+    @property
+    def lime_parcial(self):
+        if self.lime_parcial_json is None:
+            return None
+        return json.loads(self.lime_parcial_json)
+
+    @lime_parcial.setter
+    def lime_parcial(self, value):
+        self.lime_parcial_json = None if value is None else json.dumps(value)
+
     @classmethod
     def ativos(cls):
         """Consulta base que ignora o que o aluno retirou.
@@ -172,20 +218,6 @@ class Feedback(db.Model):
         """Se a explicação já foi tentada, com ou sem resultado."""
         return self.token_attributions_json is not None or self.shap_attributions_json is not None
 
-    # Teto para considerar um cálculo ainda em curso. Acima disso, presume-se que
-    # a instância morreu no meio — o Cloud Run pode encerrar um contêiner a
-    # qualquer momento — e um novo pedido tem permissão para recomeçar. Sem esse
-    # teto, um cálculo interrompido travaria a explicação daquele feedback para
-    # sempre.
-    LIMITE_DE_CALCULO = datetime.timedelta(minutes=15)
-
-    @property
-    def explicacao_em_curso(self):
-        """Se há um cálculo iniciado há pouco e ainda sem resultado gravado."""
-        if self.explicacao_calculada or self.explicacao_iniciada_em is None:
-            return False
-        idade = datetime.datetime.utcnow() - self.explicacao_iniciada_em
-        return idade < self.LIMITE_DE_CALCULO
     created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     subject = db.relationship('Subject', backref=db.backref('feedbacks', lazy=True))
 
@@ -223,6 +255,14 @@ class Feedback(db.Model):
             'overall_score': self.overall_score,
             'token_attributions': self.token_attributions,
             'shap_attributions': self.shap_attributions,
+            'lime_modo': self.lime_modo,
+            # A prévia só vale enquanto não há explicação: com LIME ou SHAP
+            # gravados, quem lê usa estes e ignora a prévia.
+            'previa_attributions': self.previa_attributions,
+            'lime_parcial': None if self.explicacao_calculada else self.lime_parcial,
+            'explicacao_provisoria': not self.explicacao_calculada and (
+                self.previa_attributions_json is not None or self.lime_parcial_json is not None
+            ),
             'created_at': self.created_at.isoformat(),
             # Quando o cálculo da explicação começou. A tela usa este instante
             # para mostrar o progresso, e por vir do servidor a contagem
@@ -240,13 +280,161 @@ class Feedback(db.Model):
 
         return data
 
+class TarefaDeExplicacao(db.Model):
+    """O cálculo de LIME e SHAP de um feedback, à espera de um trabalhador.
+
+    A rota só registra a tarefa e responde; quem calcula é o processo
+    `flask worker-explicacoes`, ou a thread equivalente dentro do próprio
+    servidor. Uma tarefa por feedback: pedir de novo não duplica o trabalho,
+    no máximo sobe a prioridade de quem ainda espera.
+
+    O trabalhador que pega uma tarefa recebe uma concessão com prazo e a
+    renova enquanto calcula. Se o processo morrer no meio, a concessão vence e
+    outro trabalhador retoma a tarefa, sem ninguém precisar limpar nada.
+    """
+    __tablename__ = 'tarefa_de_explicacao'
+
+    PENDENTE = 'pendente'
+    EM_CURSO = 'em_curso'
+    CONCLUIDA = 'concluida'
+    FALHOU = 'falhou'
+    CANCELADA = 'cancelada'
+
+    # O aluno que acabou de enviar passa à frente da varredura do que ficou
+    # para trás, e entre iguais sai primeiro a tarefa mais recente.
+    PRIORIDADE_DO_ALUNO = 10
+    PRIORIDADE_DA_VARREDURA = 0
+
+    id = db.Column(db.Integer, primary_key=True)
+    feedback_id = db.Column(db.Integer, db.ForeignKey('feedback.id', ondelete='CASCADE'),
+                            nullable=False, unique=True)
+    estado = db.Column(db.String(20), nullable=False, default=PENDENTE, index=True)
+    prioridade = db.Column(db.Integer, nullable=False, default=PRIORIDADE_DA_VARREDURA)
+    tentativas = db.Column(db.Integer, nullable=False, default=0)
+    criada_em = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    # Antes disto a tarefa não é pega. Serve de espera entre uma tentativa que
+    # falhou e a seguinte.
+    disponivel_em = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    # Até quando o trabalhador atual tem a tarefa. Vencido o prazo sem
+    # renovação, ela volta a ser de quem a pegar.
+    concessao_ate = db.Column(db.DateTime, nullable=True)
+    trabalhador = db.Column(db.String(120), nullable=True)
+
+    erro = db.Column(db.Text, nullable=True)
+    concluida_em = db.Column(db.DateTime, nullable=True)
+
+    # Os feedbacks são apagados em massa (direito de eliminação, contas de
+    # teste), sem passar pelo ORM. Quem apaga a tarefa junto é o banco, e quem
+    # apaga em massa apaga as tarefas antes, para o SQLite sem chaves
+    # estrangeiras ativas.
+    feedback = db.relationship(
+        'Feedback', backref=db.backref('tarefa', uselist=False, lazy=True, passive_deletes=True),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'feedback_id': self.feedback_id,
+            'estado': self.estado,
+            'prioridade': self.prioridade,
+            'tentativas': self.tentativas,
+            'criada_em': self.criada_em.isoformat(),
+            'concessao_ate': self.concessao_ate.isoformat() if self.concessao_ate else None,
+            'trabalhador': self.trabalhador,
+            'erro': self.erro,
+            'concluida_em': self.concluida_em.isoformat() if self.concluida_em else None,
+        }
+
+
+class ArtefatoDeExplicacao(db.Model):
+    """As perturbações de uma explicação e o que o modelo respondeu a cada uma.
+
+    Gravado aos poucos enquanto o cálculo dura, para que a tentativa seguinte
+    de uma tarefa interrompida retome de onde a anterior parou, e mantido depois
+    de concluído, para refazer a regressão do LIME sem o modelo. Um por feedback
+    e identidade do modelo: probabilidades de outros pesos não servem. O
+    conteúdo e o formato estão em artefatos.py.
+    """
+    __tablename__ = 'artefato_de_explicacao'
+    __table_args__ = (db.UniqueConstraint('feedback_id', 'modelo'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    feedback_id = db.Column(db.Integer, db.ForeignKey('feedback.id', ondelete='CASCADE'),
+                            nullable=False, index=True)
+    modelo = db.Column(db.String(16), nullable=False)
+    conteudo = db.Column(db.LargeBinary, nullable=False)
+
+    # Quantas das entradas já têm probabilidade, e quantas são ao todo. Iguais,
+    # o artefato está completo.
+    calculadas = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    atualizado_em = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'feedback_id': self.feedback_id,
+            'modelo': self.modelo,
+            'bytes': len(self.conteudo),
+            'calculadas': self.calculadas,
+            'total': self.total,
+            'atualizado_em': self.atualizado_em.isoformat(),
+        }
+
+
+class ExplicacaoDeTexto(db.Model):
+    """LIME e SHAP de um comentário, por texto e identidade do modelo.
+
+    Comentários curtos se repetem entre alunos e semestres, e cada cópia
+    custava o cálculo inteiro. A explicação depende só do texto e do modelo,
+    então a primeira cópia calcula e as seguintes reaproveitam. A linha sem
+    resultado e com `reservada_ate` no futuro é um cálculo em curso: quem mais
+    pedir o mesmo texto espera por ele em vez de calcular de novo. Ver
+    explicacoes_por_texto.py.
+    """
+    __tablename__ = 'explicacao_de_texto'
+    __table_args__ = (db.UniqueConstraint('chave', 'modelo'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    # Hash do texto normalizado; o texto em si não é guardado aqui.
+    chave = db.Column(db.String(64), nullable=False, index=True)
+    modelo = db.Column(db.String(16), nullable=False)
+
+    token_attributions_json = db.Column(db.Text, nullable=True)
+    shap_attributions_json = db.Column(db.Text, nullable=True)
+    lime_modo = db.Column(db.String(20), nullable=True)
+    calculada_em = db.Column(db.DateTime, nullable=True)
+
+    reservada_ate = db.Column(db.DateTime, nullable=True)
+    reservada_por = db.Column(db.String(120), nullable=True)
+
+    # Quantos feedbacks receberam esta explicação sem calcular.
+    usos = db.Column(db.Integer, nullable=False, default=0)
+    criada_em = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+
 class StudentRiskAnalysis(db.Model):
+    # Uma linha por aluno e disciplina. Sem a restrição, dois envios simultâneos
+    # criavam duas linhas para o mesmo par, e o aluno aparecia em dobro no
+    # painel. É ela também que o UPSERT de feedbacks.ajustar_risco usa.
+    __table_args__ = (
+        db.UniqueConstraint('student_id', 'subject_id', name='uq_risco_aluno_disciplina'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     student_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     subject_id = db.Column(db.Integer, db.ForeignKey('subject.id'), nullable=False)
     average_score = db.Column(db.Float, nullable=False)
     average_sentiment = db.Column(db.Float, nullable=True)
     feedback_count = db.Column(db.Integer, nullable=False)
+
+    # Somas dos feedbacks ativos do par, de onde saem as médias. Cada envio e
+    # cada retirada somam ou subtraem o próprio feedback, sem reler os outros.
+    # Nulas nas linhas anteriores a elas, até o recálculo completo do par.
+    score_sum = db.Column(db.Float, nullable=True)
+    sentiment_sum = db.Column(db.Float, nullable=True)
+    sentiment_count = db.Column(db.Integer, nullable=True)
     
     risk_score = db.Column(db.Float, nullable=False)
     risk_level = db.Column(db.String(20), nullable=False)
@@ -265,6 +453,14 @@ class StudentRiskAnalysis(db.Model):
     THRESHOLD_ALTO          = 0.6
     THRESHOLD_MEDIO         = 0.3
 
+    def aplicar_somas(self):
+        """Médias e risco a partir das somas e da contagem."""
+        self.average_score = self.score_sum / self.feedback_count
+        self.average_sentiment = (
+            self.sentiment_sum / self.sentiment_count if self.sentiment_count else None
+        )
+        self.calculate_risk_score()
+
     def calculate_risk_score(self):
         score_risk = 1 - self.average_score
 
@@ -292,18 +488,56 @@ class StudentRiskAnalysis(db.Model):
             self.risk_level = 'medio'
         else:
             self.risk_level = 'baixo'
+
+    @classmethod
+    def riscos_em_lote(cls, average_score, average_sentiment, feedback_count):
+        """`calculate_risk_score` de muitos pares de uma vez, em arrays do NumPy.
+
+        Sentimento ausente vem como NaN. Mesmas operações, na mesma ordem, para
+        o resultado sair igual ao da linha a linha até o último bit: é o que
+        scripts/conferir_recalculo_do_risco.py e `flask recalcular-risco
+        --conferir` verificam. Mudou um, mude o outro.
+        Devolve (risk_score, risk_level).
+        """
+        score_risk = 1 - average_score
+        com_sentimento = ~np.isnan(average_sentiment)
+        sentiment_risk = np.where(com_sentimento, (1 - average_sentiment) / 2, 0.0)
+        consistency_risk = np.maximum(0, (cls.CONSISTENCY_CAP - feedback_count) / cls.CONSISTENCY_CAP)
+
+        risk_score = np.where(
+            com_sentimento,
+            score_risk       * cls.WEIGHT_SCORE       +
+            sentiment_risk   * cls.WEIGHT_SENTIMENT   +
+            consistency_risk * cls.WEIGHT_CONSISTENCY,
+            score_risk       * cls.WEIGHT_SCORE_NO_SENT       +
+            consistency_risk * cls.WEIGHT_CONSISTENCY_NO_SENT,
+        )
+        risk_level = np.select(
+            [risk_score >= cls.THRESHOLD_ALTO, risk_score >= cls.THRESHOLD_MEDIO],
+            ['alto', 'medio'], 'baixo',
+        )
+        return risk_score, risk_level
     
     def to_dict(self):
+        return self.dict_da_linha(self, self.student.display_name, self.subject.name)
+
+    @staticmethod
+    def dict_da_linha(linha, student_username, subject_name):
+        """O to_dict de qualquer objeto com as colunas, como uma linha de consulta.
+
+        Quem já trouxe o nome do aluno e o da disciplina na mesma consulta não
+        precisa carregar `student` e `subject`, uma consulta a mais cada.
+        """
         return {
-            'id': self.id,
-            'student_id': self.student_id,
-            'student_username': self.student.display_name,
-            'subject_id': self.subject_id,
-            'subject_name': self.subject.name,
-            'average_score': round(self.average_score, 3),
-            'average_sentiment': round(self.average_sentiment, 3) if self.average_sentiment else None,
-            'feedback_count': self.feedback_count,
-            'risk_score': round(self.risk_score, 3),
-            'risk_level': self.risk_level,
-            'last_updated': self.last_updated.isoformat()
+            'id': linha.id,
+            'student_id': linha.student_id,
+            'student_username': student_username,
+            'subject_id': linha.subject_id,
+            'subject_name': subject_name,
+            'average_score': round(linha.average_score, 3),
+            'average_sentiment': round(linha.average_sentiment, 3) if linha.average_sentiment else None,
+            'feedback_count': linha.feedback_count,
+            'risk_score': round(linha.risk_score, 3),
+            'risk_level': linha.risk_level,
+            'last_updated': linha.last_updated.isoformat()
         }
\ No newline at end of file
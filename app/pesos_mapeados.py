@@ -0,0 +1,139 @@
+"""Os pesos do modelo num arquivo mapeado em memória, em vez de copiados para cada processo.
+
+O `create_analyzer` do pysentimiento lê os pesos do disco para memória anônima,
+do próprio processo. Dois processos com o modelo são dois modelos na RAM, e é
+por isso que o gunicorn roda com um worker só.
+
+Aqui os pesos são convertidos uma vez, na build da imagem, para um state_dict
+do torch que pode ser aberto com `torch.load(mmap=True)`. Carregados assim, os
+tensores apontam direto para o arquivo: as páginas vêm do cache de páginas do
+sistema, que é um só para a máquina inteira, e só são lidas. Quantos processos
+abrirem o mesmo arquivo, seja por fork do gunicorn com --preload, seja cada um
+por conta própria, dividem uma cópia dos pesos.
+
+O formato é o do torch, e não safetensors, porque é o que o torch 2.4 sabe
+mapear sem copiar: o carregador de safetensors para o torch lê o arquivo mapeado
+mas entrega tensores copiados para memória do processo.
+
+Os pesos são os mesmos, bit a bit, então as probabilidades também; a identidade
+do modelo continua a do pysentimiento, e o cache de predições segue valendo. Os
+backends que transformam os pesos (int8, bf16) fazem a cópia deles a partir
+daqui e não se beneficiam do mapeamento; o fp32 e o ONNX, sim, o segundo
+porque nem usa estes pesos depois do boot.
+
+    python app/pesos_mapeados.py     converte, na build do Docker
+    PESOS_MAPEADOS=0                 ignora a conversão e carrega como antes
+    PESOS_MAPEADOS_PASTA=caminho     padrão: $HF_HOME/voz-discente/mapeado
+
+Sem a pasta convertida, ou se ela não abrir, o modelo é carregado pelo
+`create_analyzer`, como sempre foi.
+"""
+
+import json
+import logging
+import os
+import shutil
+import time
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+TAREFA = 'sentiment'
+IDIOMA = 'pt'
+
+LIGADO = os.environ.get('PESOS_MAPEADOS', '1').lower() not in ('0', 'false', 'nao', 'não')
+PASTA = os.environ.get(
+    'PESOS_MAPEADOS_PASTA',
+    os.path.join(
+        os.environ.get('HF_HOME')
+        or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance'),
+        'voz-discente', 'mapeado',
+    ),
+)
+
+_PESOS = 'pesos.pt'
+_DESCRICAO = 'analisador.json'
+
+
+def converter(pasta=PASTA):
+    """Grava config, tokenizador e pesos do analisador numa pasta mapeável."""
+    from pysentimiento import create_analyzer
+
+    analisador = create_analyzer(task=TAREFA, lang=IDIOMA)
+
+    # Gravada com outro nome e renomeada no fim, como a exportação do ONNX: uma
+    # conversão interrompida não pode deixar uma pasta pela metade com o nome
+    # que o boot procura.
+    provisoria = pasta + '.convertendo'
+    shutil.rmtree(provisoria, ignore_errors=True)
+    os.makedirs(provisoria)
+
+    analisador.model.config.save_pretrained(provisoria)
+    analisador.tokenizer.save_pretrained(provisoria)
+    torch.save(analisador.model.state_dict(), os.path.join(provisoria, _PESOS))
+    with open(os.path.join(provisoria, _DESCRICAO), 'w', encoding='utf-8') as arquivo:
+        json.dump({
+            'modelo': analisador.model.config._name_or_path,
+            'tarefa': analisador.task,
+            'preprocessing_args': analisador.preprocessing_args,
+        }, arquivo, indent=2)
+
+    shutil.rmtree(pasta, ignore_errors=True)
+    os.replace(provisoria, pasta)
+    logger.info('Pesos convertidos para mapeamento em %s', pasta)
+
+
+def _do_mapeamento(pasta):
+    from pysentimiento.analyzer import AnalyzerForSequenceClassification
+    from transformers import AutoConfig, AutoModelForSequenceClassification, AutoTokenizer
+    from transformers.modeling_utils import no_init_weights
+
+    with open(os.path.join(pasta, _DESCRICAO), encoding='utf-8') as arquivo:
+        descricao = json.load(arquivo)
+
+    # A identidade é a dos pesos originais, não a da pasta: é ela que o
+    # descrever_modelo informa e que indexa o cache de predições e a calibração.
+    configuracao = AutoConfig.from_pretrained(pasta)
+    configuracao._name_or_path = descricao['modelo']
+
+    # A estrutura é montada sem inicializar pesos, que seriam descartados em
+    # seguida, e os tensores do arquivo entram no lugar dos alocados, sem cópia.
+    with no_init_weights():
+        modelo = AutoModelForSequenceClassification.from_config(configuracao)
+    estado = torch.load(os.path.join(pasta, _PESOS), map_location='cpu',
+                        mmap=True, weights_only=True)
+    modelo.load_state_dict(estado, strict=True, assign=True)
+    modelo.eval()
+
+    return AnalyzerForSequenceClassification(
+        modelo, AutoTokenizer.from_pretrained(pasta), descricao['tarefa'],
+        descricao['preprocessing_args'],
+    )
+
+
+def carregar_analisador():
+    """O analisador do pysentimiento, com os pesos mapeados se houver conversão.
+
+    Devolve (analisador, origem), com origem 'mapeados' ou 'originais'.
+    """
+    inicio = time.perf_counter()
+    if LIGADO and os.path.exists(os.path.join(PASTA, _DESCRICAO)):
+        try:
+            analisador = _do_mapeamento(PASTA)
+            logger.info('Pesos mapeados de %s em %.1fs', PASTA, time.perf_counter() - inicio)
+            return analisador, 'mapeados'
+        except Exception:
+            logger.warning('Pesos mapeados em %s não abriram; carregando os originais.',
+                           PASTA, exc_info=True)
+
+    from pysentimiento import create_analyzer
+
+    analisador = create_analyzer(task=TAREFA, lang=IDIOMA)
+    logger.info('Pesos originais carregados em %.1fs', time.perf_counter() - inicio)
+    return analisador, 'originais'
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    converter()
@@ -0,0 +1,238 @@
+"""Vários trabalhadores de explicação sobre uma única cópia do modelo.
+
+O gunicorn roda um worker só porque cada processo carregaria os próprios 1,3 GB
+do modelo. Por isso todas as explicações de uma instância dividem um
+interpretador e um GIL, e numa máquina de quatro vCPUs o LIME de um comentário
+e o SHAP de outro se revezam em vez de rodar juntos.
+
+`flask worker-explicacoes --processos N` carrega o modelo uma vez, no processo
+pai, e bifurca N filhos. Fork não copia memória: pai e filhos apontam para as
+mesmas páginas, e uma página só é duplicada quando alguém escreve nela. Os
+pesos são só lidos, e `services.preparar_para_bifurcar` tira do caminho o que
+escreveria neles sem necessidade: o autograd e as coletas do coletor de lixo.
+O resultado é N trabalhadores com memória perto da de um.
+
+Cada filho fica com uma fatia dos núcleos no torch, para que os N não disputem
+os mesmos núcleos com threads demais, e roda o mesmo laço de tarefas.py com o
+próprio nome de trabalhador: para o banco, são N trabalhadores como quaisquer
+outros. Conexões ao banco e ao cache em disco não atravessam fork, e cada filho
+abre as suas.
+
+O pai não calcula nada. Repõe o filho que morrer, repassa o sinal de parada e
+registra periodicamente a memória e a vazão de cada filho. A memória vem em
+três números: RSS, que conta as páginas compartilhadas em cada filho e por isso
+superestima o total; PSS, que divide cada página compartilhada entre quem a
+usa e soma a memória real; e a parte compartilhada, que mostra quanto do
+modelo continua sendo uma cópia só.
+
+    EXPLICACOES_PROCESSOS=1         processos filhos do worker-explicacoes
+    EXPLICACOES_RELATORIO_S=60      intervalo do relatório de memória e vazão
+"""
+
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+from . import tarefas
+from .models import db
+
+logger = logging.getLogger(__name__)
+
+PROCESSOS = max(1, int(os.environ.get('EXPLICACOES_PROCESSOS', 1)))
+RELATORIO = float(os.environ.get('EXPLICACOES_RELATORIO_S', 60))
+
+# Um filho que morre logo depois de nascer, sem memória por exemplo, seria
+# reposto em laço. Abaixo deste tempo de vida, a reposição espera um pouco.
+_VIDA_MINIMA = 30
+
+_contexto = multiprocessing.get_context('fork')
+
+
+def memoria(pid):
+    """RSS, PSS, memória compartilhada e privada do processo, em MB, ou None se não der para ler."""
+    campos = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as arquivo:
+            for linha in arquivo:
+                nome, _, valor = linha.partition(':')
+                if valor.strip().endswith('kB'):
+                    campos[nome] = int(valor.split()[0])
+    except (OSError, ValueError):
+        return None
+
+    compartilhada = campos.get('Shared_Clean', 0) + campos.get('Shared_Dirty', 0)
+    privada = campos.get('Private_Clean', 0) + campos.get('Private_Dirty', 0)
+    return {
+        'rss_mb': round(campos.get('Rss', 0) / 1024, 1),
+        'pss_mb': round(campos.get('Pss', 0) / 1024, 1),
+        'compartilhada_mb': round(compartilhada / 1024, 1),
+        'privada_mb': round(privada / 1024, 1),
+    }
+
+
+class _Filho:
+    """Um processo filho e o seu lugar nos contadores compartilhados."""
+
+    def __init__(self, posicao, processo):
+        self.posicao = posicao
+        self.processo = processo
+        self.nascido_em = time.monotonic()
+
+
+class ProcessosDeExplicacao:
+    """O processo pai: bifurca, repõe e acompanha os trabalhadores.
+
+    Precisa ser criado num contexto de aplicação, com o services.py já
+    importado, e antes de qualquer thread: um fork feito com outra thread
+    segurando uma trava deixa o filho esperando por ela para sempre.
+    """
+
+    def __init__(self, app, processos=PROCESSOS, por_vez=tarefas.POR_VEZ, ate_esvaziar=False):
+        self.app = app
+        self.processos = processos
+        self.por_vez = por_vez
+        self.ate_esvaziar = ate_esvaziar
+        self.threads = None
+
+        # Por filho: tarefas concluídas e segundos calculando. Memória
+        # compartilhada criada antes do fork, para o pai ler o que os filhos
+        # escrevem.
+        self._concluidas = _contexto.Array('l', processos)
+        self._ocupado = _contexto.Array('d', processos)
+        self._filhos = {}
+        self._parar = threading.Event()
+        self._inicio = time.monotonic()
+
+    def executar(self):
+        """Bifurca os filhos e acompanha até o sinal de parada ou, com
+        `ate_esvaziar`, até todos terminarem a fila."""
+        from .prontidao import carregar_modelo
+
+        services = carregar_modelo()
+
+        self.threads = services.threads_por_processo(self.processos)
+        services.preparar_para_bifurcar()
+        # A conexão do pai não pode ser herdada em uso pelos filhos.
+        db.session.remove()
+        db.engine.dispose()
+
+        signal.signal(signal.SIGTERM, self._ao_sinal)
+        signal.signal(signal.SIGINT, self._ao_sinal)
+
+        for posicao in range(self.processos):
+            self._bifurcar(posicao)
+        logger.info('%s processo(s) de explicação, %s thread(s) do torch cada.',
+                    self.processos, self.threads)
+
+        proximo_relatorio = time.monotonic() + RELATORIO
+        while self._filhos:
+            time.sleep(1)
+            self._recolher()
+            if time.monotonic() >= proximo_relatorio:
+                self._relatar()
+                proximo_relatorio = time.monotonic() + RELATORIO
+
+        self._relatar()
+
+    def estatisticas(self):
+        """Memória e vazão de cada filho vivo, e do conjunto."""
+        decorrido = time.monotonic() - self._inicio
+        filhos = []
+        for filho in sorted(self._filhos.values(), key=lambda f: f.posicao):
+            concluidas = self._concluidas[filho.posicao]
+            ocupado = self._ocupado[filho.posicao]
+            filhos.append({
+                'pid': filho.processo.pid,
+                'memoria': memoria(filho.processo.pid),
+                'concluidas': concluidas,
+                'por_minuto': round(60 * concluidas / decorrido, 2) if decorrido else None,
+                'segundos_por_explicacao': round(ocupado / concluidas, 1) if concluidas else None,
+            })
+        total = sum(self._concluidas)
+        pai = memoria(os.getpid())
+        return {
+            'processos': self.processos,
+            'threads_por_processo': self.threads,
+            'pai': pai,
+            'filhos': filhos,
+            'concluidas': total,
+            'por_minuto': round(60 * total / decorrido, 2) if decorrido else None,
+            # O PSS soma sem contar duas vezes o que é compartilhado: é a
+            # memória que o conjunto ocupa de fato.
+            'pss_total_mb': round(sum(
+                (m or {}).get('pss_mb', 0) for m in [pai] + [f['memoria'] for f in filhos]
+            ), 1),
+        }
+
+    # ---------------------------------------------------------------- interno
+
+    def _ao_sinal(self, numero, _quadro):
+        logger.info('Sinal %s: parando os processos de explicação.', numero)
+        self._parar.set()
+        for filho in self._filhos.values():
+            if filho.processo.is_alive():
+                os.kill(filho.processo.pid, signal.SIGTERM)
+
+    def _bifurcar(self, posicao):
+        processo = _contexto.Process(
+            target=self._no_filho, args=(posicao,), name=f'explicacoes-{posicao}', daemon=False,
+        )
+        processo.start()
+        self._filhos[posicao] = _Filho(posicao, processo)
+
+    def _recolher(self):
+        """Tira os filhos que terminaram e repõe os que morreram antes da hora."""
+        for posicao, filho in list(self._filhos.items()):
+            if filho.processo.is_alive():
+                continue
+            filho.processo.join()
+            del self._filhos[posicao]
+
+            codigo = filho.processo.exitcode
+            if self._parar.is_set() or (self.ate_esvaziar and codigo == 0):
+                continue
+
+            logger.warning('Processo de explicação %s (pid %s) terminou com código %s; repondo.',
+                           posicao, filho.processo.pid, codigo)
+            if time.monotonic() - filho.nascido_em < _VIDA_MINIMA:
+                self._parar.wait(_VIDA_MINIMA)
+            if not self._parar.is_set():
+                self._bifurcar(posicao)
+
+    def _relatar(self):
+        estatisticas = self.estatisticas()
+        for filho in estatisticas['filhos']:
+            logger.info('processo de explicação pid=%s memoria=%s concluidas=%s por_minuto=%s '
+                        'segundos_por_explicacao=%s', filho['pid'], filho['memoria'],
+                        filho['concluidas'], filho['por_minuto'], filho['segundos_por_explicacao'])
+        logger.info('processos de explicação: %s concluídas, %s por minuto, PSS total %s MB',
+                    estatisticas['concluidas'], estatisticas['por_minuto'],
+                    estatisticas['pss_total_mb'])
+
+    def _no_filho(self, posicao):
+        """O corpo de cada filho: a fatia de núcleos, conexões novas e o laço de sempre."""
+        parar = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: parar.set())
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        from .prontidao import carregar_modelo
+
+        carregar_modelo().apos_bifurcar(self.processos)
+
+        def _contar(concluidas, segundos):
+            with self._concluidas.get_lock():
+                self._concluidas[posicao] += concluidas
+            with self._ocupado.get_lock():
+                self._ocupado[posicao] += segundos
+
+        with self.app.app_context():
+            # O pool herdado do pai foi descartado antes do fork; o filho abre
+            # as próprias conexões na primeira consulta.
+            db.engine.dispose(close=False)
+            tarefas.trabalhar(
+                tarefas.nome_do_trabalhador(f'p{posicao}'), self.por_vez,
+                parar=parar, ate_esvaziar=self.ate_esvaziar, ao_processar=_contar,
+            )
@@ -0,0 +1,282 @@
+"""Andamento das explicações, entregue a quem espera sem consultas ao banco.
+
+Para saber se a explicação ficou pronta, a tela e os scripts de validação e de
+carga pediam a lista de feedbacks a cada dez segundos: uma requisição
+autenticada e uma consulta ao banco por aluno esperando, durante minutos. Agora
+quem espera pergunta uma vez e fica esperando a resposta:
+
+    GET /feedbacks/<id>/explicacao/eventos           Server-Sent Events
+    GET /feedbacks/<id>/explicacao/estado?versao=N   long-poll: responde quando
+                                                     a versão muda ou a espera
+                                                     acaba
+
+Os dois leem este registro, em memória, que o trabalhador atualiza enquanto
+calcula: a tarefa reservada, a porcentagem das entradas do LIME que já passaram
+pelo modelo, os pesos da etapa mais recente do LIME (ver
+services.LIME_ETAPAS), o SHAP pronto, e por fim concluída, com falha ou
+cancelada. Cada mudança tem uma versão nova, e quem espera acorda com ela.
+
+O registro é de um processo. Quando o cálculo acontece noutro, no `flask
+worker-explicacoes` ou noutra instância, uma thread vigia confere no banco, a
+cada EXPLICACOES_EVENTOS_VIGIA_S, as tarefas de todos os feedbacks com alguém
+esperando, numa consulta só. Dali chegam as mudanças de estado e as etapas do
+LIME, que o trabalhador grava no feedback; a porcentagem só se vê no processo
+que calcula.
+
+Esperar ocupa uma thread do gunicorn, ainda que parada, sem modelo nem conexão
+com o banco. Cada espera dura no máximo EXPLICACOES_EVENTOS_ESPERA_S e entra
+numa classe própria da admissão (ver admissao.py): sem vaga, 503 com
+Retry-After, e quem espera volta depois. Dividindo as threads com o /analyze
+sobra vaga para pouca gente; o docker-compose.yml põe as esperas num servidor
+à parte, o serviço `eventos`, com SERVIDOR_DE_EVENTOS=1 e WEB_THREADS=64. Lá
+não se calcula nada: o andamento chega pelo vigia, a cada
+EXPLICACOES_EVENTOS_VIGIA_S, numa consulta só para todos os que esperam.
+
+    EXPLICACOES_EVENTOS_ESPERA_S=25    duração máxima de cada espera
+    EXPLICACOES_EVENTOS_VIGIA_S=5      intervalo da conferência no banco
+"""
+
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+from .models import Feedback, TarefaDeExplicacao, db
+
+logger = logging.getLogger(__name__)
+
+ESPERA_MAXIMA = float(os.environ.get('EXPLICACOES_EVENTOS_ESPERA_S', 25))
+VIGIA = float(os.environ.get('EXPLICACOES_EVENTOS_VIGIA_S', 5))
+
+NAO_PEDIDA = 'nao_pedida'
+PENDENTE = 'pendente'
+RESERVADA = 'reservada'
+CALCULANDO = 'calculando'
+CONCLUIDA = 'concluida'
+FALHOU = 'falhou'
+CANCELADA = 'cancelada'
+FINAIS = (CONCLUIDA, FALHOU, CANCELADA)
+
+_DO_BANCO = {
+    TarefaDeExplicacao.PENDENTE: PENDENTE,
+    TarefaDeExplicacao.EM_CURSO: RESERVADA,
+    TarefaDeExplicacao.CONCLUIDA: CONCLUIDA,
+    TarefaDeExplicacao.FALHOU: FALHOU,
+    TarefaDeExplicacao.CANCELADA: CANCELADA,
+}
+
+# Andamentos sem ninguém esperando saem depois disto, para o registro não
+# crescer com todo feedback já explicado desde o boot.
+_GUARDA_S = 600
+
+_condicao = threading.Condition()
+_andamentos = {}   # feedback_id -> andamento
+_esperando = {}    # feedback_id -> quantos esperam
+_versoes = itertools.count(1)
+
+_vigia = None
+_vigia_pid = None
+
+
+def publicar(feedback_id, estado, lime_percentual=None, shap_concluido=False,
+             lime_parcial=None):
+    """Registra o andamento do feedback e acorda quem espera por ele.
+
+    Calculando, sem `lime_parcial`, fica a etapa do LIME já publicada.
+    """
+    with _condicao:
+        anterior = _andamentos.get(feedback_id)
+        if lime_parcial is None and estado == CALCULANDO and anterior is not None:
+            lime_parcial = anterior['lime_parcial']
+        if anterior is not None and (
+            anterior['estado'], anterior['lime_percentual'], anterior['shap_concluido'],
+            _amostras(anterior['lime_parcial']),
+        ) == (estado, lime_percentual, shap_concluido, _amostras(lime_parcial)):
+            return
+        _andamentos[feedback_id] = {
+            'feedback_id': feedback_id,
+            'estado': estado,
+            'lime_percentual': lime_percentual,
+            'shap_concluido': shap_concluido,
+            'lime_parcial': lime_parcial,
+            'versao': next(_versoes),
+            'em': time.monotonic(),
+        }
+        _varrer()
+        _condicao.notify_all()
+
+
+def publicar_varios(ids_de_feedbacks, estado):
+    for feedback_id in ids_de_feedbacks:
+        publicar(feedback_id, estado)
+
+
+def publicar_etapa(ids_de_feedbacks, lime_parcial):
+    """Uma etapa nova do LIME, mantendo a porcentagem e o SHAP já publicados."""
+    for feedback_id in ids_de_feedbacks:
+        with _condicao:
+            anterior = _andamentos.get(feedback_id) or {}
+        publicar(feedback_id, CALCULANDO, anterior.get('lime_percentual'),
+                 anterior.get('shap_concluido', False), lime_parcial)
+
+
+def _amostras(lime_parcial):
+    return lime_parcial['amostras'] if lime_parcial else None
+
+
+def devolver(ids_de_feedbacks):
+    """De volta a pendente, as tarefas devolvidas à fila que não foram encerradas.
+
+    A cancelada no meio do cálculo volta junto com as outras do grupo, mas
+    continua cancelada.
+    """
+    with _condicao:
+        ids = [feedback_id for feedback_id in ids_de_feedbacks
+               if _andamentos.get(feedback_id, {}).get('estado') not in FINAIS]
+    publicar_varios(ids, PENDENTE)
+
+
+def estado_no_banco(feedback):
+    """O estado da explicação do feedback segundo o banco."""
+    if feedback.explicacao_calculada:
+        return CONCLUIDA
+    if feedback.tarefa is None:
+        return NAO_PEDIDA
+    estado = _DO_BANCO[feedback.tarefa.estado]
+    # Com uma etapa do LIME gravada, o cálculo já passou da reserva.
+    return CALCULANDO if estado == RESERVADA and feedback.lime_parcial_json else estado
+
+
+def semear(feedback):
+    """Registra o estado do banco, se o registro ainda não sabe nada do feedback.
+
+    Vem antes de `aguardar`, dentro do contexto da aplicação, e sobe o vigia.
+    """
+    iniciar_vigia()
+    with _condicao:
+        if feedback.id in _andamentos:
+            return
+    estado = estado_no_banco(feedback)
+    lime_parcial = feedback.lime_parcial if estado == CALCULANDO else None
+    with _condicao:
+        if feedback.id not in _andamentos:
+            _andamentos[feedback.id] = {
+                'feedback_id': feedback.id,
+                'estado': estado,
+                'lime_percentual': None,
+                'shap_concluido': estado == CONCLUIDA,
+                'lime_parcial': lime_parcial,
+                'versao': next(_versoes),
+                'em': time.monotonic(),
+            }
+
+
+def aguardar(feedback_id, versao=None, espera=ESPERA_MAXIMA):
+    """O andamento do feedback assim que a versão for outra que `versao`.
+
+    Sem mudança até o fim da espera, devolve o mesmo andamento; quem chamou
+    percebe pela versão igual. Chamar `semear` antes; daí em diante, não
+    precisa do contexto da aplicação nem do banco.
+    """
+    prazo = time.monotonic() + max(0.0, min(espera, ESPERA_MAXIMA))
+    with _condicao:
+        _esperando[feedback_id] = _esperando.get(feedback_id, 0) + 1
+        try:
+            while True:
+                andamento = _andamentos.get(feedback_id)
+                restante = prazo - time.monotonic()
+                if andamento is None or andamento['versao'] != versao or restante <= 0:
+                    return _publico(andamento, feedback_id)
+                _condicao.wait(restante)
+        finally:
+            _esperando[feedback_id] -= 1
+            if not _esperando[feedback_id]:
+                del _esperando[feedback_id]
+
+
+def _publico(andamento, feedback_id):
+    if andamento is None:
+        return {'feedback_id': feedback_id, 'estado': NAO_PEDIDA, 'lime_percentual': None,
+                'shap_concluido': False, 'lime_parcial': None, 'versao': None}
+    return {chave: valor for chave, valor in andamento.items() if chave != 'em'}
+
+
+def _varrer():
+    """Tira os andamentos antigos sem ninguém esperando. Chamado com a condição travada."""
+    if len(_andamentos) < 256:
+        return
+    limite = time.monotonic() - _GUARDA_S
+    for feedback_id in [f for f, a in _andamentos.items()
+                        if a['em'] < limite and f not in _esperando]:
+        del _andamentos[feedback_id]
+
+
+def _conferir_no_banco():
+    """Uma consulta para todos os feedbacks esperados que ainda não terminaram."""
+    with _condicao:
+        ids = [feedback_id for feedback_id in _esperando
+               if _andamentos.get(feedback_id, {}).get('estado') not in FINAIS]
+    if not ids:
+        return
+
+    linhas = (db.session.query(Feedback.id, TarefaDeExplicacao.estado,
+                               Feedback.token_attributions_json, Feedback.shap_attributions_json,
+                               Feedback.lime_parcial_json)
+              .outerjoin(TarefaDeExplicacao, TarefaDeExplicacao.feedback_id == Feedback.id)
+              .filter(Feedback.id.in_(ids)).all())
+    db.session.rollback()
+
+    for feedback_id, tarefa, lime, shap, parcial in linhas:
+        lime_parcial = None
+        if lime is not None or shap is not None:
+            estado = CONCLUIDA
+        elif tarefa is None:
+            estado = NAO_PEDIDA
+        else:
+            estado = _DO_BANCO[tarefa]
+            if estado == RESERVADA and parcial is not None:
+                estado, lime_parcial = CALCULANDO, json.loads(parcial)
+        with _condicao:
+            anterior = _andamentos.get(feedback_id, {})
+        atual = anterior.get('estado')
+        # Reservada no banco é tudo o que o vigia sabe; o processo que calcula
+        # pode já ter dito mais.
+        if estado == RESERVADA and atual == CALCULANDO:
+            continue
+        if estado == CALCULANDO == atual:
+            if _amostras(lime_parcial) != _amostras(anterior.get('lime_parcial')):
+                publicar_etapa([feedback_id], lime_parcial)
+        elif estado != atual:
+            publicar(feedback_id, estado, shap_concluido=estado == CONCLUIDA,
+                     lime_parcial=lime_parcial)
+
+
+def iniciar_vigia():
+    """Sobe, uma vez por processo, a thread que confere o banco por quem espera."""
+    global _vigia, _vigia_pid
+    from flask import current_app
+
+    with _condicao:
+        # Thread não atravessa fork: num processo filho, a do pai não existe mais.
+        if _vigia_pid == os.getpid() and _vigia.is_alive():
+            return
+        app = current_app._get_current_object()
+
+        def _laco():
+            with app.app_context():
+                while True:
+                    time.sleep(VIGIA)
+                    try:
+                        _conferir_no_banco()
+                    except Exception:
+                        db.session.rollback()
+                        logger.warning('Falha ao conferir o andamento das explicações no banco.',
+                                       exc_info=True)
+                    finally:
+                        db.session.remove()
+
+        _vigia = threading.Thread(target=_laco, name='vigia-explicacoes', daemon=True)
+        _vigia.start()
+        _vigia_pid = os.getpid()
@@ -0,0 +1,121 @@
+"""Carregamento tardio do modelo e o estado de prontidão do processo.
+
+O services.py importa torch, transformers, shap e lime e carrega o modelo no
+próprio import. Enquanto o app o importava de cima, pelo routes.py, nenhum
+processo atendia nada antes disso: nem o /login, nem o `flask listar-usuarios`,
+nem o primeiro pedido de um cold start no Cloud Run.
+
+Agora ninguém o importa de cima. Quem precisa do modelo pede por
+`carregar_modelo()`, que o importa uma vez, medindo cada fase, e devolve o
+módulo. Login, perfil, painéis e comandos do `flask` que não calculam nada
+nunca o pedem. Quem calcula (o trabalhador, o `calcular-explicacoes`, os filhos
+do `--processos`, os scripts de medição) também pede por aqui, e nunca importa
+o services.py direto: é o que mantém o estado deste módulo fiel ao processo.
+
+No servidor, `iniciar_no_processo` faz o pedido numa thread logo depois do boot
+e aquece o modelo com uma inferência de verdade. O /health continua respondendo
+na hora; o /ready diz se o modelo já carregou, se já aqueceu e se o banco
+responde, e é ele que deve servir de sonda de prontidão.
+
+    MODELO_NO_BOOT=1    carrega e aquece numa thread ao subir o servidor;
+                        com 0, só no primeiro uso, e o /ready não espera por ele
+"""
+
+import importlib
+import logging
+import os
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+NO_BOOT = os.environ.get('MODELO_NO_BOOT', '1').lower() not in ('0', 'false', 'nao', 'não')
+
+# As fases, na ordem em que o services.py as dispararia. Importadas antes e uma
+# a uma, cada biblioteca tem o seu tempo; o que sobra para o services.py é o
+# modelo em si.
+_FASES = (
+    ('torch', ('torch',)),
+    ('transformers', ('transformers',)),
+    ('shap_e_lime', ('shap', 'lime.lime_text')),
+)
+
+_trava = threading.Lock()
+_estado = {
+    'modelo_carregado': False,
+    'aquecido': False,
+    'tempos_s': {},
+    'erro': None,
+}
+_thread = None
+_thread_pid = None
+
+
+def carregar_modelo():
+    """O services.py, importado e com o modelo carregado; na primeira chamada, carrega."""
+    servicos = sys.modules.get(f'{__package__}.services')
+    if _estado['modelo_carregado'] and servicos is not None:
+        return servicos
+
+    with _trava:
+        if not _estado['modelo_carregado']:
+            tempos = {}
+            for fase, modulos in _FASES:
+                inicio = time.perf_counter()
+                for modulo in modulos:
+                    importlib.import_module(modulo)
+                tempos[fase] = round(time.perf_counter() - inicio, 2)
+
+            inicio = time.perf_counter()
+            importlib.import_module(f'{__package__}.services')
+            tempos['modelo'] = round(time.perf_counter() - inicio, 2)
+
+            _estado.update(modelo_carregado=True, tempos_s=tempos, erro=None)
+            logger.info('Pilha de ML carregada em %.1fs: %s',
+                        sum(tempos.values()),
+                        ', '.join(f'{fase} {segundos:.1f}s' for fase, segundos in tempos.items()))
+
+    return sys.modules[f'{__package__}.services']
+
+
+def aquecer():
+    """Carrega, se preciso, e faz a primeira inferência deste processo."""
+    servicos = carregar_modelo()
+    if _estado['aquecido']:
+        return
+    segundos = servicos.aquecer()
+    _estado['tempos_s']['aquecimento'] = round(segundos, 2)
+    _estado['aquecido'] = True
+    logger.info('Modelo aquecido no processo %s em %.1fs.', os.getpid(), segundos)
+
+
+def estado():
+    """Cópia do estado do modelo neste processo, para o /ready."""
+    return dict(_estado, tempos_s=dict(_estado['tempos_s']))
+
+
+def iniciar_no_processo():
+    """Carrega e aquece o modelo numa thread, sem segurar o boot.
+
+    Como tarefas.iniciar_no_processo, não roda nos comandos do `flask`: os que
+    usam o modelo o pedem na hora. Com o gunicorn em --preload o mestre já
+    carregou o modelo antes do fork, e a thread de cada worker só aquece.
+    """
+    global _thread, _thread_pid
+    if not NO_BOOT or os.environ.get('FLASK_RUN_FROM_CLI') == 'true':
+        return None
+    if _thread_pid == os.getpid() and _thread.is_alive():
+        return _thread
+
+    def _carregar():
+        try:
+            aquecer()
+        except Exception as erro:
+            _estado['erro'] = f'{type(erro).__name__}: {erro}'
+            logger.exception('Falha ao carregar o modelo em segundo plano.')
+
+    _thread = threading.Thread(target=_carregar, name='carregar-modelo', daemon=True)
+    _thread.start()
+    _thread_pid = os.getpid()
+    return _thread
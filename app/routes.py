@@ -1,20 +1,18 @@
+import json
 import logging
 import time
 
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, Response, jsonify, request
 from flask_jwt_extended import get_jwt_identity, jwt_required, get_jwt
 from datetime import datetime
 from werkzeug.security import check_password_hash, generate_password_hash
-from .emails import notificar
-from .models import db, Feedback, User, Subject, StudentRiskAnalysis
-from .services import (
-    create_feedback,
-    explain_sentiment_lime,
-    explain_sentiment_shap,
-    get_students_at_risk,
-    update_student_risk_analysis,
-)
+from .models import db, Feedback, User, Subject, StudentRiskAnalysis, TarefaDeExplicacao
+from .feedbacks import ajustar_risco, create_feedback, get_students_at_risk
+from .tarefas import apagar_do_aluno, cancelar, enfileirar, espera_por_vaga_na_fila
 from .decorators import requires_role
+from .emails import notificar
+from . import admissao, explicacoes_por_texto, progresso
+from .prontidao import carregar_modelo, estado as estado_do_modelo
 
 logger = logging.getLogger(__name__)
 
@@ -63,8 +61,12 @@ def validate_feedback_payload(data):
     
     return True, ""
 
+# Com as vagas tomadas, a recusa sai antes de ler o corpo ou tocar no banco:
+# é o que a torna barata no pico (ver admissao.py). Depois do jwt_required,
+# para que um token inválido não ocupe vaga nem conte como recusa.
 @api.route("/analyze", methods=["POST"])
 @jwt_required()
+@admissao.admitir(admissao.ANALISE)
 def analyze_and_save_feedback():
     data = request.get_json()
     student_id = get_jwt_identity()
@@ -115,24 +117,34 @@ def analyze_and_save_feedback():
     return jsonify(feedback.to_dict(incluir_identificacao=True)), 201
 
 
+def _feedback_do_aluno(feedback_id):
+    """O feedback, se for de quem pede.
+
+    O aluno só explica e acompanha o próprio comentário; o docente não passa
+    por aqui, porque na visão dele o feedback é dissociado de quem escreveu.
+    """
+    feedback = db.session.get(Feedback, feedback_id)
+    if feedback is None or feedback.student_id != int(get_jwt_identity()):
+        return None
+    return feedback
+
+
 @api.route("/feedbacks/<int:feedback_id>/explicacao", methods=["POST"])
 @jwt_required()
+@admissao.admitir(admissao.EXPLICACAO)
 def gerar_explicacao(feedback_id):
-    """Calcula LIME e SHAP de um feedback já gravado.
+    """Pede LIME e SHAP de um feedback já gravado.
 
-    Idempotente: se as atribuições já existem, devolve as que estão no banco em
-    vez de recalcular. Isso torna a chamada segura para repetir — a tela pode
-    tentar de novo, e o comando `calcular-explicacoes` pode varrer o que sobrou.
+    Não calcula: registra a tarefa na fila e responde 202 na hora. Quem calcula
+    é o trabalhador de explicações (ver tarefas.py), que grava as atribuições e
+    avisa o aluno por e-mail. Idempotente: se as atribuições já existem, devolve
+    as que estão no banco com 200, e pedir de novo uma tarefa ainda aberta não a
+    duplica.
     """
-    feedback = db.session.get(Feedback, feedback_id)
+    feedback = _feedback_do_aluno(feedback_id)
     if feedback is None:
         return jsonify({"error": "Feedback não encontrado."}), 404
 
-    # O aluno só explica o próprio comentário; o docente não passa por aqui,
-    # porque na visão dele o feedback é dissociado de quem escreveu.
-    if feedback.student_id != int(get_jwt_identity()):
-        return jsonify({"error": "Feedback não encontrado."}), 404
-
     if not (feedback.additional_comment or '').strip():
         return jsonify({"error": "Este feedback não tem comentário para explicar."}), 400
 
@@ -141,98 +153,133 @@ def gerar_explicacao(feedback_id):
     if feedback.explicacao_calculada:
         return jsonify(feedback.to_dict(incluir_identificacao=True)), 200
 
-    # Reserva do cálculo, em uma única instrução, para que dois pedidos
-    # simultâneos não façam o mesmo trabalho duas vezes.
-    #
-    # Ler o estado e depois gravar deixaria uma janela entre as duas operações, e
-    # foi exatamente ela que apareceu em produção: dois pedidos para o mesmo
-    # feedback, com 51 segundos de diferença, ambos concluíram que faltava
-    # calcular e ambos calcularam. Aqui, o banco decide quem reserva — quem
-    # atualizar a linha segue, quem não atualizar sabe que outro já está com ela.
-    #
-    # A condição de idade permite retomar um cálculo cuja instância morreu no
-    # meio, o que o Cloud Run pode fazer a qualquer momento.
-    agora = datetime.utcnow()
-    reservado = (
-        Feedback.query
-        .filter(Feedback.id == feedback.id)
-        .filter(db.or_(
-            Feedback.explicacao_iniciada_em.is_(None),
-            Feedback.explicacao_iniciada_em < agora - Feedback.LIMITE_DE_CALCULO,
-        ))
-        .update({'explicacao_iniciada_em': agora}, synchronize_session=False)
-    )
-    db.session.commit()
+    # Outro aluno já escreveu o mesmo comentário e a explicação dele está
+    # guardada: responde com ela na hora. Só com o modelo já carregado neste
+    # processo, que é quem sabe a identidade dele; sem isso a tarefa vai para a
+    # fila, e o trabalhador reaproveita do mesmo jeito.
+    if explicacoes_por_texto.LIGADO and estado_do_modelo()['modelo_carregado']:
+        if explicacoes_por_texto.reaproveitar(feedback, carregar_modelo().IDENTIDADE_DO_MODELO):
+            db.session.commit()
+            logger.info("explicacao feedback=%s reaproveitada de texto igual", feedback.id)
+            progresso.publicar(feedback.id, progresso.CONCLUIDA, 100, True)
+            notificar(feedback)
+            return jsonify(feedback.to_dict(incluir_identificacao=True)), 200
+
+    # Com a fila no teto, melhor dizer agora quando voltar do que prometer um
+    # e-mail para daqui a horas. Nada é gravado; a tela repete sozinha.
+    if admissao.LIGADO:
+        espera = espera_por_vaga_na_fila(feedback.id)
+        if espera is not None:
+            return admissao.resposta_de_recusa(admissao.EXPLICACAO.recusar(espera))
+
+    # A unicidade da tarefa por feedback é o que antes a reserva por
+    # explicacao_iniciada_em fazia: dois pedidos simultâneos, como os do teste
+    # de 19 de agosto, caem na mesma tarefa e o cálculo acontece uma vez.
+    tarefa = enfileirar(feedback, TarefaDeExplicacao.PRIORIDADE_DO_ALUNO)
+    logger.info("explicacao feedback=%s enfileirada, tarefa=%s estado=%s",
+                feedback.id, tarefa.id, tarefa.estado)
+    if tarefa.estado == TarefaDeExplicacao.PENDENTE:
+        progresso.publicar(feedback.id, progresso.PENDENTE)
+
+    corpo = feedback.to_dict(incluir_identificacao=True)
+    corpo['explicacao_em_processamento'] = True
+    corpo['explicacao_estado'] = tarefa.estado
+    return jsonify(corpo), 202
+
+
+def _acompanhar(feedback_id):
+    """O feedback do aluno, com o andamento dele já no registro, ou uma resposta de erro.
+
+    Solta a conexão com o banco antes de esperar: quem espera não consulta
+    mais nada, e segurá-la esgotaria o pool com alunos parados.
+    """
+    feedback = _feedback_do_aluno(feedback_id)
+    if feedback is None:
+        db.session.remove()
+        return jsonify({"error": "Feedback não encontrado."}), 404
+    progresso.semear(feedback)
+    db.session.remove()
+    return None
 
-    if not reservado:
-        logger.info(
-            "explicacao feedback=%s ja em curso, pedido devolvido sem recalcular",
-            feedback.id,
-        )
-        corpo = feedback.to_dict(incluir_identificacao=True)
-        corpo['explicacao_em_processamento'] = True
-        return jsonify(corpo), 202
 
-    comentario = feedback.additional_comment
-    houve_falha = False
+@api.route("/feedbacks/<int:feedback_id>/explicacao/estado", methods=["GET"])
+@jwt_required()
+@admissao.admitir(admissao.EVENTOS)
+def estado_da_explicacao(feedback_id):
+    """Long-poll do andamento da explicação (ver progresso.py).
 
-    # As duas técnicas são independentes: se uma falhar, a outra ainda serve para
-    # destacar as palavras, e a tela não fica sem explicação nenhuma.
-    #
-    # Os tempos vão para o log porque é a única forma de saber, em produção, qual
-    # das duas domina o custo e como cada uma cresce com o tamanho do texto.
-    inicio = time.perf_counter()
-    try:
-        feedback.token_attributions = explain_sentiment_lime(comentario)
-    except Exception:
-        houve_falha = True
-        logger.exception("LIME falhou para o feedback %s", feedback.id)
-    tempo_lime = time.perf_counter() - inicio
+    Sem `versao`, responde na hora. Com a versão da última resposta, responde
+    quando houver outra, ou com a mesma ao fim de `espera` segundos, no máximo
+    EXPLICACOES_EVENTOS_ESPERA_S.
+    """
+    erro = _acompanhar(feedback_id)
+    if erro is not None:
+        return erro
+    return jsonify(progresso.aguardar(
+        feedback_id,
+        request.args.get("versao", type=int),
+        request.args.get("espera", progresso.ESPERA_MAXIMA, type=float),
+    )), 200
 
-    inicio = time.perf_counter()
-    try:
-        feedback.shap_attributions = explain_sentiment_shap(comentario)
-    except Exception:
-        houve_falha = True
-        logger.exception("SHAP falhou para o feedback %s", feedback.id)
-    tempo_shap = time.perf_counter() - inicio
 
-    logger.info(
-        "explicacao feedback=%s caracteres=%s lime=%.1fs shap=%.1fs total=%.1fs",
-        feedback.id, len(comentario), tempo_lime, tempo_shap, tempo_lime + tempo_shap,
-    )
+@api.route("/feedbacks/<int:feedback_id>/explicacao/eventos", methods=["GET"])
+@jwt_required()
+def eventos_da_explicacao(feedback_id):
+    """O andamento da explicação em Server-Sent Events (ver progresso.py).
 
-    # Nada foi calculado, então a reserva é devolvida. Mantê-la faria a próxima
-    # tentativa receber "em processamento" por quinze minutos, escondendo do
-    # aluno um cálculo que não está acontecendo.
-    if houve_falha and not feedback.explicacao_calculada:
-        feedback.explicacao_iniciada_em = None
+    Um evento `andamento` a cada mudança, com a versão como id. A conexão
+    termina no estado final ou depois de EXPLICACOES_EVENTOS_ESPERA_S; quem
+    acompanha reconecta com a última versão em `versao` ou Last-Event-ID.
+    """
+    erro = _acompanhar(feedback_id)
+    if erro is not None:
+        return erro
 
+    # A vaga dura o fluxo inteiro, e não só esta função: sai quando o servidor
+    # fecha a resposta, mesmo que o cliente caia antes do primeiro evento.
     try:
-        db.session.commit()
-    except Exception:
-        db.session.rollback()
-        logger.exception("Erro ao gravar as explicações do feedback %s", feedback.id)
-        return jsonify({"error": "Não foi possível gravar a explicação."}), 500
-
-    if houve_falha and not feedback.explicacao_calculada:
-        return jsonify({"error": "Não foi possível gerar a explicação deste comentário."}), 500
+        comeco = admissao.EVENTOS.entrar() if admissao.LIGADO else None
+    except admissao.Recusado as recusa:
+        return admissao.resposta_de_recusa(recusa)
+
+    versao = request.args.get("versao", type=int)
+    if versao is None:
+        versao = request.headers.get("Last-Event-ID", type=int)
+
+    def _eventos(versao):
+        prazo = time.monotonic() + progresso.ESPERA_MAXIMA
+        yield "retry: 3000\n\n"
+        while True:
+            restante = prazo - time.monotonic()
+            if restante <= 0:
+                return
+            # Um comentário a cada tanto mantém a conexão viva nos proxies e
+            # revela cedo o cliente que foi embora.
+            andamento = progresso.aguardar(feedback_id, versao, min(restante, 10))
+            if andamento["versao"] == versao:
+                yield ": aguardando\n\n"
+                continue
+            versao = andamento["versao"]
+            yield f"id: {versao}\nevent: andamento\ndata: {json.dumps(andamento)}\n\n"
+            if andamento["estado"] in progresso.FINAIS:
+                return
 
-    # O aviso sai aqui, depois do commit, porque é aqui que a análise daquele
-    # aluno acabou de ficar pronta. Depende do commit de propósito: avisar antes
-    # arriscaria mandar o aluno olhar um resultado que a gravação ainda pode
-    # perder. `notificar` não levanta exceção e não é avisado duas vezes.
-    notificar(feedback)
+    resposta = Response(_eventos(versao), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+    if comeco is not None:
+        resposta.call_on_close(lambda: admissao.EVENTOS.sair(comeco))
+    return resposta
 
-    return jsonify(feedback.to_dict(incluir_identificacao=True)), 200
 
 @api.route("/versao-modelo", methods=["GET"])
 @jwt_required()
 @requires_role(User.PROFESSOR, User.COORDENADOR)
 def versao_modelo():
-    """Qual modelo e quais versões geraram as análises — para registrar no artigo."""
-    from .services import descrever_modelo
-    return jsonify(descrever_modelo()), 200
+    """Qual modelo, em qual backend e com quais versões as análises foram
+    geradas — para registrar no artigo."""
+    return jsonify(carregar_modelo().descrever_modelo()), 200
 
 
 @api.route("/feedbacks", methods=["GET"])
@@ -267,34 +314,64 @@ def get_all_feedbacks():
     all_feedbacks = query.order_by(Feedback.created_at.desc()).all()
     return jsonify([feedback.to_dict() for feedback in all_feedbacks]), 200
 
+# Teto do `limit` do /students-at-risk. Sem `limit`, vem tudo, como o painel
+# sempre pediu.
+LIMITE_RISCO_MAXIMO = 500
+
+
+def _cursor_do_risco(cursor):
+    """O "risk_score:id" do X-Next-Cursor de volta em tupla; None se não for um."""
+    try:
+        score, id_ = cursor.split(':')
+        return float(score), int(id_)
+    except ValueError:
+        return None
+
+
 @api.route("/students-at-risk", methods=["GET"])
 @jwt_required()
 @requires_role(User.PROFESSOR, User.COORDENADOR)
 def get_at_risk_students():
+    """Análises de risco, da maior para a menor, numa consulta só.
+
+    Com `limit`, uma página; havendo mais, o cabeçalho X-Next-Cursor traz o
+    valor do `cursor` da seguinte.
+    """
     claims = get_jwt()
     user_id = get_jwt_identity()
     user = _get_user(user_id)
     role = claims.get("role")
 
-    subject_filter_id = request.args.get('subject_id')
+    # Sem o 400, um subject_id malformado viraria None, que para o coordenador
+    # é "todas as disciplinas".
+    subject_filter_id = request.args.get('subject_id', type=int)
+    if 'subject_id' in request.args and subject_filter_id is None:
+        return jsonify({"message": "subject_id deve ser um inteiro."}), 400
     min_risk_level = request.args.get('min_risk', 'medio')
-    
+
+    limit = request.args.get('limit', type=int)
+    if 'limit' in request.args and not (limit and 0 < limit <= LIMITE_RISCO_MAXIMO):
+        return jsonify({"message": f"limit deve ser um inteiro de 1 a {LIMITE_RISCO_MAXIMO}."}), 400
+    depois_de = None
+    if request.args.get('cursor'):
+        depois_de = _cursor_do_risco(request.args['cursor'])
+        if depois_de is None:
+            return jsonify({"message": "cursor inválido."}), 400
+
+    subject_ids = [subject_filter_id] if subject_filter_id else None
     if role == User.PROFESSOR:
         professor_subject_ids = [s.id for s in user.subjects]
         
-        if subject_filter_id:
-            if int(subject_filter_id) not in professor_subject_ids:
-                return jsonify({"message": "Acesso negado a esta matéria."}), 403
-        
-        at_risk = []
-        for subject_id in professor_subject_ids:
-            if subject_filter_id and int(subject_filter_id) != subject_id:
-                continue
-            at_risk.extend(get_students_at_risk(subject_id, min_risk_level))
-    else:
-        at_risk = get_students_at_risk(subject_filter_id, min_risk_level)
-    
-    return jsonify([analysis.to_dict() for analysis in at_risk]), 200
+        if subject_filter_id and subject_filter_id not in professor_subject_ids:
+            return jsonify({"message": "Acesso negado a esta matéria."}), 403
+        subject_ids = subject_ids or professor_subject_ids
+
+    at_risk, proxima = get_students_at_risk(subject_ids, min_risk_level, limit, depois_de)
+
+    cabecalhos = {}
+    if proxima is not None:
+        cabecalhos['X-Next-Cursor'] = f'{proxima[0]!r}:{proxima[1]}'
+    return jsonify(at_risk), 200, cabecalhos
 
 @api.route("/student-progress/<int:student_id>", methods=["GET"])
 @jwt_required()
@@ -416,14 +493,21 @@ def delete_my_feedback(feedback_id):
     # Retirada lógica, declarada na versão 3.0 do termo. A linha sai da vista do
     # aluno e de toda análise, e fica registrado que houve retirada e quando. O
     # direito de eliminação continua inteiro pelo Perfil, que apaga de verdade.
-    subject_id = feedback.subject_id
-    feedback.deleted_at = datetime.utcnow()
+    #
+    # Condicional no banco: de dois pedidos simultâneos, só um retira, e só ele
+    # tira o feedback da análise de risco.
+    retirado = Feedback.query.filter_by(id=feedback.id, deleted_at=None).update(
+        {'deleted_at': datetime.utcnow()}, synchronize_session=False,
+    )
+    if retirado:
+        # Sem isto a análise de risco fica congelada com a média e a contagem
+        # antigas, e um aluno sem nenhum feedback continua aparecendo no painel
+        # do docente. Entra no mesmo commit da retirada.
+        ajustar_risco(feedback.student_id, feedback.subject_id, feedback.overall_score,
+                      feedback.compound, sinal=-1)
+        cancelar(feedback.id)
     db.session.commit()
 
-    # Sem isto a análise de risco fica congelada com a média e a contagem antigas,
-    # e um aluno sem nenhum feedback continua aparecendo no painel do docente.
-    update_student_risk_analysis(int(student_id), subject_id)
-
     return jsonify({"message": "Feedback apagado com sucesso."}), 200
 
 
@@ -477,6 +561,7 @@ def apagar_meus_dados():
     user = _get_user(get_jwt_identity())
 
     feedbacks = Feedback.query.filter_by(student_id=user.id).count()
+    apagar_do_aluno([user.id])
     Feedback.query.filter_by(student_id=user.id).delete()
     StudentRiskAnalysis.query.filter_by(student_id=user.id).delete()
 
@@ -1,7 +1,8 @@
 from werkzeug.security import generate_password_hash
 from datetime import datetime, timedelta
 from .models import db, User, Subject, Feedback
-from .services import analyze_sentiment_text, update_student_risk_analysis, explain_sentiment_lime, explain_sentiment_shap
+from .feedbacks import recalcular_riscos
+from .prontidao import carregar_modelo
 import random
 import json
 
@@ -144,28 +145,26 @@ def seed_subjects():
 
 
 def _precompute_attributions():
+    services = carregar_modelo()
     unique_comments = set()
     for pool in COMMENTS.values():
         unique_comments.update(pool)
+    unique_comments = sorted(unique_comments)
 
     sentiment_cache = {}
     lime_cache = {}
     shap_cache = {}
 
-    for i, comment in enumerate(unique_comments, 1):
-        print(f'  Computing attributions {i}/{len(unique_comments)}: {comment[:40]}...')
+    for comment in unique_comments:
+        sentiment_cache[comment] = services.analyze_sentiment_text(comment)
 
-        sentiment_cache[comment] = analyze_sentiment_text(comment)
-
-        try:
-            lime_cache[comment] = json.dumps(explain_sentiment_lime(comment))
-        except Exception:
-            lime_cache[comment] = None
-
-        try:
-            shap_cache[comment] = json.dumps(explain_sentiment_shap(comment))
-        except Exception:
-            shap_cache[comment] = None
+    # All comments share their model passes; see explicar_em_lote.
+    print(f'  Computing LIME + SHAP for {len(unique_comments)} comments together...')
+    for comment, resultado in zip(unique_comments, services.explicar_em_lote(unique_comments, services.VARREDURA)):
+        lime, erro_lime, _ = resultado['lime']
+        lime_cache[comment] = json.dumps(lime) if erro_lime is None else None
+        shap, erro_shap, _ = resultado['shap']
+        shap_cache[comment] = json.dumps(shap) if erro_shap is None else None
 
     return sentiment_cache, lime_cache, shap_cache
 
@@ -175,6 +174,7 @@ def seed_feedbacks():
     subjects = Subject.query.filter(Subject.name.in_(SUBJECT_NAMES[:3])).all()
     now = datetime.utcnow()
 
+    services = carregar_modelo()
     print('Pre-computing sentiment + LIME + SHAP for unique comments...')
     sentiment_cache, lime_cache, shap_cache = _precompute_attributions()
     print('Done. Creating feedbacks...')
@@ -224,6 +224,8 @@ def seed_feedbacks():
                 fb.pos      = sentiment['pos']
 
             fb.token_attributions_json = lime_cache.get(comment)
+            if fb.token_attributions_json is not None:
+                fb.lime_modo = services.modo_lime(comment)
             fb.shap_attributions_json  = shap_cache.get(comment)
 
             feedbacks_to_add.append(fb)
@@ -232,11 +234,6 @@ def seed_feedbacks():
     db.session.commit()
     print(f'{len(feedbacks_to_add)} feedbacks created.')
 
-    all_subjects = Subject.query.all()
-    for username, _, _, _ in STUDENTS:
-        student = students[username]
-        for subject in all_subjects:
-            if Feedback.query.filter_by(student_id=student.id, subject_id=subject.id).first():
-                update_student_risk_analysis(student.id, subject.id)
+    recalcular_riscos()
 
     print('Risk analysis computed.')
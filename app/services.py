@@ -1,16 +1,30 @@
+import hashlib
+import json
 import logging
+import math
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import numpy as np
 import shap
 import torch
-from pysentimiento import create_analyzer
 from lime.lime_text import LimeTextExplainer
-from .models import db, Feedback, StudentRiskAnalysis
+from . import backend_de_inferencia, cache_de_predicoes, calibracao, lime_por_mascaras, pesos_mapeados
+from .escalonador_de_inferencia import ANALISE, EXPLICACAO, VARREDURA, EscalonadorDeInferencia
+from .fila_de_inferencia import FilaDeInferencia, PedidoCancelado
 
 logger = logging.getLogger(__name__)
 
-sentiment_analyzer = create_analyzer(task="sentiment", lang="pt")
+# Pelos pesos mapeados em memória quando a imagem os converteu, que vários
+# processos dividem; senão pelo create_analyzer, como sempre. Ver
+# pesos_mapeados.py.
+sentiment_analyzer, ORIGEM_DOS_PESOS = pesos_mapeados.carregar_analisador()
+
+# Guardada à parte porque o modelo do analisador pode ser trocado pela variante
+# do backend escolhido, e a identificação precisa continuar a dos pesos.
+_configuracao = sentiment_analyzer.model.config
 
 
 def descrever_modelo():
@@ -19,12 +33,14 @@ def descrever_modelo():
     O pysentimiento não permite fixar a revisão dos pesos, então registramos o
     que foi carregado de fato — é isso que garante rastreabilidade entre a
     coleta e a defesa. Em produção, a imagem Docker baixa os pesos na build e
-    os congela; aqui fica o registro de qual versão está em uso.
+    os congela; aqui fica o registro de qual versão está em uso, e de qual
+    backend executou a inferência: int8, bf16 e ONNX não dão exatamente as
+    mesmas probabilidades que a referência em fp32.
     """
     from importlib.metadata import version
 
     try:
-        modelo = sentiment_analyzer.model.config._name_or_path
+        modelo = _configuracao._name_or_path
     except Exception:
         modelo = 'desconhecido'
 
@@ -36,6 +52,7 @@ def descrever_modelo():
 
     return {
         'modelo': modelo,
+        'backend': _backend.nome,
         'pysentimiento': _versao('pysentimiento'),
         'transformers': _versao('transformers'),
         'lime': _versao('lime'),
@@ -43,48 +60,434 @@ def descrever_modelo():
     }
 
 
-logger.info("Modelo de sentimento carregado: %s", descrever_modelo())
+# A semente vale por comentário: cada sorteio começa de um gerador novo com
+# ela, e não do ponto em que o anterior deixou o gerador do explicador. Assim a
+# explicação de um texto não depende do que o processo explicou antes, e pode
+# ser reaproveitada para o mesmo texto (ver explicacoes_por_texto.py).
+SEMENTE_LIME = 42
 
 lime_explainer = LimeTextExplainer(
     class_names=['NEG', 'NEU', 'POS'],
-    random_state=42,
+    random_state=SEMENTE_LIME,
 )
 
 shap_masker = shap.maskers.Text(tokenizer=r"\W+")
 
 CLASSES = ('NEG', 'NEU', 'POS')
+POS_IDX = 2
+
+# Tamanho do lote e threads vêm, nesta ordem, da variável de ambiente, da
+# calibração gravada para esta máquina por `flask calibrar-inferencia`, ou do
+# padrão. Ver calibracao.py.
+_IMPRESSAO_DIGITAL = calibracao.impressao_digital(
+    f'{_configuracao._name_or_path}|{backend_de_inferencia.ESCOLHIDO}|{torch.__version__}'
+)
+_calibrado = calibracao.carregar(_IMPRESSAO_DIGITAL) or {}
 
-TAMANHO_DO_LOTE = int(os.environ.get('PREDICT_BATCH_SIZE', 64))
+
+def _parametro(variavel, chave, padrao):
+    """Valor de um parâmetro da inferência e de onde ele veio."""
+    if variavel in os.environ:
+        return int(os.environ[variavel]), 'ambiente'
+    if chave in _calibrado:
+        return int(_calibrado[chave]), 'autotune'
+    return padrao, 'padrao'
+
+
+TAMANHO_DO_LOTE, _ORIGEM_DO_LOTE = _parametro('PREDICT_BATCH_SIZE', 'tamanho_do_lote', 64)
 COMPRIMENTO_MAXIMO = 128
 
+# Quantos tokens, contando o padding, cabem numa passagem pelo modelo: linhas do
+# lote vezes o comprimento da maior. O padrão equivale aos 64 textos de antes com
+# 64 tokens cada, o meio da faixa que os comentários ocupam.
+ORCAMENTO_DE_TOKENS = int(os.environ.get('ORCAMENTO_DE_TOKENS', TAMANHO_DO_LOTE * 64))
+
 # O torch escolhe o número de threads olhando o host, não o contêiner. No Cloud
 # Run isso costuma resultar em uma única thread mesmo com vários vCPUs
 # disponíveis, e o LIME, que faz 5.000 passagens pelo modelo, executa em série.
 # Fixar explicitamente é o que garante o paralelismo pelo qual já estamos
 # pagando.
-_NUCLEOS = int(os.environ.get('TORCH_THREADS', os.cpu_count() or 1))
-torch.set_num_threads(_NUCLEOS)
+_NUCLEOS, _ORIGEM_DAS_THREADS = _parametro('TORCH_THREADS', 'threads', os.cpu_count() or 1)
 
-_modelo = sentiment_analyzer.model
-_tokenizador = sentiment_analyzer.tokenizer
-_dispositivo = next(_modelo.parameters()).device
+# Com o gunicorn em --preload, este módulo é importado no processo mestre e os
+# workers o herdam por fork (ver gunicorn.conf.py). O OpenMP do torch não
+# sobrevive a isso: um filho que herda um pool de threads já usado trava na
+# primeira passagem pelo modelo. Com uma thread só, o torch não abre região
+# paralela nenhuma, então o mestre faz o boot assim, e cada worker recebe a
+# sua parte dos núcleos depois do fork, em `apos_bifurcar`.
+SERA_BIFURCADO = os.environ.get('SERVIDOR_PRELOAD') == '1'
+torch.set_num_threads(1 if SERA_BIFURCADO else _NUCLEOS)
 
-logger.info(
-    'Inferência: %s núcleos visíveis, %s threads no torch, lote de %s, dispositivo %s',
-    os.cpu_count(), torch.get_num_threads(), TAMANHO_DO_LOTE, _dispositivo,
-)
+_tokenizador = sentiment_analyzer.tokenizer
 
 # A ordem das colunas vem do próprio modelo, não de uma constante nossa: se os
 # pesos mudarem o mapeamento, o índice acompanha em vez de trocar positivo por
 # negativo em silêncio.
 _COLUNAS = [
-    next(i for i, rotulo in _modelo.config.id2label.items() if rotulo.upper().startswith(classe))
+    next(i for i, rotulo in _configuracao.id2label.items() if rotulo.upper().startswith(classe))
     for classe in CLASSES
 ]
 
 
+def _codificar(textos):
+    """Tokeniza os textos uma vez, sem padding: uma codificação por texto."""
+    codificado = _tokenizador(
+        list(textos),
+        truncation=True,
+        max_length=COMPRIMENTO_MAXIMO,
+    )
+    return [{chave: valores[i] for chave, valores in codificado.items()}
+            for i in range(len(textos))]
+
+
+def _formar_lotes(comprimentos, orcamento=None):
+    """Índices agrupados em lotes que cabem no orçamento de tokens.
+
+    Sem `orcamento`, vale ORCAMENTO_DE_TOKENS. O custo de um lote é o número de linhas vezes o comprimento da maior, já
+    que o padding leva todas a ele. Em ordem crescente de comprimento, o
+    elemento que entra é sempre o maior do lote, então a conta é direta.
+    """
+    orcamento = orcamento or ORCAMENTO_DE_TOKENS
+    ordem = sorted(range(len(comprimentos)), key=lambda i: comprimentos[i])
+
+    lotes, atual = [], []
+    for i in ordem:
+        if atual and (len(atual) + 1) * comprimentos[i] > orcamento:
+            lotes.append(atual)
+            atual = []
+        atual.append(i)
+    if atual:
+        lotes.append(atual)
+    return lotes
+
+
+def _conferir(cancelamento):
+    """Levanta PedidoCancelado se quem pediu o cálculo já desistiu dele."""
+    if cancelamento is not None and cancelamento.is_set():
+        raise PedidoCancelado()
+
+
+class _QualquerSinal:
+    """Sinalizado quando qualquer um dos sinais dados está; os None não contam."""
+
+    __slots__ = ('sinais',)
+
+    def __init__(self, *sinais):
+        self.sinais = [sinal for sinal in sinais if sinal is not None]
+
+    def is_set(self):
+        return any(sinal.is_set() for sinal in self.sinais)
+
+
+# Toda passagem do servidor pelo modelo pede a vez aqui, pela faixa de quem a
+# pediu: o /analyze antes das explicações, e elas antes da varredura. Ver
+# escalonador_de_inferencia.py.
+_escalonador = EscalonadorDeInferencia()
+
+
 @torch.inference_mode()
-def _predict_proba(texts):
+def _inferir_codificados(codificacoes, backend, ao_concluir_lote=None, faixa=None,
+                         cancelamento=None, orcamento=None):
+    """Probabilidades [NEG, NEU, POS] de entradas já tokenizadas, na ordem recebida.
+
+    `ao_concluir_lote`, se dado, recebe os índices e as probabilidades de cada
+    lote assim que ele sai do modelo. Com `faixa`, cada lote espera a sua vez
+    no escalonador; sem ela, vai direto, o que só serve a quem tem o processo
+    para si, como a verificação de paridade e a calibração. Com `cancelamento`
+    sinalizado, levanta PedidoCancelado antes do lote seguinte. `orcamento`
+    troca ORCAMENTO_DE_TOKENS só nesta chamada, para a calibração.
+    """
+    saida = np.empty((len(codificacoes), len(CLASSES)))
+
+    # Agrupa entradas de comprimento parecido antes de formar os lotes. O padding
+    # leva todo o lote ao tamanho do maior elemento, e as perturbações do LIME
+    # vão de poucas palavras até o comentário inteiro. Em ordem aleatória quase
+    # todo lote contém uma perturbação longa, então até os textos curtos pagam o
+    # comprimento máximo. Ordenados, cada lote paga o próprio tamanho. A conta do
+    # modelo não muda: as posições de padding já eram anuladas pela máscara de
+    # atenção, e o resultado volta na ordem original em que os textos chegaram.
+    #
+    # O corte do lote é por tokens, não por quantidade de textos. Sessenta e
+    # quatro perturbações de cinco tokens e sessenta e quatro de cento e vinte e
+    # oito custavam o mesmo lote e trabalho muito diferente; pelo orçamento, as
+    # curtas vão em lotes grandes e as longas em lotes pequenos, e cada passagem
+    # fica perto do mesmo tamanho. O comprimento é o real, em tokens, e não o
+    # número de caracteres que a versão anterior usava como aproximação.
+    comprimentos = [len(c['input_ids']) for c in codificacoes]
+
+    for indices in _formar_lotes(comprimentos, orcamento):
+        _conferir(cancelamento)
+        entrada = _tokenizador.pad(
+            [codificacoes[i] for i in indices],
+            padding=True,
+            return_tensors='pt',
+        )
+
+        if faixa is None:
+            logits = backend.logits(entrada)
+        else:
+            with _escalonador.vez(faixa, len(indices)):
+                logits = backend.logits(entrada)
+        probabilidades = torch.softmax(logits, dim=-1).float().cpu().numpy()[:, _COLUNAS]
+        saida[indices] = probabilidades
+
+        if ao_concluir_lote is not None:
+            ao_concluir_lote(indices, probabilidades)
+
+    return saida
+
+
+def _inferir(textos, backend, ao_concluir_lote=None, faixa=None, orcamento=None):
+    """Probabilidades [NEG, NEU, POS] dos textos, na ordem recebida, pelo backend dado.
+
+    Não descarta repetição nem consulta cache: isso é do _predict_proba. Existe
+    separado para que a verificação de paridade possa rodar o mesmo caminho
+    com a referência e com o backend escolhido. `ao_concluir_lote` recebe os
+    textos e as probabilidades de cada lote.
+    """
+    textos = list(textos)
+
+    def _repassar(indices, probabilidades):
+        ao_concluir_lote([textos[i] for i in indices], probabilidades)
+
+    return _inferir_codificados(
+        _codificar(textos), backend,
+        ao_concluir_lote=_repassar if ao_concluir_lote is not None else None, faixa=faixa,
+        orcamento=orcamento,
+    )
+
+
+def concordancia_top(a, b, k=10):
+    """Fração das k palavras de maior peso absoluto que as duas explicações têm em comum.
+
+    1,0 quando os dois destaques coincidem, 0,0 quando não têm palavra
+    nenhuma em comum. Com menos de k palavras, compara o que houver.
+    """
+    def _topo(pesos):
+        return {p for p, _ in sorted(pesos.items(), key=lambda x: abs(x[1]), reverse=True)[:k]}
+
+    topo_a, topo_b = _topo(a or {}), _topo(b or {})
+    if not topo_a and not topo_b:
+        return 1.0
+    return len(topo_a & topo_b) / max(len(topo_a), len(topo_b))
+
+
+# Comentários fixos para comparar um backend com a referência. Cobrem os três
+# sentimentos, negação, e comprimentos do curtíssimo ao perto do limite da tela.
+CORPUS_DE_PARIDADE = (
+    'Gostei.',
+    'A aula foi boa e consegui acompanhar.',
+    'Não entendi nada, estou perdido e desmotivado.',
+    'Aula mediana. Alguns pontos ficaram confusos, mas vou rever o material.',
+    'O professor explicou muito bem e o ambiente foi acolhedor.',
+    'As tarefas estão muito difíceis e já estou atrasado em várias delas.',
+    'Não achei ruim, mas também não foi a melhor aula do semestre.',
+    'Achei a aula proveitosa, ainda que alguns trechos tenham ficado corridos. '
+    'Consegui acompanhar o raciocínio e sair com uma ideia clara do assunto.',
+    'A disciplina tem um ritmo bom e o professor explica com clareza, mas sinto '
+    'que a parte prática poderia ter mais tempo em sala. Consigo acompanhar o '
+    'conteúdo teórico sem dificuldade, porém, quando chega o momento de aplicar, '
+    'percebo que faltou repetição para fixar o que foi visto nas aulas anteriores.',
+)
+
+# Tolerâncias do backend escolhido diante da referência. A diferença é a maior
+# entre quaisquer probabilidades do corpus. A concordância é a das dez palavras
+# mais importantes do LIME, nos comentários com mais de uma palavra.
+PARIDADE_MAX_DIFERENCA = float(os.environ.get('PARIDADE_MAX_DIFERENCA', 0.02))
+PARIDADE_MIN_CONCORDANCIA = float(os.environ.get('PARIDADE_MIN_CONCORDANCIA', 0.8))
+
+# Amostras do LIME na verificação. Menos que as 5.000 da explicação real, para o
+# boot não levar minutos; as duas execuções usam o mesmo sorteio, então a
+# comparação continua justa.
+PARIDADE_AMOSTRAS_LIME = int(os.environ.get('PARIDADE_AMOSTRAS_LIME', 1000))
+
+
+def _verificar_paridade(referencia, candidato):
+    """Recusa o backend que se afasta demais da referência em fp32.
+
+    int8, bf16 e ONNX trocam exatidão por memória e velocidade. Quanto se perde
+    depende do modelo, e um backend que inverta o sentimento de um comentário,
+    ou que mude as palavras destacadas, produziria resultados que não são mais
+    os do modelo descrito no artigo. Por isso a verificação falha o boot em vez
+    de só registrar um aviso.
+    """
+    textos = list(CORPUS_DE_PARIDADE)
+    diferenca = float(np.max(np.abs(_inferir(textos, referencia) - _inferir(textos, candidato))))
+
+    def _lime(backend, texto):
+        def _classificar(perturbacoes):
+            distintos = list(dict.fromkeys(perturbacoes))
+            probabilidades = dict(zip(distintos, _inferir(distintos, backend)))
+            return np.array([probabilidades[p] for p in perturbacoes])
+
+        explicador = LimeTextExplainer(class_names=list(CLASSES), random_state=SEMENTE_LIME)
+        exp = explicador.explain_instance(
+            texto, _classificar, labels=[POS_IDX], num_features=10,
+            num_samples=PARIDADE_AMOSTRAS_LIME,
+        )
+        return dict(exp.as_list(label=POS_IDX))
+
+    concordancias = [
+        concordancia_top(_lime(referencia, texto), _lime(candidato, texto))
+        for texto in textos[1:4]
+    ]
+    concordancia = min(concordancias)
+
+    logger.info(
+        'Paridade do backend %s: diferença máxima %.4g, concordância mínima do LIME %.2f',
+        candidato.nome, diferenca, concordancia,
+    )
+
+    if diferenca > PARIDADE_MAX_DIFERENCA or concordancia < PARIDADE_MIN_CONCORDANCIA:
+        raise RuntimeError(
+            f'O backend {candidato.nome} diverge da referência em fp32 além do tolerado: '
+            f'diferença máxima {diferenca:.4g} (teto {PARIDADE_MAX_DIFERENCA}), '
+            f'concordância do LIME {concordancia:.2f} (piso {PARIDADE_MIN_CONCORDANCIA}). '
+            f'Use BACKEND_INFERENCIA={backend_de_inferencia.REFERENCIA} ou ajuste as tolerâncias.'
+        )
+
+
+_backend = backend_de_inferencia.carregar(
+    backend_de_inferencia.ESCOLHIDO, sentiment_analyzer.model, _tokenizador,
+)
+
+if _backend.nome != backend_de_inferencia.REFERENCIA:
+    _verificar_paridade(
+        backend_de_inferencia.carregar(
+            backend_de_inferencia.REFERENCIA, sentiment_analyzer.model, _tokenizador,
+        ),
+        _backend,
+    )
+    # Aprovado o backend, a referência em fp32 deixa de ser usada. Soltá-la é o
+    # que devolve a memória que motivou a troca.
+    sentiment_analyzer.model = getattr(_backend, 'modelo', None)
+
+_dispositivo = _backend.dispositivo
+
+
+def _medir_configuracao(textos, lote, threads):
+    """Textos por segundo inferidos com este lote e estas threads, sem o cache.
+
+    O orçamento em teste vai só nas chamadas da medida: os lotes que a fila
+    estiver servindo a outras threads seguem com ORCAMENTO_DE_TOKENS.
+    """
+    threads_antes = torch.get_num_threads()
+    torch.set_num_threads(threads)
+    try:
+        _inferir(textos[:lote], _backend, orcamento=lote * 64)   # aquece com a configuração nova
+        inicio = time.perf_counter()
+        _inferir(textos, _backend, orcamento=lote * 64)
+        return len(textos) / (time.perf_counter() - inicio)
+    finally:
+        torch.set_num_threads(threads_antes)
+
+
+def calibrar_inferencia(lotes=calibracao.LOTES, threads=None, gravar=True):
+    """Mede a grade de lotes e threads nesta máquina e grava a mais rápida.
+
+    Devolve (melhor, tabela). A calibração vale a partir do próximo boot; quem
+    chama no boot aplica o resultado logo em seguida.
+    """
+    textos = calibracao.textos_de_calibracao()
+    melhor, tabela = calibracao.calibrar(
+        lambda lote, n: _medir_configuracao(textos, lote, n), lotes, threads,
+    )
+    if gravar:
+        calibracao.gravar(_IMPRESSAO_DIGITAL, melhor)
+        logger.info('Calibração gravada em %s: %s', calibracao.ARQUIVO, melhor)
+    return melhor, tabela
+
+
+if calibracao.CALIBRAR_NO_BOOT and not _calibrado and SERA_BIFURCADO:
+    # Medir usaria todas as threads no mestre, justamente o que não pode
+    # acontecer antes do fork.
+    logger.warning('CALIBRAR_NO_BOOT ignorado com --preload; rode flask calibrar-inferencia.')
+elif calibracao.CALIBRAR_NO_BOOT and not _calibrado:
+    _calibrado, _ = calibrar_inferencia()
+    TAMANHO_DO_LOTE, _ORIGEM_DO_LOTE = _parametro('PREDICT_BATCH_SIZE', 'tamanho_do_lote', 64)
+    ORCAMENTO_DE_TOKENS = int(os.environ.get('ORCAMENTO_DE_TOKENS', TAMANHO_DO_LOTE * 64))
+    _NUCLEOS, _ORIGEM_DAS_THREADS = _parametro('TORCH_THREADS', 'threads', os.cpu_count() or 1)
+    torch.set_num_threads(_NUCLEOS)
+
+
+def preparar_para_bifurcar():
+    """Deixa o modelo pronto para ser compartilhado com processos filhos por fork.
+
+    Depois do fork, pai e filhos enxergam as mesmas páginas de memória até
+    alguém escrever nelas. Os pesos só são lidos na inferência, mas o autograd
+    escreve: um parâmetro com requires_grad ganha acumuladores e versões a cada
+    passagem fora do inference_mode. Sem gradiente em parte alguma, as páginas
+    dos tensores continuam sendo as do pai, e N filhos custam perto de um
+    modelo só.
+
+    O congelamento do coletor de lixo vai na mesma direção: a cada coleta, o
+    Python escreve no cabeçalho de todo objeto rastreado, e cada escrita copia
+    a página inteira para o filho. Congelados, os objetos já carregados ficam
+    fora das coletas. A contagem de referências continua mexendo nos
+    cabeçalhos dos objetos que o filho usa, mas esses são poucos e pequenos; os
+    dados dos tensores ficam em outra área, que ninguém toca.
+    """
+    import gc
+
+    modelo = getattr(_backend, 'modelo', None)
+    if modelo is not None:
+        modelo.eval()
+        for parametro in modelo.parameters():
+            parametro.requires_grad_(False)
+    torch.set_grad_enabled(False)
+
+    gc.collect()
+    gc.freeze()
+
+
+def threads_por_processo(processos):
+    """Threads do torch de cada um de `processos` processos bifurcados deste."""
+    return max(1, _NUCLEOS // processos)
+
+
+def apos_bifurcar(processos):
+    """No processo filho, depois do fork: a sua parte dos núcleos no torch."""
+    threads = threads_por_processo(processos)
+    torch.set_num_threads(threads)
+    logger.info('Processo %s: %s thread(s) do torch, pesos %s.',
+                os.getpid(), threads, ORIGEM_DOS_PESOS)
+
+
+def aquecer():
+    """Uma passagem de verdade pelo modelo, fora do cache; devolve os segundos.
+
+    A primeira inferência de um processo é bem mais lenta que as seguintes: o
+    torch escolhe os kernels, o alocador reserva os buffers e o pool de threads
+    sobe. Melhor que isso aconteça antes de o processo se dizer pronto do que na
+    primeira análise de um aluno.
+    """
+    inicio = time.perf_counter()
+    _inferir(['A aula de hoje foi boa e consegui acompanhar.'], _backend, faixa=VARREDURA)
+    return time.perf_counter() - inicio
+
+
+logger.info("Modelo de sentimento carregado: %s", descrever_modelo())
+logger.info(
+    'Inferência: %s núcleos visíveis, %s disponíveis, %s threads no torch (%s), '
+    'lote de %s textos (%s) e %s tokens, dispositivo %s, backend %s, pesos %s',
+    os.cpu_count(), calibracao.nucleos_disponiveis(), torch.get_num_threads(),
+    _ORIGEM_DAS_THREADS, TAMANHO_DO_LOTE, _ORIGEM_DO_LOTE, ORCAMENTO_DE_TOKENS,
+    _dispositivo, _backend.nome, ORIGEM_DOS_PESOS,
+)
+
+# A identidade do modelo entra na chave de cada entrada: trocar os pesos, o
+# backend ou a versão das bibliotecas invalida o que foi calculado antes, em vez
+# de servir probabilidades de outro modelo. Ver cache_de_predicoes.py. Os
+# artefatos das explicações usam a mesma, resumida. Ver artefatos.py.
+_IDENTIDADE = json.dumps(descrever_modelo(), sort_keys=True)
+IDENTIDADE_DO_MODELO = hashlib.sha256(_IDENTIDADE.encode('utf-8')).hexdigest()[:16]
+_cache = (
+    cache_de_predicoes.CacheDePredicoes(_IDENTIDADE)
+    if cache_de_predicoes.LIGADO else None
+)
+
+
+def _predict_proba(texts, faixa=ANALISE):
     """Probabilidades [NEG, NEU, POS] para uma lista de textos.
 
     Chama o tokenizador e o modelo diretamente em vez de sentiment_analyzer
@@ -109,52 +512,267 @@ def _predict_proba(texts):
     # trabalho é repetição pura. Com 5 palavras chega a 99%.
     #
     # Texto igual produz saída igual, então calcular uma vez e copiar o
-    # resultado para as posições repetidas é exato, e não aproximação.
+    # resultado para as posições repetidas é exato, e não aproximação. É o
+    # mesmo argumento que sustenta o cache entre chamadas, logo abaixo.
     posicoes_por_texto = {}
     for i, texto in enumerate(textos):
         posicoes_por_texto.setdefault(texto, []).append(i)
-    distintos = list(posicoes_por_texto)
-
-    # Agrupa textos de comprimento parecido antes de formar os lotes. O padding
-    # leva todo o lote ao tamanho do maior elemento, e as perturbações do LIME
-    # vão de poucas palavras até o comentário inteiro. Em ordem aleatória quase
-    # todo lote contém uma perturbação longa, então até os textos curtos pagam o
-    # comprimento máximo. Ordenados, cada lote paga o próprio tamanho. A conta do
-    # modelo não muda: as posições de padding já eram anuladas pela máscara de
-    # atenção, e o resultado volta na ordem original em que os textos chegaram.
-    ordem = sorted(range(len(distintos)), key=lambda i: len(distintos[i]))
 
     saida = np.empty((len(textos), len(CLASSES)))
-    for inicio in range(0, len(ordem), TAMANHO_DO_LOTE):
-        indices = ordem[inicio:inicio + TAMANHO_DO_LOTE]
 
-        entrada = _tokenizador(
-            [distintos[i] for i in indices],
-            return_tensors='pt',
-            padding=True,
-            truncation=True,
-            max_length=COMPRIMENTO_MAXIMO,
-        ).to(_dispositivo)
+    # O que já foi calculado em outra chamada não passa de novo pelo modelo: o
+    # SHAP repete boa parte das perturbações que o LIME acabou de inferir, e o
+    # mesmo comentário volta no calcular-explicacoes e no seeder.
+    conhecidas = _cache.buscar(list(posicoes_por_texto)) if _cache is not None else {}
+    for texto, probabilidades in conhecidas.items():
+        saida[posicoes_por_texto[texto]] = probabilidades
+    distintos = [texto for texto in posicoes_por_texto if texto not in conhecidas]
 
-        logits = _modelo(**entrada).logits
-        probabilidades = torch.softmax(logits, dim=-1).float().cpu().numpy()[:, _COLUNAS]
+    if distintos:
+        # Gravado a cada lote, e não no fim: se a chamada for interrompida no
+        # meio, o que já saiu do modelo fica aproveitado na próxima tentativa.
+        saida_distintos = _inferir(
+            distintos, _backend,
+            ao_concluir_lote=_cache.guardar if _cache is not None else None, faixa=faixa,
+        )
+        for texto, probabilidades in zip(distintos, saida_distintos):
+            saida[posicoes_por_texto[texto]] = probabilidades
 
-        for linha, i in enumerate(indices):
-            saida[posicoes_por_texto[distintos[i]]] = probabilidades[linha]
+    return saida
+
+
+def _chave_de_ids(ids):
+    """Chave do cache para uma entrada montada direto em tokens, sem texto."""
+    return b'ids\0' + np.asarray(ids, dtype=np.int32).tobytes()
+
+
+def _predict_proba_codificados(codificacoes, faixa=EXPLICACAO, cancelamento=None):
+    """Como o _predict_proba, para entradas já tokenizadas.
+
+    Serve ao LIME por máscaras, que monta a entrada do modelo sem passar por
+    texto. O cache é o mesmo, com a sequência de tokens no lugar do texto.
+    """
+    saida = np.empty((len(codificacoes), len(CLASSES)))
+    if not codificacoes:
+        return saida
+
+    # Entrada repetida sai uma vez só, como texto repetido no _predict_proba.
+    # As máscaras do LIME já chegam distintas; as coalizões do SHAP, não.
+    posicoes_por_chave = {}
+    for i, c in enumerate(codificacoes):
+        posicoes_por_chave.setdefault(_chave_de_ids(c['input_ids']), []).append(i)
+    chaves = list(posicoes_por_chave)
+    conhecidas = _cache.buscar(chaves) if _cache is not None else {}
+
+    faltando = []
+    for chave in chaves:
+        if chave in conhecidas:
+            saida[posicoes_por_chave[chave]] = conhecidas[chave]
+        else:
+            faltando.append(chave)
+
+    if faltando:
+        def _guardar(indices, probabilidades):
+            _cache.guardar([faltando[i] for i in indices], probabilidades)
+
+        calculadas = _inferir_codificados(
+            [codificacoes[posicoes_por_chave[chave][0]] for chave in faltando], _backend,
+            ao_concluir_lote=_guardar if _cache is not None else None, faixa=faixa,
+            cancelamento=cancelamento,
+        )
+        for chave, probabilidades in zip(faltando, calculadas):
+            saida[posicoes_por_chave[chave]] = probabilidades
 
     return saida
 
-shap_explainer = shap.Explainer(
-    _predict_proba,
-    shap_masker,
-    output_names=['NEG', 'NEU', 'POS'],
+
+def estatisticas_do_cache():
+    """Acertos e ocupação do cache de predições, ou None se estiver desligado."""
+    return _cache.estatisticas() if _cache is not None else None
+
+
+# O LIME e o SHAP de uma explicação rodam ao mesmo tempo e mandam as passagens
+# pelo modelo para esta fila, que as junta em lotes de TAMANHO_DO_LOTE entradas.
+# O SHAP, sozinho, chama o modelo com poucas coalizões por vez; aqui elas
+# completam os lotes das máscaras do LIME, e explicações de feedbacks
+# diferentes também dividem os lotes entre si. Com espera zero, cada
+# explicador vai direto ao modelo.
+ESPERA_DA_EXPLICACAO = float(os.environ.get('EXPLICACAO_ESPERA_MS', 2)) / 1000
+
+#
+# A varredura tem a sua própria fila, com a mesma espera, para que as passagens
+# dela cheguem ao escalonador pela faixa de baixo: explicações de alunos e
+# varredura não dividem lote.
+_filas_de_explicacao = {
+    faixa: FilaDeInferencia(
+        partial(_predict_proba_codificados, faixa=faixa), TAMANHO_DO_LOTE,
+        ESPERA_DA_EXPLICACAO, nome=faixa,
+    )
+    for faixa in (EXPLICACAO, VARREDURA)
+}
+
+
+def _prever_explicacao(codificacoes, faixa=EXPLICACAO, cancelamento=None):
+    """Probabilidades das entradas de um explicador, pela fila compartilhada da faixa.
+
+    Entrada repetida vai uma vez só, mesmo que as repetições caíssem em lotes
+    diferentes da fila. As distintas vão ordenadas por comprimento, para que
+    cada lote tenha pouco padding, e as linhas voltam na ordem pedida.
+    """
+    if ESPERA_DA_EXPLICACAO <= 0:
+        return _predict_proba_codificados(codificacoes, faixa, cancelamento)
+
+    posicoes_por_chave = {}
+    for i, c in enumerate(codificacoes):
+        posicoes_por_chave.setdefault(_chave_de_ids(c['input_ids']), []).append(i)
+    distintas = [codificacoes[posicoes[0]] for posicoes in posicoes_por_chave.values()]
+
+    ordem = np.argsort([len(c['input_ids']) for c in distintas], kind='stable')
+    calculadas = np.empty((len(distintas), len(CLASSES)))
+    calculadas[ordem] = _filas_de_explicacao[faixa].prever(
+        [distintas[i] for i in ordem], cancelamento,
+    )
+
+    saida = np.empty((len(codificacoes), len(CLASSES)))
+    for posicoes, probabilidades in zip(posicoes_por_chave.values(), calculadas):
+        saida[posicoes] = probabilidades
+    return saida
+
+
+def _prever_textos_da_explicacao(textos, faixa=EXPLICACAO, cancelamento=None):
+    return _prever_explicacao(_codificar(list(textos)), faixa, cancelamento)
+
+
+# Orçamento do SHAP por comentário, em avaliações do modelo.
+#
+# Até SHAP_EXATO_ATE tokens, os valores de Shapley são calculados exatamente,
+# avaliando todas as 2^n coalizões: 1.024 textos mascarados com o padrão, menos
+# do que o LIME infere no mesmo comentário. Acima disso, o Partition explainer
+# recebe SHAP_AVALIACOES_POR_TOKEN avaliações por token, até SHAP_MAX_AVALIACOES.
+# O fator cobre a árvore inteira dos comentários de até uns 30 tokens e deixa os
+# longos com mais do que as 500 fixas de antes, proporcionalmente ao tamanho.
+SHAP_EXATO_ATE = int(os.environ.get('SHAP_EXATO_ATE', 10))
+SHAP_AVALIACOES_POR_TOKEN = int(os.environ.get('SHAP_AVALIACOES_POR_TOKEN', 20))
+SHAP_MAX_AVALIACOES = int(os.environ.get('SHAP_MAX_AVALIACOES', 2000))
+
+SHAP_EXATO = 'exato'
+SHAP_PARTICAO = 'particao'
+
+
+def orcamento_shap(texto):
+    """(modo, avaliações) que `explain_sentiment_shap` usa para este texto."""
+    tokens = shap_masker.shape(texto)[1]
+    if tokens <= SHAP_EXATO_ATE:
+        return SHAP_EXATO, 2 ** tokens
+    return SHAP_PARTICAO, min(SHAP_MAX_AVALIACOES, SHAP_AVALIACOES_POR_TOKEN * tokens)
+
+
+def _coalizoes_shap(texto):
+    """Tokens, máscaras e textos de todas as coalizões de um comentário.
+
+    A coalizão de código c mantém o token i quando o bit i de c está ligado, e o
+    texto de cada uma é o que o próprio mascarador do SHAP produziria.
+    """
+    tokens = list(shap_masker.data_transform(texto)[0])
+    codigos = np.arange(2 ** len(tokens))
+    mascaras = ((codigos[:, None] >> np.arange(len(tokens))) & 1).astype(bool)
+    textos = [shap_masker(mascara, texto)[0][0] for mascara in mascaras]
+    return tokens, mascaras, textos
+
+
+def _valores_de_shapley(mascaras, saida):
+    """Valores exatos a partir da saída de cada coalizão, na ordem dos códigos.
+
+    O valor do token i é a média ponderada da contribuição marginal
+    f(S ∪ {i}) − f(S) sobre todo S sem i, com o peso |S|! (n − |S| − 1)! / n!
+    da definição.
+    """
+    n = mascaras.shape[1]
+    codigos = np.arange(len(mascaras))
+    tamanhos = mascaras.sum(axis=1)
+    peso = np.array([
+        math.factorial(k) * math.factorial(n - k - 1) / math.factorial(n) for k in range(n)
+    ])
+
+    valores = np.empty(n)
+    for i in range(n):
+        com_i = codigos[mascaras[:, i]]
+        valores[i] = np.sum(peso[tamanhos[com_i] - 1] * (saida[com_i] - saida[com_i ^ (1 << i)]))
+    return valores
+
+
+def _shap_exato(texto):
+    """Tokens e valores de Shapley exatos da classe positiva, por todas as coalizões."""
+    tokens, mascaras, textos = _coalizoes_shap(texto)
+    saida = _prever_textos_da_explicacao(textos)[:, POS_IDX]
+    return tokens, _valores_de_shapley(mascaras, saida), len(textos)
+
+
+def _shap_particao(texto, max_evals, faixa=EXPLICACAO, cancelamento=None):
+    """Tokens e valores do Partition explainer, com o orçamento dado e a contagem real."""
+    avaliacoes = 0
+
+    def _contando(textos):
+        nonlocal avaliacoes
+        avaliacoes += len(textos)
+        return _prever_textos_da_explicacao(textos, faixa, cancelamento)
+
+    # Um explicador por chamada, para que a contagem seja só deste comentário
+    # mesmo com outras requisições calculando SHAP ao mesmo tempo. O batch_size
+    # da biblioteca é 10; com o do app, cada rodada da árvore manda ao modelo
+    # tudo o que já sabe que vai precisar.
+    explicador = shap.Explainer(_contando, shap_masker, output_names=list(CLASSES))
+    shap_values = explicador([texto], max_evals=max_evals, batch_size=TAMANHO_DO_LOTE)
+    return shap_values.data[0], shap_values.values[0, :, POS_IDX], avaliacoes
+
+
+# Envios simultâneos do /analyze dividem uma passagem pelo modelo em vez de
+# pagar uma cada. A espera é o quanto o primeiro pedido aguarda companhia; com
+# zero, cada envio vai direto ao modelo, como antes. Ver fila_de_inferencia.py.
+ESPERA_DA_ANALISE = float(os.environ.get('ANALISE_ESPERA_MS', 5)) / 1000
+LOTE_DA_ANALISE = int(os.environ.get('ANALISE_LOTE_MAXIMO', 32))
+
+_fila_de_analises = FilaDeInferencia(
+    _predict_proba, LOTE_DA_ANALISE, ESPERA_DA_ANALISE, nome='analise',
 )
 
+
+def estatisticas_da_fila():
+    """Espera na fila e tamanho dos lotes do /analyze desde o início do processo."""
+    return _fila_de_analises.estatisticas()
+
+
+def estatisticas_da_fila_de_explicacoes():
+    """O mesmo, para a fila que o LIME e o SHAP dividem."""
+    return _filas_de_explicacao[EXPLICACAO].estatisticas()
+
+
+def estatisticas_da_inferencia():
+    """Filas, escalonador e cache juntos: quanto cada faixa esperou e quanto passou."""
+    return {
+        'escalonador': _escalonador.estatisticas(),
+        'filas': [
+            _fila_de_analises.estatisticas(),
+            *(fila.estatisticas() for fila in _filas_de_explicacao.values()),
+        ],
+        'cache': estatisticas_do_cache(),
+    }
+
+
 def analyze_sentiment_text(text: str) -> dict:
     if not isinstance(text, str) or not text.strip():
         return None
 
-    neg, neu, pos = (float(v) for v in _predict_proba([text])[0])
+    # Cada texto recebe a própria linha, calculada pelo mesmo _predict_proba de
+    # sempre. Dividir o lote com outros textos não muda a conta: o padding é
+    # anulado pela máscara de atenção, o mesmo argumento que já sustenta a
+    # ordenação por comprimento dentro de um lote.
+    if ESPERA_DA_ANALISE > 0:
+        probabilidades = _fila_de_analises.prever([text])[0]
+    else:
+        probabilidades = _predict_proba([text])[0]
+
+    neg, neu, pos = (float(v) for v in probabilidades)
 
     return {
         'compound': round(pos - neg, 4),
@@ -163,7 +781,153 @@ def analyze_sentiment_text(text: str) -> dict:
         'pos': round(pos, 4),
     }
 
-POS_IDX = 2
+
+NUM_AMOSTRAS_LIME = 5000
+NUM_PALAVRAS_LIME = 10
+
+# Até quantas palavras distintas o LIME enumera as máscaras em vez de sorteá-las.
+# Sortear custa uma passagem por máscara distinta sorteada, não por amostra: com
+# 5.000 amostras, cerca de 947 em 10 palavras, 1.515 em 11 e 2.078 em 12. O
+# padrão é o maior n cujas 2^n máscaras passam no máximo 10% disso, o preço
+# aceito pela exatidão: 10 para 5.000 (1.024 contra 947). Em 11 a enumeração já
+# custaria 35% a mais, e em 12 o dobro. Com 0, todo comentário é sorteado.
+_FOLGA_DA_ENUMERACAO = 1.1
+
+
+def _enumeracao_compensa_ate(amostras):
+    palavras = 0
+    while 2 ** (palavras + 1) <= _FOLGA_DA_ENUMERACAO * (
+        lime_por_mascaras.mascaras_distintas_esperadas(palavras + 1, amostras)
+    ):
+        palavras += 1
+    return palavras
+
+
+LIME_ENUMERACAO_ATE = int(os.environ.get(
+    'LIME_ENUMERACAO_ATE', _enumeracao_compensa_ate(NUM_AMOSTRAS_LIME),
+))
+
+LIME_AMOSTRAGEM = 'amostragem'
+LIME_ENUMERACAO = 'enumeracao'
+
+# Etapas intermediárias do LIME sorteado, em amostras. As 5.000 máscaras são
+# sorteadas de uma vez, como sempre, e as primeiras k linhas do sorteio são
+# uma amostra de k tão legítima quanto um sorteio de k: cada linha sai
+# independente das outras. As máscaras distintas vão ao modelo na ordem em que
+# aparecem no sorteio, e quando as das primeiras k linhas voltam, a regressão
+# dessas linhas dá os pesos da etapa. A última etapa é o sorteio inteiro, e o
+# resultado final é o mesmo de antes, com as mesmas máscaras e a mesma
+# regressão. A enumeração dos comentários curtos não tem etapas: é exata, e as
+# máscaras dela cabem em poucos segundos. Vazio desliga.
+LIME_ETAPAS = tuple(sorted({
+    int(amostras) for amostras in os.environ.get('LIME_ETAPAS', '500,1000,2500').split(',')
+    if amostras.strip() and 0 < int(amostras) < NUM_AMOSTRAS_LIME
+}))
+
+
+def modo_lime(texto):
+    """Como `explain_sentiment_lime` trata este texto: 'enumeracao' ou 'amostragem'.
+
+    É gravado com cada feedback para que uma explicação possa ser comparada
+    depois sabendo se veio do sorteio ou da conta exata.
+    """
+    palavras = lime_por_mascaras.indexar(lime_explainer, texto).num_words()
+    return LIME_ENUMERACAO if 0 < palavras <= LIME_ENUMERACAO_ATE else LIME_AMOSTRAGEM
+
+
+class _LimePreparado:
+    """O que o LIME de um comentário precisa do modelo, e o que fica para a regressão."""
+
+    __slots__ = ('indexado', 'dados', 'frequencias', 'inverso', 'entradas')
+
+    def __init__(self, indexado, dados, frequencias, inverso, entradas):
+        self.indexado = indexado
+        self.dados = dados
+        self.frequencias = frequencias
+        self.inverso = inverso
+        self.entradas = entradas
+
+
+def _preparar_lime(texto, explicador, num_samples, modo=LIME_AMOSTRAGEM, dados=None):
+    """Sorteia ou enumera as máscaras e monta a entrada do modelo de cada distinta.
+
+    Cada comentário sorteia com um gerador novo de semente SEMENTE_LIME: as
+    máscaras dependem só do texto, e não da ordem em que os comentários são
+    preparados.
+
+    `dados` são máscaras já sorteadas, as de um artefato gravado: com elas, não
+    há sorteio.
+    """
+    indexado = lime_por_mascaras.indexar(explicador, texto)
+    if modo == LIME_ENUMERACAO:
+        dados, frequencias = lime_por_mascaras.enumerar(indexado.num_words(), num_samples)
+        unicas, inverso = dados.astype(bool), np.arange(len(dados))
+    else:
+        if dados is None:
+            dados = lime_por_mascaras.sortear(
+                explicador, indexado, num_samples, np.random.RandomState(SEMENTE_LIME),
+            )
+        frequencias = None
+        unicas, inverso = lime_por_mascaras.distintas(dados)
+
+    alinhamento = lime_por_mascaras.alinhar(_tokenizador, indexado, COMPRIMENTO_MAXIMO)
+    if alinhamento is not None:
+        entradas = [alinhamento.codificacao(mascara) for mascara in unicas]
+    else:
+        # O tokenizador não separa este comentário palavra por palavra. As
+        # máscaras continuam sem repetição; só a tokenização volta a ser por
+        # texto.
+        entradas = _codificar(
+            [lime_por_mascaras.texto_da_mascara(indexado, mascara) for mascara in unicas]
+        )
+
+    logger.debug(
+        'lime por mascaras: %s palavras, %s, %s mascaras distintas, %s',
+        indexado.num_words(), modo, len(unicas),
+        'tokens montados' if alinhamento is not None else 'textos tokenizados',
+    )
+    return _LimePreparado(indexado, dados, frequencias, inverso, entradas)
+
+
+def _concluir_lime(preparado, explicador, probabilidades, num_features):
+    """A regressão do LIME, com as probabilidades das entradas preparadas."""
+    return lime_por_mascaras.ajustar(
+        explicador, preparado.indexado, preparado.dados, probabilidades[preparado.inverso],
+        POS_IDX, num_features, frequencias=preparado.frequencias,
+    )
+
+
+def _etapas_do_lime(preparado):
+    """[(amostras, máscaras distintas de que a etapa precisa)] de um LIME sorteado."""
+    if preparado.frequencias is not None:
+        return []
+    amostras = len(preparado.inverso)
+    primeira = np.full(len(preparado.entradas), amostras)
+    np.minimum.at(primeira, preparado.inverso, np.arange(amostras))
+    return [(k, np.flatnonzero(primeira < k)) for k in LIME_ETAPAS if k < amostras]
+
+
+def _lime_da_etapa(preparado, explicador, probabilidades, amostras, num_features):
+    """A regressão do LIME só com as primeiras `amostras` linhas do sorteio."""
+    return lime_por_mascaras.ajustar(
+        explicador, preparado.indexado, preparado.dados[:amostras],
+        probabilidades[preparado.inverso[:amostras]], POS_IDX, num_features,
+    )
+
+
+def _lime_por_mascaras(texto, explicador, num_samples, num_features, modo=LIME_AMOSTRAGEM):
+    """Pesos (palavra, peso) do LIME para a classe positiva, pelo caminho das máscaras.
+
+    Na amostragem, equivale a `explicador.explain_instance(...).as_list(label=POS_IDX)`,
+    com o mesmo sorteio e a mesma regressão, sem montar as strings repetidas.
+    Na enumeração, cada máscara possível entra uma vez, ponderada pela
+    frequência que teria no sorteio. Ver lime_por_mascaras.py.
+    """
+    preparado = _preparar_lime(texto, explicador, num_samples, modo)
+    return _concluir_lime(
+        preparado, explicador, _prever_explicacao(preparado.entradas), num_features,
+    )
+
 
 def explain_sentiment_lime(text: str) -> dict:
     if not isinstance(text, str) or not text.strip():
@@ -174,15 +938,21 @@ def explain_sentiment_lime(text: str) -> dict:
     # demonstrado por Mardaoui & Garreau (2021, AISTATS); reduzir esse valor
     # compromete a estabilidade das explicações (Visani et al., 2022; Zhao et al., 2021).
     # num_features=10 segue K=10 dos experimentos originais com texto em Ribeiro et al. (2016).
-    exp = lime_explainer.explain_instance(
-        text,
-        _predict_proba,
-        labels=[POS_IDX],
-        num_features=10,
-        num_samples=5000,
-    )
+    #
+    # O cálculo é o do explain_instance, feito sobre as máscaras de palavras:
+    # as amostras repetidas não viram string nem passam pelo tokenizador.
+    #
+    # Comentário curto não é sorteado. Com 5 palavras, 99% das 5.000 amostras
+    # repetem uma das 31 máscaras possíveis; enumerá-las, cada uma com o peso
+    # que teria no sorteio, dá o valor esperado que as amostras aproximam, sem
+    # o ruído e com menos passagens pelo modelo.
+    return _normalizar_lime(_lime_por_mascaras(
+        text, lime_explainer, NUM_AMOSTRAS_LIME, NUM_PALAVRAS_LIME, modo=modo_lime(text),
+    ))
+
 
-    pesos = exp.as_list(label=POS_IDX)
+def _normalizar_lime(pesos):
+    """{palavra: peso} na escala da tela, a partir da lista (palavra, peso) do LIME."""
     if not pesos:
         return {}
 
@@ -212,21 +982,83 @@ def explain_sentiment_lime(text: str) -> dict:
 
     return {palavra: round(peso / maior, 4) for palavra, peso in combinados.items()}
 
+
+# Prévia do destaque, calculada no próprio /analyze.
+#
+# LIME e SHAP levam minutos e vão para a fila; até lá o aluno via o comentário
+# sem cor nenhuma. A prévia tira uma palavra por vez: o texto inteiro e, para
+# cada palavra, o texto sem ela, num lote só de n + 1 entradas pela faixa do
+# /analyze. O peso da palavra é quanto a probabilidade positiva cai sem ela.
+# Não há sorteio, e o texto inteiro já está no cache pela análise que acabou
+# de rodar: o custo real são n entradas numa passagem.
+#
+# As palavras são as do LIME, divididas pelo mesmo explicador e removidas com
+# todas as ocorrências, como numa máscara dele, e a normalização é a mesma. A
+# prévia e o LIME falam então das mesmas palavras, na mesma escala, e a
+# concordância entre os dois se mede direto (scripts/comparar_explicacoes.py
+# previa). A oclusão não vê a interação entre palavras que a regressão do LIME
+# pega, e por isso a tela a mostra como provisória até o LIME e o SHAP chegarem.
+#
+# Comentário com mais de PREVIA_MAX_PALAVRAS palavras distintas fica sem
+# prévia: o lote cresce com o texto, e o envio esperaria por ele.
+PREVIA_OCLUSAO = os.environ.get('PREVIA_OCLUSAO', '1').lower() not in ('0', 'false', 'nao', 'não')
+PREVIA_MAX_PALAVRAS = int(os.environ.get('PREVIA_MAX_PALAVRAS', 60))
+
+
+def previa_por_oclusao(text: str):
+    """{palavra: peso} da prévia, na escala do LIME, ou None quando não há prévia."""
+    if not PREVIA_OCLUSAO or not isinstance(text, str) or not text.strip():
+        return None
+
+    indexado = lime_por_mascaras.indexar(lime_explainer, text)
+    palavras = indexado.num_words()
+    if not 0 < palavras <= PREVIA_MAX_PALAVRAS:
+        return None
+
+    sem_uma = ~np.eye(palavras, dtype=bool)
+    textos = [text] + [lime_por_mascaras.texto_da_mascara(indexado, m) for m in sem_uma]
+    positiva = _predict_proba(textos)[:, POS_IDX]
+
+    # As NUM_PALAVRAS_LIME de maior peso, como o LIME entrega.
+    pesos = sorted(
+        ((indexado.word(i), float(positiva[0] - positiva[i + 1])) for i in range(palavras)),
+        key=lambda par: abs(par[1]), reverse=True,
+    )[:NUM_PALAVRAS_LIME]
+    return _normalizar_lime(pesos)
+
+
 def explain_sentiment_shap(text: str) -> dict:
     if not isinstance(text, str) or not text.strip():
         return {}
 
-    # max_evals fica no padrão ('auto'), que na biblioteca resolve para 500
+    # max_evals ficava no padrão ('auto'), que na biblioteca resolve para 500
     # avaliações. É um número fixo, e não uma quantidade ajustada ao tamanho do
-    # texto, como a documentação sugere à primeira leitura. É o que explica o
+    # texto, como a documentação sugere à primeira leitura. Era o que explicava o
     # SHAP ter custado cerca de 30 segundos tanto em um comentário de 288
     # caracteres quanto em um de 301, enquanto o LIME, esse sim proporcional ao
     # comprimento, variou de 115 a 200 segundos nas mesmas medições.
-    shap_values = shap_explainer([text])
+    #
+    # Agora o orçamento acompanha o texto. Comentário curto tem os valores de
+    # Shapley exatos, por enumeração das coalizões; o Partition explainer, que
+    # dá valores de Owen sobre a árvore de tokens, fica para os longos, com
+    # avaliações proporcionais ao número de tokens. Ver orcamento_shap.
+    modo, orcamento = orcamento_shap(text)
+    inicio = time.perf_counter()
+    if modo == SHAP_EXATO:
+        tokens, values, avaliacoes = _shap_exato(text)
+    else:
+        tokens, values, avaliacoes = _shap_particao(text, orcamento)
+
+    logger.info(
+        'shap %s: %s tokens, orcamento %s, %s avaliacoes, %.1fs',
+        modo, len(tokens), orcamento, avaliacoes, time.perf_counter() - inicio,
+    )
+
+    return _somar_por_palavra(tokens, values)
 
-    values = shap_values.values[0, :, POS_IDX]
-    tokens = shap_values.data[0]
 
+def _somar_por_palavra(tokens, values):
+    """{palavra: valor} a partir dos tokens do mascarador, somando as repetidas."""
     import re
     result = {}
     for token, val in zip(tokens, values):
@@ -239,95 +1071,377 @@ def explain_sentiment_shap(text: str) -> dict:
             result[clean] = float(val)
     return {k: round(v, 4) for k, v in result.items()}
 
-def create_feedback(student_id, subject_id, answers, additional_comment=None):
-    sentiment_scores = None
-    if additional_comment and additional_comment.strip():
-        sentiment_scores = analyze_sentiment_text(additional_comment)
-
-    new_feedback = Feedback(
-        student_id=student_id,
-        subject_id=subject_id,
-        active_participation=answers['active_participation'],
-        task_completion=answers['task_completion'],
-        motivation_interest=answers['motivation_interest'],
-        welcoming_environment=answers['welcoming_environment'],
-        comprehension_effort=answers['comprehension_effort'],
-        content_connection=answers['content_connection'],
-        additional_comment=additional_comment
+
+def explicar_em_paralelo(text):
+    """LIME e SHAP do mesmo texto, calculados ao mesmo tempo.
+
+    O SHAP roda numa thread própria enquanto o LIME ocupa a de quem chamou; as
+    passagens pelo modelo dos dois se encontram na fila de explicações. O tempo
+    total fica perto do maior dos dois, e não da soma.
+
+    Devolve {'lime': (pesos, erro, segundos), 'shap': (...)}. Uma técnica que
+    falha traz a exceção em `erro` e None nos pesos, sem derrubar a outra.
+    """
+    def _cronometrado(funcao):
+        inicio = time.perf_counter()
+        try:
+            return funcao(text), None, time.perf_counter() - inicio
+        except Exception as erro:
+            return None, erro, time.perf_counter() - inicio
+
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='shap') as executor:
+        shap_em_curso = executor.submit(_cronometrado, explain_sentiment_shap)
+        lime = _cronometrado(explain_sentiment_lime)
+        return {'lime': lime, 'shap': shap_em_curso.result()}
+
+
+# Pontos de retomada. Quando quem chama grava o progresso (`ao_registrar`), as
+# entradas em comum vão à fila em pedaços de PONTO_ENTRADAS, e a cada PONTO_S
+# segundos o estado de cada comentário é entregue para ser gravado. Sem quem
+# grave, vai tudo de uma vez, como antes. Ver artefatos.py.
+PONTO_ENTRADAS = max(1, int(os.environ.get('EXPLICACAO_PONTO_ENTRADAS', 1024)))
+PONTO_S = float(os.environ.get('EXPLICACAO_PONTO_S', 20))
+
+
+def explicar_em_lote(textos, faixa=EXPLICACAO, cancelamento=None, retomar=None,
+                     ao_registrar=None, ao_progredir=None, ao_etapa=None, cancelamentos=None):
+    """LIME e SHAP de vários comentários, com as passagens pelo modelo em comum.
+
+    Explicados um a um, os comentários curtos deixam os lotes quase vazios: têm
+    poucas centenas de máscaras distintas cada. Aqui as máscaras do LIME e as
+    coalizões exatas do SHAP de todos os comentários são geradas primeiro, na
+    ordem dos textos, e inferidas juntas, sem repetição entre comentários. Só
+    depois cada um volta para a própria regressão. O SHAP dos comentários
+    longos, que decide as avaliações seguintes pelas anteriores e não pode ser
+    gerado de antemão, roda em paralelo pela mesma fila.
+
+    O resultado de cada comentário é o mesmo de `explicar_em_paralelo`, em
+    qualquer ordem. Devolve uma lista, na ordem dos textos, de
+    {'lime': (pesos, erro, segundos), 'shap': (valores, erro, segundos)}. Os
+    segundos contam do começo da chamada até a técnica ficar pronta para
+    aquele comentário: a última das entradas dele de volta do modelo, mais a
+    regressão do LIME ou a soma do SHAP; no SHAP por partição, o fim da thread
+    dele. Passagens em comum não se dividem entre os comentários, e um
+    comentário curto num lote de longos espera por elas.
+
+    `faixa` é a do escalonador: EXPLICACAO quando um aluno espera pelo
+    resultado, VARREDURA quando ninguém espera.
+
+    `cancelamento`, um threading.Event, interrompe o lote inteiro: sinalizado,
+    nenhuma passagem nova vai ao modelo e a chamada levanta PedidoCancelado em
+    vez de devolver resultados parciais.
+
+    `cancelamentos`, na ordem dos textos, traz um sinal por comentário, ou
+    None; basta que tenha `is_set()`. Sinalizado o de um comentário, só ele
+    sai do lote: as entradas dele deixam os pedaços seguintes, o SHAP por
+    partição dele para na próxima passagem, e o resultado dele volta com
+    PedidoCancelado como erro nas duas técnicas. Os outros seguem.
+
+    `retomar`, na ordem dos textos, traz o estado gravado de cada comentário
+    numa tentativa anterior, ou None: as máscaras sorteadas são reusadas e o
+    que já tem probabilidade não volta ao modelo. `ao_registrar(posicao,
+    estado)` recebe o estado de cada comentário que avançou, de tempos em
+    tempos e no fim das passagens em comum, mesmo interrompidas. Os dois
+    seguem o formato de artefatos.py.
+
+    `ao_progredir(posicao, lime_percentual, shap_concluido)` recebe o
+    andamento de cada comentário que mudou, a cada pedaço de entradas que
+    volta do modelo e a cada SHAP por partição que termina (ver progresso.py).
+
+    `ao_etapa(posicao, amostras, pesos, estabilidade)` recebe os pesos
+    normalizados de cada etapa intermediária do LIME sorteado (ver
+    LIME_ETAPAS) assim que as máscaras dela voltam do modelo, com a
+    concordância das dez palavras de maior peso com a etapa anterior, ou None
+    na primeira. Com ela, as entradas vão ao modelo etapa por etapa, de todos
+    os comentários, e só depois o resto; o resultado final não muda.
+    """
+    inicio = time.perf_counter()
+    resultados = [{'lime': ({}, None, 0.0), 'shap': ({}, None, 0.0)} for _ in textos]
+
+    def _decorrido():
+        return time.perf_counter() - inicio
+    retomar = retomar or [None] * len(textos)
+    cancelamentos = cancelamentos or [None] * len(textos)
+
+    def _cancelado(posicao):
+        return cancelamentos[posicao] is not None and cancelamentos[posicao].is_set()
+
+    entradas = []
+    dono = []      # posição do comentário de cada entrada
+    limes = {}     # posição -> (preparado, início, fim) nas entradas
+    exatos = {}    # posição -> (tokens, máscaras, início, fim)
+    particoes = {}  # posição -> orçamento
+    gravadas = []  # (início, fim, probabilidades) vindas de `retomar`
+
+    for posicao, texto in enumerate(textos):
+        _conferir(cancelamento)
+        if not isinstance(texto, str) or not texto.strip() or _cancelado(posicao):
+            continue
+        gravado = retomar[posicao] or {}
+
+        try:
+            modo = modo_lime(texto)
+            retomado = (gravado.get('lime_modo') == modo
+                        and gravado.get('lime_amostras') == NUM_AMOSTRAS_LIME)
+            preparado = _preparar_lime(
+                texto, lime_explainer, NUM_AMOSTRAS_LIME, modo,
+                dados=gravado['lime_dados'] if retomado else None,
+            )
+            de, ate = len(entradas), len(entradas) + len(preparado.entradas)
+            limes[posicao] = (preparado, de, ate)
+            entradas.extend(preparado.entradas)
+            dono.extend([posicao] * (ate - de))
+            if retomado:
+                gravadas.append((de, ate, gravado['lime_probabilidades']))
+        except Exception as erro:
+            resultados[posicao]['lime'] = (None, erro, _decorrido())
+
+        try:
+            modo, orcamento = orcamento_shap(texto)
+            if modo == SHAP_EXATO:
+                tokens, mascaras, coalizoes = _coalizoes_shap(texto)
+                de, ate = len(entradas), len(entradas) + len(coalizoes)
+                exatos[posicao] = (tokens, mascaras, de, ate)
+                entradas.extend(_codificar(coalizoes))
+                dono.extend([posicao] * (ate - de))
+                if gravado.get('shap_probabilidades') is not None:
+                    gravadas.append((de, ate, gravado['shap_probabilidades']))
+            else:
+                particoes[posicao] = orcamento
+        except Exception as erro:
+            resultados[posicao]['shap'] = (None, erro, _decorrido())
+
+    dono = np.asarray(dono, dtype=int)
+    probabilidades = np.full((len(entradas), len(CLASSES)), np.nan)
+    for de, ate, anteriores in gravadas:
+        if len(anteriores) == ate - de:
+            probabilidades[de:ate] = anteriores
+    faltando = np.flatnonzero(np.isnan(probabilidades[:, 0]))
+    registradas = {}
+
+    # posição -> etapas que faltam entregar, e os pesos da última entregue.
+    etapas = {}
+    ordem = np.zeros(len(entradas), dtype=int)
+    if ao_etapa is not None and LIME_ETAPAS:
+        ordem[:] = len(LIME_ETAPAS)
+        for posicao, (preparado, de, ate) in limes.items():
+            etapas[posicao] = _etapas_do_lime(preparado)
+            for indice, (_, distintas) in reversed(list(enumerate(etapas[posicao]))):
+                ordem[de + distintas] = indice
+        faltando = faltando[np.argsort(ordem[faltando], kind='stable')]
+    pesos_da_etapa = {}
+
+    # (técnica, posição) -> segundos até a última entrada do comentário voltar.
+    entradas_prontas = {}
+
+    def _marcar_prontas():
+        agora = _decorrido()
+        faixas = [(('lime', posicao), de, ate) for posicao, (_, de, ate) in limes.items()]
+        faixas += [(('shap', posicao), de, ate) for posicao, (_, _, de, ate) in exatos.items()]
+        for chave, de, ate in faixas:
+            if chave not in entradas_prontas and not np.isnan(probabilidades[de:ate, 0]).any():
+                entradas_prontas[chave] = agora
+
+    def _entregar_etapas():
+        """Entrega a etapa mais avançada de cada comentário que completou uma."""
+        for posicao, pendentes in etapas.items():
+            if _cancelado(posicao):
+                continue
+            preparado, de, ate = limes[posicao]
+            prontas = []
+            while pendentes and not np.isnan(probabilidades[de + pendentes[0][1], 0]).any():
+                prontas.append(pendentes.pop(0)[0])
+            if not prontas:
+                continue
+            try:
+                anteriores = pesos_da_etapa.get(posicao)
+                for amostras in prontas:
+                    pesos = _normalizar_lime(_lime_da_etapa(
+                        preparado, lime_explainer, probabilidades[de:ate], amostras,
+                        NUM_PALAVRAS_LIME,
+                    ))
+                    estabilidade = (
+                        concordancia_top(anteriores, pesos) if anteriores is not None else None
+                    )
+                    anteriores = pesos
+                pesos_da_etapa[posicao] = pesos
+                ao_etapa(posicao, prontas[-1], pesos, estabilidade)
+            except Exception:
+                logger.exception('Etapa do LIME do comentário %s não entregue.', posicao)
+
+    def _registrar():
+        """Entrega o estado de cada comentário com probabilidades novas desde a última vez."""
+        for posicao in sorted(set(limes) | set(exatos)):
+            estado = {'texto': textos[posicao]}
+            if posicao in limes:
+                preparado, de, ate = limes[posicao]
+                estado.update(
+                    lime_modo=LIME_AMOSTRAGEM if preparado.frequencias is None else LIME_ENUMERACAO,
+                    lime_amostras=NUM_AMOSTRAS_LIME,
+                    lime_dados=preparado.dados,
+                    lime_probabilidades=probabilidades[de:ate],
+                )
+            if posicao in exatos:
+                _, _, de, ate = exatos[posicao]
+                estado['shap_probabilidades'] = probabilidades[de:ate]
+
+            calculadas = sum(
+                int(np.count_nonzero(~np.isnan(estado[chave][:, 0])))
+                for chave in ('lime_probabilidades', 'shap_probabilidades') if chave in estado
+            )
+            if registradas.get(posicao, 0) == calculadas:
+                continue
+            try:
+                ao_registrar(posicao, estado)
+                registradas[posicao] = calculadas
+            except Exception:
+                logger.exception('Ponto de retomada do comentário %s não registrado.', posicao)
+
+    avisados = {}
+
+    def _progredir():
+        """Entrega o andamento de cada comentário que mudou desde a última vez."""
+        for posicao in sorted(set(limes) | set(exatos) | set(particoes)):
+            if _cancelado(posicao):
+                continue
+            lime_percentual = None
+            if posicao in limes:
+                _, de, ate = limes[posicao]
+                feitas = int(np.count_nonzero(~np.isnan(probabilidades[de:ate, 0])))
+                lime_percentual = 100 * feitas // max(1, ate - de)
+            if posicao in exatos:
+                _, _, de, ate = exatos[posicao]
+                shap_concluido = not np.isnan(probabilidades[de:ate, 0]).any()
+            else:
+                shap_concluido = posicao not in particoes or em_curso[posicao].done()
+            andamento = (lime_percentual, shap_concluido)
+            if avisados.get(posicao) == andamento:
+                continue
+            avisados[posicao] = andamento
+            try:
+                ao_progredir(posicao, *andamento)
+            except Exception:
+                logger.exception('Andamento do comentário %s não avisado.', posicao)
+
+    def _shap_cronometrado(*args):
+        return _shap_particao(*args), _decorrido()
+
+    with ThreadPoolExecutor(max_workers=max(1, min(len(particoes), 4)),
+                            thread_name_prefix='shap') as executor:
+        em_curso = {
+            posicao: executor.submit(_shap_cronometrado, textos[posicao], orcamento, faixa,
+                                     _QualquerSinal(cancelamento, cancelamentos[posicao]))
+            for posicao, orcamento in particoes.items()
+        }
+
+        erro_comum = None
+        # Em pedaços só quando alguém acompanha ou pode desistir de um
+        # comentário; sem isso, vai tudo de uma vez.
+        acompanhado = any(f is not None for f in (ao_registrar, ao_progredir, ao_etapa,
+                                                  *cancelamentos))
+        passo = PONTO_ENTRADAS if acompanhado else max(1, len(faltando))
+        # Nenhum pedaço atravessa a fronteira de uma etapa: a etapa sai assim
+        # que as entradas dela voltam, sem esperar as da seguinte.
+        fronteiras = [0, *(np.flatnonzero(np.diff(ordem[faltando])) + 1), len(faltando)]
+        partes = [
+            faltando[comeco:min(comeco + passo, fim)]
+            for inicio_da_etapa, fim in zip(fronteiras, fronteiras[1:])
+            for comeco in range(inicio_da_etapa, fim, passo)
+        ]
+        ultimo_ponto = time.monotonic()
+        try:
+            if ao_progredir is not None:
+                _progredir()
+            _marcar_prontas()
+            _entregar_etapas()
+            for parte in partes:
+                # Um comentário cancelado deixa de mandar entradas a partir do
+                # pedaço seguinte; o pedaço que já estava no modelo termina.
+                ativos = np.array([not _cancelado(p) for p in range(len(textos))], dtype=bool)
+                parte = parte[ativos[dono[parte]]]
+                if not len(parte):
+                    continue
+                probabilidades[parte] = _prever_explicacao(
+                    [entradas[i] for i in parte], faixa, cancelamento,
+                )
+                _marcar_prontas()
+                _entregar_etapas()
+                if ao_progredir is not None:
+                    _progredir()
+                if ao_registrar is not None and time.monotonic() - ultimo_ponto >= PONTO_S:
+                    _registrar()
+                    ultimo_ponto = time.monotonic()
+        except PedidoCancelado:
+            # Sai do bloco, e o executor espera os SHAP em curso, que param na
+            # próxima passagem que pedirem.
+            raise
+        except Exception as erro:
+            erro_comum = erro
+        finally:
+            # Interrompido ou não, o que já passou pelo modelo fica gravado
+            # para a próxima tentativa.
+            if ao_registrar is not None:
+                _registrar()
+
+        for posicao, (preparado, de, ate) in limes.items():
+            if _cancelado(posicao):
+                continue
+            if erro_comum is not None:
+                resultados[posicao]['lime'] = (None, erro_comum, _decorrido())
+                continue
+            comeco = time.perf_counter()
+            try:
+                pesos = _concluir_lime(
+                    preparado, lime_explainer, probabilidades[de:ate], NUM_PALAVRAS_LIME,
+                )
+                resultados[posicao]['lime'] = (
+                    _normalizar_lime(pesos), None,
+                    entradas_prontas[('lime', posicao)] + time.perf_counter() - comeco,
+                )
+                if posicao in pesos_da_etapa:
+                    logger.info(
+                        'lime em etapas: comentario %s, concordancia top-10 da ultima etapa '
+                        'com o resultado final %.0f%%', posicao,
+                        100 * concordancia_top(pesos_da_etapa[posicao], resultados[posicao]['lime'][0]),
+                    )
+            except Exception as erro:
+                resultados[posicao]['lime'] = (None, erro, _decorrido())
+
+        for posicao, (tokens, mascaras, de, ate) in exatos.items():
+            if _cancelado(posicao):
+                continue
+            if erro_comum is not None:
+                resultados[posicao]['shap'] = (None, erro_comum, _decorrido())
+                continue
+            comeco = time.perf_counter()
+            valores = _valores_de_shapley(mascaras, probabilidades[de:ate, POS_IDX])
+            resultados[posicao]['shap'] = (
+                _somar_por_palavra(tokens, valores), None,
+                entradas_prontas[('shap', posicao)] + time.perf_counter() - comeco,
+            )
+
+        for posicao, futuro in em_curso.items():
+            try:
+                (tokens, valores, _), segundos = futuro.result()
+                resultados[posicao]['shap'] = (_somar_por_palavra(tokens, valores), None, segundos)
+            except Exception as erro:
+                resultados[posicao]['shap'] = (None, erro, _decorrido())
+            if ao_progredir is not None and erro_comum is None:
+                _progredir()
+
+    # Cancelado depois das passagens em comum, quando só faltavam os SHAP por
+    # partição: o que saiu fica incompleto e é descartado inteiro.
+    _conferir(cancelamento)
+    for posicao in range(len(textos)):
+        if _cancelado(posicao):
+            cancelado = PedidoCancelado()
+            resultados[posicao] = {'lime': (None, cancelado, _decorrido()),
+                                   'shap': (None, cancelado, _decorrido())}
+
+    logger.info(
+        'explicacao em lote: %s comentarios, %s entradas em comum (%s retomadas), '
+        '%s shap por particao, %.1fs',
+        len(textos), len(entradas), len(entradas) - len(faltando), len(particoes),
+        time.perf_counter() - inicio,
     )
-    
-    if sentiment_scores:
-        new_feedback.compound = sentiment_scores['compound']
-        new_feedback.neg = sentiment_scores['neg']
-        new_feedback.neu = sentiment_scores['neu']
-        new_feedback.pos = sentiment_scores['pos']
-    
-    new_feedback.overall_score = new_feedback.calculate_overall_score()
-    
-    db.session.add(new_feedback)
-    db.session.commit()
-    
-    update_student_risk_analysis(student_id, subject_id)
-    
-    return new_feedback
-
-def update_student_risk_analysis(student_id, subject_id):
-    # Feedback retirado pelo aluno sai da conta. Sem isso, o índice de risco
-    # continuaria refletindo uma resposta que ele pediu para não usar.
-    feedbacks = Feedback.ativos().filter_by(
-        student_id=student_id,
-        subject_id=subject_id
-    ).all()
-    
-    if not feedbacks:
-        analysis = StudentRiskAnalysis.query.filter_by(
-            student_id=student_id,
-            subject_id=subject_id
-        ).first()
-        if analysis:
-            db.session.delete(analysis)
-            db.session.commit()
-        return None
-    
-    avg_score = sum(f.overall_score for f in feedbacks) / len(feedbacks)
-    
-    sentiment_values = [f.compound for f in feedbacks if f.compound is not None]
-    avg_sentiment = sum(sentiment_values) / len(sentiment_values) if sentiment_values else None
-    
-    analysis = StudentRiskAnalysis.query.filter_by(
-        student_id=student_id,
-        subject_id=subject_id
-    ).first()
-    
-    if not analysis:
-        analysis = StudentRiskAnalysis(
-            student_id=student_id,
-            subject_id=subject_id
-        )
-        db.session.add(analysis)
-    
-    analysis.average_score = avg_score
-    analysis.average_sentiment = avg_sentiment
-    analysis.feedback_count = len(feedbacks)
-    analysis.calculate_risk_score()
-    
-    db.session.commit()
-    return analysis
-
-def get_students_at_risk(subject_id=None, min_risk_level='medio'):
-    query = StudentRiskAnalysis.query
-    
-    if subject_id:
-        query = query.filter_by(subject_id=subject_id)
-    
-    risk_levels = {
-        'baixo': ['baixo', 'medio', 'alto'],
-        'medio': ['medio', 'alto'],
-        'alto': ['alto']
-    }
-    levels_to_include = risk_levels.get(min_risk_level, ['alto'])
-    
-    query = query.filter(StudentRiskAnalysis.risk_level.in_(levels_to_include))
-    query = query.order_by(StudentRiskAnalysis.risk_score.desc())
-    
-    return query.all()
\ No newline at end of file
+    return resultados
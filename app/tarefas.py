@@ -0,0 +1,802 @@
+"""Fila durável das explicações: a rota registra, um trabalhador calcula.
+
+A rota `POST /feedbacks/<id>/explicacao` calculava LIME e SHAP dentro da própria
+requisição, por minutos, segurando uma das quatro threads do gunicorn; o timeout
+de 300 s do Dockerfile existia só para caber nisso. Agora a rota grava uma
+TarefaDeExplicacao e responde na hora. Quem calcula é um trabalhador:
+
+    flask worker-explicacoes                 processo dedicado
+    EXPLICACOES_NO_PROCESSO=1 (padrão)       uma thread dentro do servidor web
+
+Os dois são o mesmo laço e podem coexistir, em quantas instâncias for: o banco
+decide quem fica com cada tarefa.
+
+Pegar uma tarefa é uma instrução condicional. No Postgres, a seleção usa
+`FOR UPDATE SKIP LOCKED`, e trabalhadores concorrentes passam direto pelas
+linhas que outro já travou em vez de esperar por elas. No SQLite, que não tem
+nem uma coisa nem outra, vale o UPDATE com a mesma condição da seleção: o banco
+serializa as escritas, e quem não alterar linha nenhuma sabe que perdeu a
+tarefa para outro.
+
+Quem pega recebe uma concessão com prazo, renovada por uma thread enquanto o
+cálculo dura. O processo que morrer no meio deixa a concessão vencer, e a tarefa
+volta para a fila sozinha; é o que a reserva por `explicacao_iniciada_em` fazia
+com um teto fixo de quinze minutos. O resultado só é gravado se a tarefa ainda
+for de quem calculou: um trabalhador que perdeu a concessão descarta o que fez.
+
+Retirar um feedback, apagar os dados do aluno ou as contas de teste cancela a
+tarefa no banco, inclusive em curso. Quem calcula confere a cada poucos
+segundos, na mesma thread que renova a concessão, se as tarefas continuam
+suas; no mesmo processo, o aviso chega na hora. Cada feedback tem o seu sinal:
+o texto dele sai do lote antes do próximo pedaço que vai ao modelo e não
+grava nada, e os outros textos pegos junto seguem calculando. Um texto
+repetido entre feedbacks só sai quando todos eles tiverem sido cancelados.
+
+Enquanto calcula, o trabalhador grava de tempos em tempos as perturbações e o
+que o modelo já respondeu (ver artefatos.py). A tentativa seguinte de uma
+tarefa interrompida, pela instância que caiu por exemplo, retoma desse ponto
+em vez de começar da amostra zero.
+
+Cada passo, da reserva ao fim, também vai para o registro de andamento deste
+processo (ver progresso.py), que avisa na hora quem está esperando pelo
+resultado.
+
+Configuração:
+
+    EXPLICACOES_NO_PROCESSO=1       thread trabalhadora dentro do servidor web
+    EXPLICACOES_POR_VEZ=4           tarefas pegas de uma vez, explicadas em lote
+    EXPLICACOES_CONCESSAO_S=120     prazo da concessão, renovada a cada terço
+    EXPLICACOES_TENTATIVAS=3        tentativas antes de dar a tarefa por falha
+    EXPLICACOES_INTERVALO_S=2       pausa entre consultas com a fila vazia
+    EXPLICACOES_VERIFICACAO_S=2     de quanto em quanto tempo o cálculo confere
+                                    se foi cancelado
+    EXPLICACOES_FILA_MAXIMA=200     tarefas abertas acima das quais a rota
+                                    recusa pedidos novos com 503; 0 desliga
+"""
+
+import datetime
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+
+from . import admissao, artefatos, explicacoes_por_texto, progresso
+from .models import Feedback, TarefaDeExplicacao, db
+
+logger = logging.getLogger(__name__)
+
+NO_PROCESSO = os.environ.get('EXPLICACOES_NO_PROCESSO', '1').lower() in ('1', 'true', 'sim')
+POR_VEZ = max(1, int(os.environ.get('EXPLICACOES_POR_VEZ', 4)))
+CONCESSAO = datetime.timedelta(seconds=int(os.environ.get('EXPLICACOES_CONCESSAO_S', 120)))
+TENTATIVAS = max(1, int(os.environ.get('EXPLICACOES_TENTATIVAS', 3)))
+INTERVALO = float(os.environ.get('EXPLICACOES_INTERVALO_S', 2))
+VERIFICACAO = float(os.environ.get('EXPLICACOES_VERIFICACAO_S', 2))
+
+# Espera antes de repetir uma tarefa que falhou, dobrando a cada tentativa. Uma
+# falha costuma ser o processo sem memória ou o banco fora por um instante, e
+# repetir no segundo seguinte daria no mesmo.
+ESPERA_APOS_FALHA = datetime.timedelta(seconds=30)
+
+_ABERTAS = (TarefaDeExplicacao.PENDENTE, TarefaDeExplicacao.EM_CURSO)
+
+# Teto da fila. Aceitar o pedido é barato, mas cada tarefa a mais é um aluno a
+# mais esperando o e-mail; acima de um tanto, a espera passa do que ele tolera e
+# é melhor dizer logo quando voltar. A contagem vale alguns segundos por
+# processo, para a rota não consultar o banco a cada pedido de um pico.
+FILA_MAXIMA = max(0, int(os.environ.get('EXPLICACOES_FILA_MAXIMA', 200)))
+_VALIDADE_DA_CONTAGEM = 5
+_JANELA_DA_VAZAO = datetime.timedelta(minutes=10)
+_contagem = {'em': None, 'abertas': 0, 'por_segundo': None}
+
+# Cálculos em curso neste processo, por feedback: o Event que os interrompe. O
+# cancelamento feito aqui mesmo sinaliza na hora, sem esperar a conferência.
+_em_calculo = {}
+_trava_em_calculo = threading.Lock()
+
+
+def nome_do_trabalhador(sufixo=''):
+    """Identifica o trabalhador na tarefa: máquina, processo e, se houver, thread."""
+    nome = f'{socket.gethostname()}:{os.getpid()}'
+    return f'{nome}:{sufixo}' if sufixo else nome
+
+
+def enfileirar(feedback, prioridade=TarefaDeExplicacao.PRIORIDADE_DO_ALUNO):
+    """A tarefa de explicação do feedback, criada ou reaberta se preciso.
+
+    Idempotente: uma tarefa aberta continua a mesma, só com a prioridade maior
+    das duas. Uma tarefa encerrada sem explicação gravada, porque falhou, foi
+    cancelada ou teve o resultado apagado, recomeça do zero.
+    """
+    tarefa = TarefaDeExplicacao.query.filter_by(feedback_id=feedback.id).first()
+    agora = datetime.datetime.utcnow()
+
+    if tarefa is None:
+        tarefa = TarefaDeExplicacao(
+            feedback_id=feedback.id, prioridade=prioridade,
+            criada_em=agora, disponivel_em=agora,
+        )
+        db.session.add(tarefa)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Dois pedidos para o mesmo feedback criaram a tarefa ao mesmo
+            # tempo. A restrição de unicidade escolheu um; o outro usa a dele.
+            db.session.rollback()
+            tarefa = TarefaDeExplicacao.query.filter_by(feedback_id=feedback.id).one()
+        return tarefa
+
+    if tarefa.estado in _ABERTAS:
+        if tarefa.prioridade < prioridade:
+            tarefa.prioridade = prioridade
+            db.session.commit()
+        return tarefa
+
+    if feedback.explicacao_calculada:
+        return tarefa
+
+    tarefa.estado = TarefaDeExplicacao.PENDENTE
+    tarefa.prioridade = prioridade
+    tarefa.tentativas = 0
+    tarefa.criada_em = agora
+    tarefa.disponivel_em = agora
+    tarefa.concessao_ate = None
+    tarefa.trabalhador = None
+    tarefa.erro = None
+    tarefa.concluida_em = None
+    db.session.commit()
+    return tarefa
+
+
+def espera_por_vaga_na_fila(feedback_id):
+    """Segundos até a fila ter vaga para a tarefa deste feedback, ou None se tem.
+
+    Um feedback que já tem tarefa aberta sempre tem vaga: pedir de novo não
+    acrescenta trabalho. A espera sai da vazão dos últimos minutos, contada
+    pelas tarefas concluídas.
+    """
+    if not FILA_MAXIMA:
+        return None
+
+    agora = time.monotonic()
+    if _contagem['em'] is None or agora - _contagem['em'] > _VALIDADE_DA_CONTAGEM:
+        desde = datetime.datetime.utcnow() - _JANELA_DA_VAZAO
+        concluidas = TarefaDeExplicacao.query.filter(
+            TarefaDeExplicacao.estado == TarefaDeExplicacao.CONCLUIDA,
+            TarefaDeExplicacao.concluida_em >= desde,
+        ).count()
+        _contagem.update(
+            em=agora,
+            abertas=TarefaDeExplicacao.query.filter(
+                TarefaDeExplicacao.estado.in_(_ABERTAS)).count(),
+            por_segundo=concluidas / _JANELA_DA_VAZAO.total_seconds() or None,
+        )
+
+    if _contagem['abertas'] < FILA_MAXIMA:
+        return None
+    if TarefaDeExplicacao.query.filter(
+        TarefaDeExplicacao.feedback_id == feedback_id,
+        TarefaDeExplicacao.estado.in_(_ABERTAS),
+    ).count():
+        return None
+    return admissao.segundos_de_espera(
+        _contagem['abertas'] - FILA_MAXIMA + 1, _contagem['por_segundo'], admissao.RETRY_MAXIMO,
+    )
+
+
+def _sinalizar(ids_de_feedbacks):
+    """Interrompe os cálculos deste processo para estes feedbacks, se houver."""
+    with _trava_em_calculo:
+        for feedback_id in ids_de_feedbacks:
+            cancelamento = _em_calculo.get(feedback_id)
+            if cancelamento is not None:
+                cancelamento.set()
+
+
+def cancelar(feedback_id):
+    """Cancela a tarefa aberta de um feedback retirado, pendente ou em curso.
+
+    A concessão de quem calcula deixa de valer; o trabalhador percebe, para o
+    cálculo e não grava nada. Os artefatos do cálculo saem junto. Não faz
+    commit.
+    """
+    TarefaDeExplicacao.query.filter(
+        TarefaDeExplicacao.feedback_id == feedback_id,
+        TarefaDeExplicacao.estado.in_(_ABERTAS),
+    ).update({
+        'estado': TarefaDeExplicacao.CANCELADA,
+        'concessao_ate': None,
+        'concluida_em': datetime.datetime.utcnow(),
+    }, synchronize_session=False)
+    artefatos.apagar([feedback_id])
+    _sinalizar([feedback_id])
+    progresso.publicar(feedback_id, progresso.CANCELADA)
+
+
+def apagar_do_aluno(ids_de_alunos):
+    """Apaga tarefas, artefatos e explicações guardadas dos feedbacks destes alunos.
+
+    Vem antes de apagar os feedbacks. Uma tarefa em curso some junto, e o
+    cálculo dela é interrompido como no cancelamento. Não faz commit.
+    """
+    linhas = (db.session.query(Feedback.id, Feedback.additional_comment)
+              .filter(Feedback.student_id.in_(ids_de_alunos)).all())
+    feedbacks = [id_ for id_, _ in linhas]
+    TarefaDeExplicacao.query.filter(
+        TarefaDeExplicacao.feedback_id.in_(feedbacks)
+    ).delete(synchronize_session=False)
+    artefatos.apagar(feedbacks)
+    explicacoes_por_texto.apagar([texto for _, texto in linhas])
+    _sinalizar(feedbacks)
+
+
+def _disponiveis(agora):
+    """Condição de uma tarefa que pode ser pega agora: pendente e fora da espera,
+    ou em curso com a concessão vencida."""
+    return db.or_(
+        db.and_(TarefaDeExplicacao.estado == TarefaDeExplicacao.PENDENTE,
+                TarefaDeExplicacao.disponivel_em <= agora),
+        db.and_(TarefaDeExplicacao.estado == TarefaDeExplicacao.EM_CURSO,
+                TarefaDeExplicacao.concessao_ate < agora),
+    )
+
+
+def _abandonar_esgotadas(agora):
+    """Dá por falha a tarefa cuja concessão venceu na última tentativa.
+
+    Um comentário que derruba o processo toda vez, por memória por exemplo,
+    seria retomado para sempre, e levaria junto cada trabalhador que o pegasse.
+    """
+    esgotadas = TarefaDeExplicacao.query.filter(
+        TarefaDeExplicacao.estado == TarefaDeExplicacao.EM_CURSO,
+        TarefaDeExplicacao.concessao_ate < agora,
+        TarefaDeExplicacao.tentativas >= TENTATIVAS,
+    ).update({
+        'estado': TarefaDeExplicacao.FALHOU,
+        'erro': 'concessão vencida na última tentativa; o trabalhador parou no meio',
+        'concessao_ate': None,
+    }, synchronize_session=False)
+    if esgotadas:
+        logger.warning('%s tarefa(s) de explicação abandonadas após %s tentativas.',
+                       esgotadas, TENTATIVAS)
+
+
+def reivindicar(trabalhador, quantas=POR_VEZ):
+    """Pega até `quantas` tarefas para este trabalhador, e devolve as que pegou.
+
+    Na ordem de prioridade e, entre iguais, da mais recente para a mais antiga.
+    """
+    agora = datetime.datetime.utcnow()
+    _abandonar_esgotadas(agora)
+
+    consulta = (
+        db.session.query(TarefaDeExplicacao.id)
+        .filter(_disponiveis(agora))
+        .order_by(TarefaDeExplicacao.prioridade.desc(), TarefaDeExplicacao.criada_em.desc())
+        .limit(quantas)
+    )
+    if db.engine.url.get_backend_name() == 'postgresql':
+        consulta = consulta.with_for_update(skip_locked=True)
+    candidatas = [id_ for id_, in consulta.all()]
+
+    # No Postgres as linhas já estão travadas por esta transação, e o UPDATE
+    # condicional não tem como perder. No SQLite é ele que decide: a condição é
+    # a mesma da seleção, e a tarefa que outro pegou nesse meio tempo não é
+    # mais alterada.
+    pegas = []
+    for id_ in candidatas:
+        alteradas = TarefaDeExplicacao.query.filter(
+            TarefaDeExplicacao.id == id_, _disponiveis(agora),
+        ).update({
+            'estado': TarefaDeExplicacao.EM_CURSO,
+            'trabalhador': trabalhador,
+            'concessao_ate': agora + CONCESSAO,
+            'tentativas': TarefaDeExplicacao.tentativas + 1,
+        }, synchronize_session=False)
+        if alteradas:
+            pegas.append(id_)
+
+    if pegas:
+        Feedback.query.filter(
+            Feedback.id.in_(db.session.query(TarefaDeExplicacao.feedback_id)
+                            .filter(TarefaDeExplicacao.id.in_(pegas)).scalar_subquery())
+        ).update({'explicacao_iniciada_em': agora}, synchronize_session=False)
+    db.session.commit()
+
+    if not pegas:
+        return []
+    return (TarefaDeExplicacao.query
+            .filter(TarefaDeExplicacao.id.in_(pegas))
+            .order_by(TarefaDeExplicacao.prioridade.desc(), TarefaDeExplicacao.criada_em.desc())
+            .all())
+
+
+def _minhas(ids, trabalhador):
+    return TarefaDeExplicacao.query.filter(
+        TarefaDeExplicacao.id.in_(ids),
+        TarefaDeExplicacao.trabalhador == trabalhador,
+        TarefaDeExplicacao.estado == TarefaDeExplicacao.EM_CURSO,
+    )
+
+
+def ainda_minhas(ids, trabalhador):
+    """Quantas destas tarefas continuam em curso com este trabalhador."""
+    quantas = _minhas(ids, trabalhador).count()
+    # Só leitura, mas encerra a transação: a próxima conferência precisa ver o
+    # que foi gravado desde esta.
+    db.session.commit()
+    return quantas
+
+
+def _quais_ainda_minhas(ids, trabalhador):
+    """Os ids, destes, das tarefas que continuam em curso com este trabalhador."""
+    minhas = {tarefa_id for (tarefa_id,) in
+              _minhas(ids, trabalhador).with_entities(TarefaDeExplicacao.id)}
+    db.session.commit()
+    return minhas
+
+
+def renovar(ids, trabalhador):
+    """Estende a concessão das tarefas que ainda são deste trabalhador.
+
+    Devolve quantas foram renovadas; menos que `len(ids)` quer dizer que alguma
+    foi perdida para outro trabalhador.
+    """
+    renovadas = _minhas(ids, trabalhador).update(
+        {'concessao_ate': datetime.datetime.utcnow() + CONCESSAO}, synchronize_session=False,
+    )
+    db.session.commit()
+    return renovadas
+
+
+class _TodosSinalizados:
+    """Sinalizado quando todos os sinais dados estão: o texto de um grupo só
+    deixa de ser calculado quando nenhum feedback dele espera mais."""
+
+    __slots__ = ('sinais',)
+
+    def __init__(self, sinais):
+        self.sinais = sinais
+
+    def is_set(self):
+        return all(sinal.is_set() for sinal in self.sinais)
+
+
+class _Renovacao:
+    """Thread que mantém a concessão enquanto o bloco `with` calcula, e avisa
+    o cálculo, pelo sinal de cada feedback em `cancelamentos`, quando a tarefa
+    dele deixa de ser deste trabalhador.
+
+    Uma tarefa cancelada, apagada ou perdida para outro trabalhador teria o
+    resultado descartado de qualquer jeito; parar logo o texto dela devolve o
+    modelo a quem ainda espera, sem interromper as outras tarefas do grupo.
+    Roda num contexto de aplicação próprio, e por isso com a própria sessão do
+    banco: a sessão do cálculo não pode ser compartilhada entre threads.
+    """
+
+    def __init__(self, tarefas, trabalhador, ao_renovar=None):
+        self.ids = [tarefa.id for tarefa in tarefas]
+        self.feedbacks = [tarefa.feedback_id for tarefa in tarefas]
+        self.feedback_da_tarefa = dict(zip(self.ids, self.feedbacks))
+        self.trabalhador = trabalhador
+        self.ao_renovar = ao_renovar
+        self.cancelamentos = {feedback_id: threading.Event() for feedback_id in self.feedbacks}
+        self._app = current_app._get_current_object()
+        self._parar = threading.Event()
+        self._thread = threading.Thread(target=self._laco, name='concessao', daemon=True)
+
+    def __enter__(self):
+        with _trava_em_calculo:
+            _em_calculo.update(self.cancelamentos)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *_):
+        self._parar.set()
+        self._thread.join()
+        with _trava_em_calculo:
+            for feedback_id, cancelamento in self.cancelamentos.items():
+                if _em_calculo.get(feedback_id) is cancelamento:
+                    del _em_calculo[feedback_id]
+
+    def _laco(self):
+        renovar_a_cada = CONCESSAO.total_seconds() / 3
+        proxima_renovacao = time.monotonic() + renovar_a_cada
+        ids = list(self.ids)
+        with self._app.app_context():
+            while ids and not self._parar.wait(min(VERIFICACAO, renovar_a_cada)):
+                try:
+                    # A conferência é uma leitura; a renovação, que escreve,
+                    # só quando vence o terço da concessão.
+                    if time.monotonic() >= proxima_renovacao:
+                        minhas = renovar(ids, self.trabalhador)
+                        if self.ao_renovar is not None:
+                            self.ao_renovar()
+                        proxima_renovacao = time.monotonic() + renovar_a_cada
+                    else:
+                        minhas = ainda_minhas(ids, self.trabalhador)
+                    if minhas < len(ids):
+                        perdidas = set(ids) - _quais_ainda_minhas(ids, self.trabalhador)
+                    else:
+                        perdidas = set()
+                except Exception:
+                    db.session.rollback()
+                    logger.warning('Falha ao conferir a concessão de %s', ids, exc_info=True)
+                    continue
+                if perdidas:
+                    feedbacks = [self.feedback_da_tarefa[t] for t in perdidas]
+                    logger.info('%s não tem mais as tarefas dos feedbacks %s; '
+                                'interrompendo só esses.', self.trabalhador, feedbacks)
+                    for feedback_id in feedbacks:
+                        self.cancelamentos[feedback_id].set()
+                    ids = [t for t in ids if t not in perdidas]
+
+
+def _encerrar(tarefa, trabalhador, estado, erro=None):
+    """Encerra a tarefa, se ela ainda for deste trabalhador. Não faz commit."""
+    return _minhas([tarefa.id], trabalhador).update({
+        'estado': estado,
+        'erro': erro,
+        'concessao_ate': None,
+        'concluida_em': datetime.datetime.utcnow(),
+    }, synchronize_session=False)
+
+
+def _falhar(tarefa, trabalhador, erro):
+    """Devolve a tarefa para a fila com espera, ou a dá por falha na última tentativa."""
+    feedback_id = tarefa.feedback_id
+    esgotada = tarefa.tentativas >= TENTATIVAS
+    if esgotada:
+        _encerrar(tarefa, trabalhador, TarefaDeExplicacao.FALHOU, erro)
+    else:
+        espera = ESPERA_APOS_FALHA * 2 ** (tarefa.tentativas - 1)
+        _minhas([tarefa.id], trabalhador).update({
+            'estado': TarefaDeExplicacao.PENDENTE,
+            'erro': erro,
+            'concessao_ate': None,
+            'trabalhador': None,
+            'disponivel_em': datetime.datetime.utcnow() + espera,
+        }, synchronize_session=False)
+
+    # A reserva informativa volta a zero, para a tela não mostrar um cálculo
+    # que não está acontecendo.
+    Feedback.query.filter(Feedback.id == feedback_id).update(
+        {'explicacao_iniciada_em': None}, synchronize_session=False)
+    db.session.commit()
+    progresso.publicar(feedback_id, progresso.FALHOU if esgotada else progresso.PENDENTE)
+
+
+def _liberar(ids, ids_de_feedbacks, trabalhador, espera=datetime.timedelta(0)):
+    """Devolve para a fila, sem gastar tentativa, as tarefas ainda deste trabalhador.
+
+    São as de um texto que outro trabalhador já está calculando: esperar por
+    ele não é falha delas.
+    """
+    _minhas(ids, trabalhador).update({
+        'estado': TarefaDeExplicacao.PENDENTE,
+        'concessao_ate': None,
+        'trabalhador': None,
+        'disponivel_em': datetime.datetime.utcnow() + espera,
+        'tentativas': TarefaDeExplicacao.tentativas - 1,
+    }, synchronize_session=False)
+    Feedback.query.filter(Feedback.id.in_(ids_de_feedbacks)).update(
+        {'explicacao_iniciada_em': None}, synchronize_session=False)
+    db.session.commit()
+    progresso.devolver(ids_de_feedbacks)
+
+
+def _gravar(tarefa, trabalhador, resultado, lime_modo):
+    """Grava LIME e SHAP de uma tarefa, se ela ainda for deste trabalhador.
+
+    Faz commit e avisa o aluno. Devolve se a tarefa foi concluída.
+    """
+    from .emails import notificar
+
+    lime, erro_lime, _ = resultado['lime']
+    shap, erro_shap, _ = resultado['shap']
+    if erro_lime is not None:
+        logger.error('LIME falhou para o feedback %s', tarefa.feedback_id, exc_info=erro_lime)
+    if erro_shap is not None:
+        logger.error('SHAP falhou para o feedback %s', tarefa.feedback_id, exc_info=erro_shap)
+
+    # As duas técnicas são independentes: se só uma falhar, a outra já
+    # destaca as palavras e a explicação conta como calculada. Só as duas
+    # falhando devolvem a tarefa para nova tentativa.
+    if erro_lime is not None and erro_shap is not None:
+        _falhar(tarefa, trabalhador, f'LIME: {erro_lime!r}; SHAP: {erro_shap!r}')
+        return False
+
+    try:
+        erro = '; '.join(
+            f'{tecnica}: {erro!r}'
+            for tecnica, erro in (('LIME', erro_lime), ('SHAP', erro_shap)) if erro is not None
+        ) or None
+        if not _encerrar(tarefa, trabalhador, TarefaDeExplicacao.CONCLUIDA, erro):
+            db.session.rollback()
+            logger.warning('Tarefa %s não é mais de %s, resultado descartado.',
+                           tarefa.id, trabalhador)
+            return False
+
+        feedback = tarefa.feedback
+        if erro_lime is None:
+            feedback.token_attributions = lime
+            feedback.lime_modo = lime_modo
+        if erro_shap is None:
+            feedback.shap_attributions = shap
+        feedback.lime_parcial = None
+        db.session.commit()
+    except Exception as erro:
+        db.session.rollback()
+        logger.exception('Erro ao gravar as explicações do feedback %s', tarefa.feedback_id)
+        _falhar(tarefa, trabalhador, repr(erro))
+        return False
+
+    # Depois do commit, como antes na rota: avisar antes arriscaria mandar
+    # o aluno olhar um resultado que a gravação ainda pode perder.
+    progresso.publicar(tarefa.feedback_id, progresso.CONCLUIDA, 100 if erro_lime is None else None,
+                       erro_shap is None)
+    notificar(feedback)
+    return True
+
+
+def processar(tarefas, trabalhador):
+    """Calcula as explicações das tarefas pegas e grava o que ainda for deste trabalhador.
+
+    A tarefa de um comentário que já tem explicação guardada neste modelo é
+    concluída com ela, sem calcular; a de um comentário que outro trabalhador
+    está calculando volta para a fila por alguns segundos. As demais são
+    explicadas em lote, com as passagens pelo modelo em comum e cada texto
+    distinto uma vez só. Cada tarefa é gravada no seu próprio commit. Devolve
+    quantas foram concluídas.
+    """
+    from .escalonador_de_inferencia import EXPLICACAO, VARREDURA
+    from .fila_de_inferencia import PedidoCancelado
+    from .prontidao import carregar_modelo
+
+    services = carregar_modelo()
+
+    calcular = []
+    encerradas = []
+    for tarefa in tarefas:
+        feedback = tarefa.feedback
+        if feedback is None or feedback.deleted_at is not None:
+            _encerrar(tarefa, trabalhador, TarefaDeExplicacao.CANCELADA)
+            encerradas.append((tarefa.feedback_id, progresso.CANCELADA))
+        elif feedback.explicacao_calculada:
+            # Calculado por outro caminho, a varredura calcular-explicacoes
+            # por exemplo, enquanto a tarefa esperava.
+            _encerrar(tarefa, trabalhador, TarefaDeExplicacao.CONCLUIDA)
+            encerradas.append((tarefa.feedback_id, progresso.CONCLUIDA))
+        elif not (feedback.additional_comment or '').strip():
+            _encerrar(tarefa, trabalhador, TarefaDeExplicacao.CANCELADA, 'feedback sem comentário')
+            encerradas.append((tarefa.feedback_id, progresso.CANCELADA))
+        else:
+            calcular.append(tarefa)
+    db.session.commit()
+    for feedback_id, estado in encerradas:
+        progresso.publicar(feedback_id, estado, shap_concluido=estado == progresso.CONCLUIDA)
+    progresso.publicar_varios([t.feedback_id for t in calcular], progresso.RESERVADA)
+
+    if not calcular:
+        return 0
+
+    modelo = services.IDENTIDADE_DO_MODELO
+    reuso = explicacoes_por_texto.LIGADO
+    concluidas = 0
+
+    # As tarefas por texto. Sem o reaproveitamento, cada uma é o seu grupo.
+    grupos = {}
+    for tarefa in calcular:
+        texto = tarefa.feedback.additional_comment
+        grupos.setdefault(explicacoes_por_texto.chave(texto) if reuso else tarefa.id, []).append(tarefa)
+
+    if reuso:
+        prontas = explicacoes_por_texto.prontas(
+            [grupo[0].feedback.additional_comment for grupo in grupos.values()], modelo,
+        )
+        for chave in prontas:
+            for tarefa in grupos.pop(chave):
+                resultado = explicacoes_por_texto.usar(prontas[chave])
+                concluidas += _gravar(tarefa, trabalhador, resultado, prontas[chave].lime_modo)
+        if prontas:
+            logger.info('explicacao reaproveitada de %s texto(s) ja explicado(s) trabalhador=%s',
+                        len(prontas), trabalhador)
+
+        adiadas = []
+        for chave in list(grupos):
+            if not explicacoes_por_texto.reservar(chave, modelo, trabalhador, CONCESSAO):
+                adiadas.extend(grupos.pop(chave))
+        if adiadas:
+            # Outro trabalhador está calculando o mesmo texto. Na volta, a
+            # explicação dele já estará guardada.
+            _liberar([t.id for t in adiadas], [t.feedback_id for t in adiadas], trabalhador,
+                     explicacoes_por_texto.ESPERA)
+            logger.info('explicacao adiada feedbacks=%s: texto em calculo por outro trabalhador',
+                        [t.feedback_id for t in adiadas])
+
+    if not grupos:
+        return concluidas
+
+    calcular = [tarefa for grupo in grupos.values() for tarefa in grupo]
+    representantes = [grupo[0] for grupo in grupos.values()]
+    # O texto normalizado é o que a chave descreve; explicado assim, o que fica
+    # guardado vale para qualquer cópia dele.
+    textos = [explicacoes_por_texto.normalizar(t.feedback.additional_comment)
+              for t in representantes]
+    reservadas = list(grupos) if reuso else []
+
+    # No modelo, o grupo vai na faixa de quem espera: basta um pedido de aluno
+    # para o grupo inteiro passar à frente da varredura.
+    aluno_esperando = any(
+        tarefa.prioridade >= TarefaDeExplicacao.PRIORIDADE_DO_ALUNO for tarefa in calcular
+    )
+    faixa = EXPLICACAO if aluno_esperando else VARREDURA
+
+    # Uma tentativa anterior interrompida deixou o que já tinha passado pelo
+    # modelo; esta continua de lá.
+    retomar = [
+        artefatos.carregar(tarefa.feedback_id, modelo, texto)
+        for tarefa, texto in zip(representantes, textos)
+    ]
+    retomadas = [t.feedback_id for t, estado in zip(representantes, retomar) if estado is not None]
+    if retomadas:
+        logger.info('explicacao retomada de artefatos feedbacks=%s', retomadas)
+
+    # Os ids à parte: a tarefa apagada no meio do cálculo não pode mais ser
+    # recarregada da sessão.
+    chaves = [(tarefa.id, tarefa.feedback_id) for tarefa in representantes]
+
+    def _registrar(posicao, estado):
+        # Só quem ainda tem a tarefa grava: a de um feedback retirado no meio
+        # do cálculo não deixa rastro.
+        tarefa_id, feedback_id = chaves[posicao]
+        if ainda_minhas([tarefa_id], trabalhador):
+            artefatos.gravar(feedback_id, modelo, estado)
+
+    def _renovar_reservas():
+        explicacoes_por_texto.renovar(reservadas, modelo, trabalhador, CONCESSAO)
+
+    # O andamento de um texto vale para todas as tarefas do grupo dele.
+    feedbacks_do_grupo = [[t.feedback_id for t in grupo] for grupo in grupos.values()]
+
+    def _progredir(posicao, lime_percentual, shap_concluido):
+        for feedback_id in feedbacks_do_grupo[posicao]:
+            progresso.publicar(feedback_id, progresso.CALCULANDO, lime_percentual, shap_concluido)
+
+    def _etapa(posicao, amostras, pesos, estabilidade):
+        # Gravada no feedback, para a tela que recarregar e para o vigia de
+        # outro processo; como o ponto de retomada, só enquanto a tarefa é nossa.
+        tarefa_id, _ = chaves[posicao]
+        if not ainda_minhas([tarefa_id], trabalhador):
+            return
+        lime_parcial = {'amostras': amostras, 'pesos': pesos, 'estabilidade': estabilidade}
+        feedbacks = feedbacks_do_grupo[posicao]
+        try:
+            Feedback.query.filter(Feedback.id.in_(feedbacks)).update(
+                {'lime_parcial_json': json.dumps(lime_parcial)}, synchronize_session=False,
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        progresso.publicar_etapa(feedbacks, lime_parcial)
+        logger.info('lime etapa feedbacks=%s amostras=%s estabilidade=%s',
+                    feedbacks, amostras, estabilidade)
+
+    inicio = time.perf_counter()
+    try:
+        with _Renovacao(calcular, trabalhador, _renovar_reservas if reservadas else None) as renovacao:
+            resultados = services.explicar_em_lote(
+                textos, faixa, retomar=retomar,
+                ao_registrar=_registrar if artefatos.LIGADO else None,
+                ao_progredir=_progredir, ao_etapa=_etapa,
+                cancelamentos=[
+                    _TodosSinalizados([renovacao.cancelamentos[t.feedback_id] for t in grupo])
+                    for grupo in grupos.values()
+                ],
+            )
+        decorrido = time.perf_counter() - inicio
+
+        backend = services.descrever_modelo()['backend']
+        for (chave, grupo), texto, resultado in zip(grupos.items(), textos, resultados):
+            if isinstance(resultado['lime'][1], PedidoCancelado):
+                # Nenhuma tarefa do grupo é mais nossa: não há onde gravar, e o
+                # cancelamento já avisou quem acompanhava.
+                logger.info('explicacao interrompida feedbacks=%s depois de %.1fs trabalhador=%s',
+                            [t.feedback_id for t in grupo], resultado['lime'][2], trabalhador)
+                continue
+            lime_modo = services.modo_lime(texto)
+            if reuso and resultado['lime'][1] is None and resultado['shap'][1] is None:
+                explicacoes_por_texto.concluir(
+                    chave, modelo, resultado['lime'][0], lime_modo, resultado['shap'][0],
+                )
+            # Os tempos de cada técnica são os do texto dentro do grupo; o
+            # total, o que o feedback esperou até as duas ficarem prontas.
+            tempo_lime, tempo_shap = resultado['lime'][2], resultado['shap'][2]
+            for tarefa in grupo:
+                concluidas += _gravar(tarefa, trabalhador, resultado, lime_modo)
+                logger.info(
+                    'explicacao feedback=%s caracteres=%s lime=%.1fs shap=%.1fs total=%.1fs '
+                    'backend=%s trabalhador=%s',
+                    tarefa.feedback_id, len(texto), tempo_lime, tempo_shap,
+                    max(tempo_lime, tempo_shap), backend, trabalhador,
+                )
+    finally:
+        # O que não chegou a ser guardado volta a estar livre para quem pedir.
+        if reservadas:
+            db.session.rollback()
+            explicacoes_por_texto.desistir(reservadas, modelo, trabalhador)
+
+    logger.info(
+        'explicacao %s tarefa(s) feedbacks=%s textos=%s caracteres=%s total=%.1fs backend=%s '
+        'trabalhador=%s',
+        len(calcular), [t.feedback_id for t in calcular], len(textos),
+        sum(len(t) for t in textos), decorrido, backend, trabalhador,
+    )
+    return concluidas
+
+
+def trabalhar(trabalhador, por_vez=POR_VEZ, parar=None, ate_esvaziar=False, ao_processar=None):
+    """O laço do trabalhador: pega, calcula, grava, e espera quando não há nada.
+
+    Precisa de um contexto de aplicação. Termina quando `parar` for sinalizado
+    ou, com `ate_esvaziar`, na primeira vez em que a fila estiver vazia.
+    `ao_processar`, se dado, recebe quantas tarefas cada rodada concluiu e em
+    quantos segundos.
+    """
+    parar = parar or threading.Event()
+    while not parar.is_set():
+        try:
+            tarefas = reivindicar(trabalhador, por_vez)
+            if tarefas:
+                inicio = time.perf_counter()
+                concluidas = processar(tarefas, trabalhador)
+                if ao_processar is not None:
+                    ao_processar(concluidas, time.perf_counter() - inicio)
+        except Exception:
+            # O trabalhador não pode morrer por causa de uma tarefa nem de uma
+            # queda do banco: o que ele tiver pego volta para a fila quando a
+            # concessão vencer.
+            db.session.rollback()
+            logger.exception('Erro no trabalhador de explicações %s', trabalhador)
+            tarefas = []
+        finally:
+            db.session.remove()
+
+        if not tarefas:
+            if ate_esvaziar:
+                return
+            parar.wait(INTERVALO)
+
+
+_embutido = None
+_embutido_pid = None
+
+
+def iniciar_no_processo(app):
+    """Sobe a thread trabalhadora dentro do servidor web, se configurado.
+
+    Não sobe nos comandos do `flask`, que carregam o mesmo app: o próprio
+    worker-explicacoes seria um segundo trabalhador dentro de si mesmo, e os
+    demais comandos não devem calcular nada por baixo.
+    """
+    global _embutido, _embutido_pid
+    if not NO_PROCESSO or os.environ.get('FLASK_RUN_FROM_CLI') == 'true':
+        return None
+    # Thread não atravessa fork: num processo filho, a do pai não existe mais.
+    if _embutido_pid == os.getpid() and _embutido.is_alive():
+        return _embutido
+
+    def _laco():
+        with app.app_context():
+            trabalhar(nome_do_trabalhador('embutido'))
+
+    _embutido = threading.Thread(target=_laco, name='trabalhador-explicacoes', daemon=True)
+    _embutido.start()
+    _embutido_pid = os.getpid()
+    logger.info('Trabalhador de explicações embutido no processo %s.', os.getpid())
+    return _embutido
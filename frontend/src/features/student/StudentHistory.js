@@ -1,7 +1,9 @@
 import React, { useState, useEffect, useRef } from 'react';
 import { useLocation, useNavigate } from 'react-router-dom';
 import { useAuth } from '../auth/AuthContext';
-import { getMyFeedbacks, getSubjects, deleteMyFeedback, gerarExplicacao } from '../../services/api';
+import {
+  getMyFeedbacks, getSubjects, deleteMyFeedback, gerarExplicacao, acompanharExplicacao,
+} from '../../services/api';
 import { getSentimentLabel, rotuloDoFeedback } from '../../utils/sentiment';
 import { translateSubject } from '../../utils/translations';
 import { tokenizeAndScore, temAtribuicoes, atribuicoesConvergentes } from '../../utils/wordHighlight';
@@ -123,7 +125,22 @@ function ExplainabilityLegend({ onInfo }) {
   );
 }
 
-function AnaliseEmPreparo({ comEmail }) {
+// O andamento que o servidor informa, em palavras; null enquanto não há nada a
+// dizer além do que o cartão já diz.
+function descreverAndamento(andamento) {
+  if (!andamento) return null;
+  if (andamento.estado === 'calculando' && andamento.lime_percentual !== null) {
+    return `Cálculo em andamento: ${andamento.lime_percentual}% das leituras feitas.`;
+  }
+  if (andamento.estado === 'reservada' || andamento.estado === 'calculando') {
+    return 'O cálculo começou.';
+  }
+  if (andamento.estado === 'pendente') return 'Na fila para o cálculo.';
+  return null;
+}
+
+function AnaliseEmPreparo({ comEmail, andamento, provisoria, amostras }) {
+  const situacao = descreverAndamento(andamento);
   return (
     <div className="mt-3 rounded-xl border border-[#cfe0da] bg-bg px-4 py-3 space-y-1.5">
       <p className="text-sm font-semibold text-[#1e293b]">
@@ -137,11 +154,30 @@ function AnaliseEmPreparo({ comEmail }) {
         logo abaixo. O que ainda falta é descobrir quais palavras mais pesaram nele,
         e isso exige repetir a leitura do seu texto milhares de vezes.
       </p>
+      {provisoria && !amostras && (
+        <p className="text-sm text-[#334155] leading-relaxed">
+          {/* A prévia tira uma palavra por vez do texto; o cálculo completo pesa
+              as palavras juntas e pode mudar as cores. Sem este aviso, a troca
+              pareceria um erro. */}
+          As cores acima são uma <strong>prévia</strong>, feita tirando uma palavra de
+          cada vez do seu texto. Elas podem mudar quando o cálculo completo terminar.
+        </p>
+      )}
+      {provisoria && amostras && (
+        <p className="text-sm text-[#334155] leading-relaxed">
+          As cores acima são uma <strong>prévia</strong>, feita com{' '}
+          {amostras.toLocaleString('pt-BR')} das 5.000 leituras do cálculo completo, e
+          ainda podem mudar até ele terminar.
+        </p>
+      )}
       <p className="text-sm text-[#334155] leading-relaxed">
         {comEmail
           ? 'Você vai receber um e-mail quando esse cálculo terminar, e as cores aparecem aqui.'
           : 'As cores aparecem aqui quando esse cálculo terminar. Se quiser ser avisado por e-mail, cadastre um endereço no seu Perfil.'}
       </p>
+      {situacao && (
+        <p className="text-sm text-[#64748b]" aria-live="polite">{situacao}</p>
+      )}
     </div>
   );
 }
@@ -337,12 +373,21 @@ function countPointsWithData(feedbacks) {
   return feedbacks.filter((fb) => fb.overall_score !== null && fb.overall_score !== undefined).length;
 }
 
-function FeedbackCard({ fb, defaultOpen, comEmail, onInfo, onRequestDelete }) {
+function FeedbackCard({ fb, defaultOpen, comEmail, andamento, onInfo, onRequestDelete }) {
   const [expanded, setExpanded] = useState(defaultOpen);
   const rotulo = rotuloDoFeedback(fb);
   const meta  = SENTIMENT_META[rotulo];
   const date  = new Date(fb.created_at).toLocaleDateString('pt-BR', { day: '2-digit', month: 'short', year: 'numeric' });
-  const attributions = atribuicoesConvergentes(fb.token_attributions, fb.shap_attributions);
+  // Enquanto LIME e SHAP não chegam, o comentário é colorido pela etapa mais
+  // recente do LIME, que o servidor avisa pelo andamento, ou pela prévia
+  // gravada no envio, marcadas como provisórias logo abaixo.
+  const definitivas = atribuicoesConvergentes(fb.token_attributions, fb.shap_attributions);
+  const parcial = andamento?.lime_parcial || fb.lime_parcial;
+  const pesosProvisorios = temAtribuicoes(parcial?.pesos) ? parcial.pesos : fb.previa_attributions;
+  const provisoria = !temAtribuicoes(definitivas) && temAtribuicoes(pesosProvisorios)
+    && (fb.explicacao_provisoria || temAtribuicoes(andamento?.lime_parcial?.pesos));
+  const attributions = provisoria ? atribuicoesConvergentes(pesosProvisorios, null) : definitivas;
+  const amostrasProvisorias = provisoria && temAtribuicoes(parcial?.pesos) ? parcial.amostras : null;
 
   return (
     <div
@@ -404,15 +449,20 @@ function FeedbackCard({ fb, defaultOpen, comEmail, onInfo, onRequestDelete }) {
                       palavra. Reduz a chance de conflito com extensões que
                       reescrevem o texto da página, como tradutores. */}
                   <HighlightedText
-                    key={temAtribuicoes(attributions) ? 'com-destaque' : 'sem-destaque'}
+                    key={provisoria ? `previa-${amostrasProvisorias ?? 0}` : temAtribuicoes(attributions) ? 'com-destaque' : 'sem-destaque'}
                     text={fb.additional_comment}
                     tokenAttributions={attributions}
                   />
                 </blockquote>
-                {temAtribuicoes(attributions) ? (
+                {temAtribuicoes(attributions) && !provisoria ? (
                   <ExplainabilityLegend onInfo={onInfo} />
                 ) : (
-                  <AnaliseEmPreparo comEmail={comEmail} />
+                  <AnaliseEmPreparo
+                    comEmail={comEmail}
+                    andamento={andamento}
+                    provisoria={provisoria}
+                    amostras={amostrasProvisorias}
+                  />
                 )}
               </div>
             )}
@@ -444,6 +494,7 @@ function StudentHistory() {
   const [confirmDeleteId, setConfirmDeleteId] = useState(null);
   const [isDeleting, setIsDeleting]           = useState(false);
   const [erroExclusao, setErroExclusao]       = useState(null);
+  const [andamento, setAndamento]             = useState(null);
 
   // O resultado do envio é consumido uma vez e some do histórico do navegador.
   // Enquanto vivia só no state da rota, um F5 restaurava a entrada e a tela
@@ -468,11 +519,10 @@ function StudentHistory() {
   // Isso funcionava, mas prendia o aluno a uma espera de minutos logo depois de
   // um envio que já estava salvo, e a espera longa é o que mais desengaja.
   //
-  // Agora o pedido é disparado e abandonado. O servidor conclui e grava de
-  // qualquer forma, mesmo que a aba feche no instante seguinte, porque o
-  // trabalho já está em curso do lado dele quando a conexão cai. A rotina
-  // `flask calcular-explicacoes` varre depois o que porventura não tenha
-  // completado, e é ela que envia o aviso por e-mail.
+  // Agora o pedido é disparado e abandonado. O servidor só põe a explicação
+  // numa fila e responde na hora; o trabalhador de explicações calcula, grava
+  // e envia o aviso por e-mail, mesmo que a aba já tenha fechado. Uma tentativa
+  // que falhe volta sozinha para a fila.
   useEffect(() => {
     if (!recemEnviado || !accessToken) return;
     if (!(recemEnviado.additional_comment || '').trim()) return;
@@ -487,6 +537,30 @@ function StudentHistory() {
     gerarExplicacao(recemEnviado.id, accessToken).catch(() => {});
   }, [recemEnviado, accessToken]);
 
+  // Sem prender o aluno: enquanto a página está aberta, o servidor avisa o
+  // andamento do cálculo e o fim dele, numa conexão só, e as cores aparecem
+  // sem recarregar. Fechar a página só encerra o acompanhamento; o cálculo e o
+  // e-mail seguem do mesmo jeito.
+  const recemEnviadoId = recemEnviado?.id;
+  useEffect(() => {
+    if (!recemEnviadoId) return undefined;
+    const controle = new AbortController();
+    acompanharExplicacao(recemEnviadoId, setAndamento, controle.signal)
+      .then((final) => {
+        if (final?.estado !== 'concluida') return undefined;
+        // Só o cartão do envio muda; recarregar a lista inteira piscaria o
+        // esqueleto por cima do histórico. O token vem da fonte viva.
+        return getMyFeedbacks(null, null).then((lista) => {
+          const atualizado = (lista || []).find((f) => f.id === recemEnviadoId);
+          if (atualizado) {
+            setFeedbacks((atual) => atual.map((f) => (f.id === recemEnviadoId ? atualizado : f)));
+          }
+        });
+      })
+      .catch(() => {});
+    return () => controle.abort();
+  }, [recemEnviadoId]);
+
   useEffect(() => {
     let cancelled = false;
     if (!accessToken) return;
@@ -707,6 +781,7 @@ function StudentHistory() {
                 fb={fb}
                 defaultOpen={idx === 0}
                 comEmail={!!user?.email}
+                andamento={fb.id === recemEnviadoId ? andamento : null}
                 onInfo={() => setShowModal(true)}
                 onRequestDelete={setConfirmDeleteId}
               />
@@ -11,6 +11,12 @@ const TIMEOUT_ENVIO = 120000;
 // aberta por minutos é interrompida por qualquer troca de aplicativo ou bloqueio
 // de tela, e era isso que fazia o aluno ver erro em um cálculo bem-sucedido.
 const TIMEOUT_EXPLICACAO = 120000;
+// Quanto a tela aguarda, somando as esperas, quando o servidor recusa com 503 e
+// Retry-After por estar cheio. A recusa não grava nada, e repetir o mesmo
+// pedido é seguro. Passado isso, o aluno vê a mensagem e tenta quando quiser.
+const ESPERA_POR_VAGA = 60000;
+
+const esperar = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
 
 export class ApiError extends Error {
   constructor(message, status) {
@@ -93,6 +99,18 @@ const request = async (endpoint, options = {}) => {
 
   const data = await lerCorpo(response);
 
+  const { esperaPorVaga = 0 } = options;
+  if (response.status === 503 && esperaPorVaga > 0) {
+    const segundos = Number(data?.retry_after ?? response.headers.get('Retry-After'));
+    // Até um segundo a mais, sorteado, para que a turma recusada no mesmo
+    // instante não volte toda no mesmo instante.
+    const ms = segundos * 1000 + Math.random() * 1000;
+    if (segundos > 0 && ms <= esperaPorVaga) {
+      await esperar(ms);
+      return request(endpoint, { ...options, esperaPorVaga: esperaPorVaga - ms });
+    }
+  }
+
   if (!response.ok) {
     throw new ApiError(data?.error || data?.message || `Erro ${response.status}`, response.status);
   }
@@ -146,7 +164,12 @@ export const deleteMyFeedback = (feedbackId, token) =>
 // carregar o modelo leva perto de um minuto. Sem esta folga, justamente o
 // primeiro aluno da turma veria erro por um feedback que seria gravado.
 export const analyzeFeedback = (feedbackData, token) =>
-  request('/analyze', { body: feedbackData, token, timeoutMs: TIMEOUT_ENVIO });
+  request('/analyze', {
+    body: feedbackData,
+    token,
+    timeoutMs: TIMEOUT_ENVIO,
+    esperaPorVaga: ESPERA_POR_VAGA,
+  });
 
 // Segunda etapa: LIME e SHAP do comentário já gravado. É a parte cara, e o
 // tempo cresce com o tamanho do texto — daí o limite generoso.
@@ -155,8 +178,89 @@ export const gerarExplicacao = (feedbackId, token) =>
     body: {},
     token,
     timeoutMs: TIMEOUT_EXPLICACAO,
+    esperaPorVaga: ESPERA_POR_VAGA,
   });
 
+// Estados em que o cálculo da explicação não anda mais (ver app/progresso.py).
+const FINAIS_DA_EXPLICACAO = ['concluida', 'falhou', 'cancelada'];
+// Pausa antes de reconectar depois de uma queda de rede no acompanhamento.
+const ESPERA_APOS_QUEDA = 5000;
+
+// Um bloco de Server-Sent Events: as linhas "data:" juntas, já em JSON.
+const lerEvento = (bloco) => {
+  const dados = bloco
+    .split('\n')
+    .filter((linha) => linha.startsWith('data:'))
+    .map((linha) => linha.slice(5).trim())
+    .join('\n');
+  return dados ? JSON.parse(dados) : null;
+};
+
+// Acompanha o cálculo da explicação pelo fluxo de eventos do servidor, em vez
+// de pedir a lista de feedbacks de tempos em tempos. O EventSource do navegador
+// não manda o cabeçalho Authorization, por isso o fluxo é lido à mão sobre o
+// fetch. Cada conexão dura no máximo uns 25 segundos e é refeita a partir da
+// última versão vista; um 503 por falta de vaga espera o Retry-After.
+//
+// `aoAndamento` recebe cada mudança: reservada, porcentagem do LIME, SHAP
+// pronto. Resolve com o andamento final, ou null se `signal` interromper.
+export const acompanharExplicacao = async (feedbackId, aoAndamento, signal) => {
+  let versao = null;
+  while (!signal?.aborted) {
+    const headers = { Accept: 'text/event-stream' };
+    const token = auth.getToken();
+    if (token) headers.Authorization = `Bearer ${token}`;
+    const caminho = comQuery(`/feedbacks/${feedbackId}/explicacao/eventos`, { versao });
+
+    try {
+      const response = await fetch(`${API_BASE_URL}${caminho}`, { headers, signal });
+
+      if (response.status === 401) {
+        if (!(await auth.refresh())) {
+          auth.onAuthFailure();
+          return null;
+        }
+        continue;
+      }
+      if (response.status === 503) {
+        const data = await lerCorpo(response);
+        await esperar((Number(data?.retry_after) || 5) * 1000 + Math.random() * 1000);
+        continue;
+      }
+      if (!response.ok || !response.body) {
+        const data = await lerCorpo(response);
+        throw new ApiError(data?.error || `Erro ${response.status}`, response.status);
+      }
+
+      const leitor = response.body.getReader();
+      const decodificador = new TextDecoder();
+      let pendente = '';
+      for (;;) {
+        const { value, done } = await leitor.read();
+        if (done) break;
+        pendente += decodificador.decode(value, { stream: true });
+        const blocos = pendente.split('\n\n');
+        pendente = blocos.pop();
+        for (const bloco of blocos) {
+          const andamento = lerEvento(bloco);
+          if (!andamento) continue;
+          versao = andamento.versao;
+          aoAndamento(andamento);
+          if (FINAIS_DA_EXPLICACAO.includes(andamento.estado)) {
+            leitor.cancel();
+            return andamento;
+          }
+        }
+      }
+    } catch (erro) {
+      if (signal?.aborted) return null;
+      if (erro instanceof ApiError) throw erro;
+      await esperar(ESPERA_APOS_QUEDA);
+    }
+  }
+  return null;
+};
+
 export const getFeedbacks = (subjectId, dateRange, token) =>
   request(
     comQuery('/feedbacks', {
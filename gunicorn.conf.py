@@ -0,0 +1,41 @@
+"""Configuração do gunicorn, lida pelo CMD do Dockerfile.
+
+Um worker, como sempre foi, a menos que WEB_WORKERS peça mais. Com mais de um,
+o app é carregado uma vez no processo mestre (--preload) e os workers o herdam
+por fork. Os pesos mapeados em memória (ver app/pesos_mapeados.py) ficam então
+numa cópia só para todos, em vez de 1,3 GB por worker.
+
+    WEB_WORKERS=1        processos do gunicorn
+    WEB_THREADS=4        threads por processo
+    WEB_PRELOAD=         1 ou 0; padrão: ligado quando há mais de um worker
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+workers = int(os.environ.get('WEB_WORKERS', 1))
+threads = int(os.environ.get('WEB_THREADS', 4))
+
+# LIME e SHAP não rodam mais dentro de requisição nenhuma: a rota põe a
+# explicação na fila e quem calcula é uma thread do próprio processo ou o
+# `flask worker-explicacoes` (ver app/tarefas.py). O timeout cobre só o
+# /analyze, uma passagem pelo modelo.
+timeout = 60
+
+accesslog = '-'
+errorlog = '-'
+
+preload_app = os.environ.get('WEB_PRELOAD', '1' if workers > 1 else '0').lower() in ('1', 'true', 'sim')
+
+# Lido pelo services.py no import, que acontece depois desta configuração: com
+# preload, o boot no mestre usa uma thread só do torch e deixa os núcleos para
+# os workers repartirem depois do fork.
+if preload_app:
+    os.environ['SERVIDOR_PRELOAD'] = '1'
+
+
+def post_worker_init(worker):
+    """Em cada worker, com o app já carregado, herdado ou não."""
+    import wsgi
+
+    wsgi.apos_bifurcar(workers if preload_app else 1)
@@ -0,0 +1,118 @@
+"""Tempo de boot e memória por processo, com os pesos originais e com os mapeados.
+
+Para cada forma de carregar o modelo, sobe um processo novo que importa o
+services.py, mede quanto tempo o modelo leva para ficar pronto e bifurca N
+filhos, como o gunicorn com --preload faria com N workers. Cada filho infere um
+lote de textos, para tocar todos os pesos, e espera; com todos vivos, mede-se a
+memória de cada um:
+
+    RSS         tudo o que o processo enxerga, compartilhado ou não
+    PSS         a parte dele na memória da máquina; somada, dá o total real
+    privada     o que só ele tem, e que cada worker a mais custaria de novo
+
+Com os pesos originais, a privada de cada filho deve ficar perto da do modelo
+inteiro assim que ele infere; com os mapeados, perto de zero no que é peso.
+
+    python medir_memoria.py
+    python medir_memoria.py --processos 4
+
+Sem a conversão feita (python app/pesos_mapeados.py), a segunda linha sai igual
+à primeira.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+TEXTOS_POR_FILHO = 64
+
+
+def medir(processos):
+    """Roda dentro do processo de medição e imprime o resultado em JSON."""
+    os.environ['SERVIDOR_PRELOAD'] = '1'
+
+    inicio = time.perf_counter()
+    from app import calibracao
+    from app.processos_de_explicacao import memoria
+    from app.prontidao import carregar_modelo
+    services = carregar_modelo()
+    boot = time.perf_counter() - inicio
+
+    services.preparar_para_bifurcar()
+    textos = calibracao.textos_de_calibracao(TEXTOS_POR_FILHO)
+
+    prontos, liberar = os.pipe(), os.pipe()
+    filhos = []
+    for _ in range(processos):
+        pid = os.fork()
+        if pid == 0:
+            os.close(prontos[0])
+            os.close(liberar[1])
+            services.apos_bifurcar(processos)
+            services._inferir(textos, services._backend)
+            os.write(prontos[1], b'.')
+            os.read(liberar[0], 1)
+            os._exit(0)
+        filhos.append(pid)
+
+    os.close(prontos[1])
+    os.close(liberar[0])
+    for _ in filhos:
+        os.read(prontos[0], 1)
+
+    resultado = {
+        'pesos': services.ORIGEM_DOS_PESOS,
+        'boot_s': round(boot, 1),
+        'pai': memoria(os.getpid()),
+        'filhos': [memoria(pid) for pid in filhos],
+    }
+
+    os.close(liberar[1])
+    for pid in filhos:
+        os.waitpid(pid, 0)
+    print(json.dumps(resultado))
+
+
+def _media(filhos, campo):
+    valores = [f[campo] for f in filhos if f]
+    return sum(valores) / len(valores) if valores else float('nan')
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--processos', type=int, default=2)
+    p.add_argument('--medir', action='store_true', help=argparse.SUPPRESS)
+    args = p.parse_args()
+
+    if args.medir:
+        medir(args.processos)
+        return
+
+    print(f'{args.processos} filho(s), {TEXTOS_POR_FILHO} textos inferidos em cada.\n')
+    print(f'{"pesos":<11} {"boot":>6} {"RSS pai":>8} {"RSS filho":>10} {"PSS filho":>10} '
+          f'{"privada":>8} {"PSS total":>10}')
+    print('-' * 70)
+
+    for ligado in ('0', '1'):
+        ambiente = dict(os.environ, PESOS_MAPEADOS=ligado, CACHE_PREDICOES='0')
+        saida = subprocess.run(
+            [sys.executable, __file__, '--medir', '--processos', str(args.processos)],
+            env=ambiente, capture_output=True, text=True, check=True,
+        ).stdout.strip().splitlines()[-1]
+        r = json.loads(saida)
+
+        filhos = r['filhos']
+        total = r['pai']['pss_mb'] + sum(f['pss_mb'] for f in filhos if f)
+        print(f"{r['pesos']:<11} {r['boot_s']:>5.1f}s {r['pai']['rss_mb']:>7.0f}M "
+              f"{_media(filhos, 'rss_mb'):>9.0f}M {_media(filhos, 'pss_mb'):>9.0f}M "
+              f"{_media(filhos, 'privada_mb'):>7.0f}M {total:>9.0f}M")
+
+    print('\nMédia por filho. "PSS total" soma pai e filhos: é a memória que o conjunto ocupa.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""Latência do /analyze com explicações calculando ao lado, com e sem o escalonador.
+
+Para cada configuração, sobe um processo novo, sem o cache de predições, que
+mede o sentimento de um texto por vez, a intervalos regulares: primeiro com o
+modelo livre, depois com uma thread explicando comentários sem parar, como o
+trabalhador embutido faria. Com INFERENCIA_SIMULTANEAS=0 as passagens vão
+direto ao modelo, como antes do escalonador; com 1, o /analyze passa à frente
+entre um lote e outro da explicação.
+
+    python medir_prioridade.py
+    python medir_prioridade.py --analises 200 --intervalo-ms 50
+
+O que importa é o p99 com explicações: sem o escalonador, ele cresce com a
+disputa pelos núcleos; com ele, fica perto do tempo de uma passagem da
+explicação em curso. A vazão da explicação aparece ao lado, para mostrar o que
+ela cedeu.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+COMENTARIOS = (
+    'A aula foi boa e consegui acompanhar.',
+    'Não entendi nada, estou perdido e desmotivado.',
+    'Achei a aula proveitosa, ainda que alguns trechos tenham ficado corridos. '
+    'Vou revisar os exemplos em casa e trazer as dúvidas na próxima semana.',
+    'A disciplina tem um ritmo bom e o professor explica com clareza, mas sinto '
+    'que a parte prática poderia ter mais tempo em sala.',
+)
+
+
+def _latencias(services, quantas, intervalo):
+    """Segundos de cada análise, com textos sempre diferentes."""
+    latencias = []
+    for i in range(quantas):
+        inicio = time.perf_counter()
+        services.analyze_sentiment_text(f'Envio {i}: a aula de hoje foi boa.')
+        latencias.append(time.perf_counter() - inicio)
+        time.sleep(intervalo)
+    return latencias
+
+
+def _resumo(latencias):
+    ordenadas = sorted(latencias)
+    return {
+        'p50_ms': round(1000 * ordenadas[len(ordenadas) // 2], 1),
+        'p99_ms': round(1000 * ordenadas[min(len(ordenadas) - 1, int(0.99 * len(ordenadas)))], 1),
+        'max_ms': round(1000 * ordenadas[-1], 1),
+    }
+
+
+def medir(analises, intervalo):
+    """Roda dentro do processo de medição e imprime o resultado em JSON."""
+    from app.prontidao import aquecer, carregar_modelo
+
+    services = carregar_modelo()
+    aquecer()
+    sozinho = _latencias(services, analises, intervalo)
+
+    parar = threading.Event()
+    explicados = []
+
+    def _explicar():
+        while not parar.is_set():
+            services.explicar_em_lote(list(COMENTARIOS))
+            explicados.append(len(COMENTARIOS))
+
+    explicando = threading.Thread(target=_explicar, daemon=True)
+    inicio = time.perf_counter()
+    explicando.start()
+    time.sleep(1)   # a explicação já no meio quando as análises começam
+    com_explicacoes = _latencias(services, analises, intervalo)
+    parar.set()
+    explicando.join()
+    decorrido = time.perf_counter() - inicio
+
+    print(json.dumps({
+        'sozinho': _resumo(sozinho),
+        'com_explicacoes': _resumo(com_explicacoes),
+        'explicacoes_por_minuto': round(60 * sum(explicados) / decorrido, 1),
+        'escalonador': services.estatisticas_da_inferencia()['escalonador'],
+    }))
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--analises', type=int, default=100)
+    p.add_argument('--intervalo-ms', type=float, default=100)
+    p.add_argument('--medir', action='store_true', help=argparse.SUPPRESS)
+    args = p.parse_args()
+
+    if args.medir:
+        medir(args.analises, args.intervalo_ms / 1000)
+        return
+
+    print(f'{args.analises} análises, uma a cada {args.intervalo_ms:.0f} ms.\n')
+    print(f'{"escalonador":<12} {"sozinho p50":>12} {"p99":>8} '
+          f'{"c/ expl. p50":>13} {"p99":>8} {"máx":>8} {"expl./min":>10}')
+    print('-' * 78)
+
+    for simultaneas in ('0', '1'):
+        ambiente = dict(os.environ, INFERENCIA_SIMULTANEAS=simultaneas, CACHE_PREDICOES='0')
+        saida = subprocess.run(
+            [sys.executable, __file__, '--medir', '--analises', str(args.analises),
+             '--intervalo-ms', str(args.intervalo_ms)],
+            env=ambiente, capture_output=True, text=True, check=True,
+        ).stdout.strip().splitlines()[-1]
+        r = json.loads(saida)
+
+        nome = 'desligado' if simultaneas == '0' else 'ligado'
+        s, c = r['sozinho'], r['com_explicacoes']
+        print(f"{nome:<12} {s['p50_ms']:>10.1f}ms {s['p99_ms']:>6.1f}ms "
+              f"{c['p50_ms']:>11.1f}ms {c['p99_ms']:>6.1f}ms {c['max_ms']:>6.1f}ms "
+              f"{r['explicacoes_por_minuto']:>10.1f}")
+        if simultaneas != '0':
+            faixas = r['escalonador']['faixas']
+            for faixa in ('analise', 'explicacao'):
+                print(f"    {faixa}: espera média {faixas[faixa]['espera_media_ms']} ms, "
+                      f"p99 {faixas[faixa]['espera_p99_ms']} ms, "
+                      f"{faixas[faixa]['itens_por_segundo_no_modelo']} itens/s no modelo")
+
+    print('\nA latência inclui a espera da fila do /analyze (ANALISE_ESPERA_MS).')
+
+
+if __name__ == '__main__':
+    main()
@@ -32,21 +32,33 @@ def cronometrar(funcao, texto):
 
 
 def main():
-    from app import services
+    from app.prontidao import carregar_modelo
 
+    services = carregar_modelo()
     print(f'threads do torch: {torch.get_num_threads()}')
-    print(f'tamanho do lote:  {services.TAMANHO_DO_LOTE}\n')
+    print(f'lote em tokens:   {services.ORCAMENTO_DE_TOKENS}\n')
 
     services.analyze_sentiment_text(CURTO)   # aquece
 
-    print(f'{"texto":<8} {"chars":>6} {"tokens":>7} {"lime":>9} {"shap":>9} {"total":>9}')
-    print('-' * 52)
+    print(f'{"texto":<8} {"chars":>6} {"tokens":>7} {"lime":>9} {"shap":>9} {"soma":>9} '
+          f'{"paralelo":>9}')
+    print('-' * 62)
 
     for nome, texto in (('curto', CURTO), ('medio', MEDIO), ('longo', LONGO)):
         tokens = len(services._tokenizador(texto)['input_ids'])
         t_lime = cronometrar(services.explain_sentiment_lime, texto)
         t_shap = cronometrar(services.explain_sentiment_shap, texto)
-        print(f'{nome:<8} {len(texto):>6} {tokens:>7} {t_lime:>8.1f}s {t_shap:>8.1f}s {t_lime + t_shap:>8.1f}s')
+        # De novo, os dois juntos, como a rota faz. Sai do cache se ele estiver
+        # ligado; para medir o paralelo de verdade, rode com CACHE_PREDICOES=0.
+        t_paralelo = cronometrar(services.explicar_em_paralelo, texto)
+        print(f'{nome:<8} {len(texto):>6} {tokens:>7} {t_lime:>8.1f}s {t_shap:>8.1f}s '
+              f'{t_lime + t_shap:>8.1f}s {t_paralelo:>8.1f}s')
+
+    print(f'\ncache de predicoes: {services.estatisticas_do_cache()}')
+    print(f'fila do /analyze:   {services.estatisticas_da_fila()}')
+    print(f'fila de explicacoes: {services.estatisticas_da_fila_de_explicacoes()}')
+    print(f'escalonador: {services.estatisticas_da_inferencia()["escalonador"]}')
+    print('Rode de novo para ver o efeito do cache em disco: a segunda execucao nao infere nada.')
 
     print('\nEm producao o tempo e maior: aqui roda com MPS, o Cloud Run e CPU pura.')
 
@@ -5,11 +5,17 @@ O .env é carregado no import do config.py, antes de qualquer leitura do ambient
 
 import os
 
-from app import create_app
+from app import create_app, prontidao
+from app.tarefas import iniciar_no_processo
 
 app = create_app(os.environ.get('FLASK_CONFIG', 'development'))
 
 if __name__ == '__main__':
+    # Com o recarregador do modo debug, este arquivo roda duas vezes: no
+    # processo que vigia os arquivos e no que atende. Só o segundo calcula.
+    if not app.config.get('DEBUG') or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        prontidao.iniciar_no_processo()
+        iniciar_no_processo(app)
     app.run(
         debug=app.config.get('DEBUG', False),
         port=int(os.environ.get('PORT', 5001)),
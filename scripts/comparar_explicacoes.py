@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+"""Compara os caminhos otimizados das explicações com a implementação de referência.
+
+Cada otimização do cálculo de LIME e SHAP promete um resultado: ou idêntico ao
+de antes, ou uma aproximação com erro conhecido. Esta é a conferência dessa
+promessa, sobre um corpus fixo, para que a afirmação vire número reproduzível em
+vez de crença.
+
+O corpus é o dos comentários de demonstração do seeder, os mesmos que qualquer
+instalação de desenvolvimento já calcula.
+
+    python scripts/comparar_explicacoes.py mascaras
+    python scripts/comparar_explicacoes.py enumeracao
+    python scripts/comparar_explicacoes.py shap
+    CACHE_PREDICOES=0 python scripts/comparar_explicacoes.py lote
+    CACHE_PREDICOES=0 python scripts/comparar_explicacoes.py previa
+    CACHE_PREDICOES=0 python scripts/comparar_explicacoes.py etapas
+
+mascaras     o LIME por máscaras contra o LimeTextExplainer.explain_instance,
+             ambos com random_state=42. Os pesos têm de coincidir.
+enumeracao   o LIME enumerado contra a média de várias amostragens com
+             sementes diferentes, nos comentários curtos o bastante para
+             enumerar. A enumeração é o valor esperado que a amostragem
+             estima, então tem de cair dentro do erro padrão dessa média.
+shap         o SHAP com orçamento por tamanho (exato nos curtos) contra o
+             Partition explainer com max_evals='auto', como era antes.
+             Mostra avaliações, tempo e concordância das dez palavras de
+             maior peso. É medição, não conferência: valores de Shapley
+             exatos e valores de Owen do Partition não precisam coincidir.
+lote         o explicar_em_lote de todo o corpus contra explicar_em_paralelo
+             comentário a comentário, os dois a partir do gerador do LIME
+             recém-semeado. Os resultados têm de coincidir; os tempos só
+             comparam de verdade com CACHE_PREDICOES=0.
+previa       a prévia por oclusão, que o /analyze grava, contra o LIME que a
+             substitui depois. Mostra as n + 1 entradas e o tempo de cada uma
+             e a concordância das dez palavras de maior peso, e das cinco que a
+             tela destaca. É medição: a prévia é uma aproximação, e o número
+             é o quanto ela acerta do destaque final.
+etapas       o LIME em etapas do explicar_em_lote contra o LIME de uma vez
+             só, nos comentários sorteados. O resultado final tem de
+             coincidir; mostra quando cada etapa saiu e a concordância de
+             cada uma com a anterior e com o resultado final.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import shap                                     # noqa: E402
+from lime.lime_text import LimeTextExplainer    # noqa: E402
+
+from app.prontidao import carregar_modelo       # noqa: E402
+from app.seeder import COMMENTS                 # noqa: E402
+
+services = carregar_modelo()
+
+# Diferença tolerada entre pesos que deveriam ser iguais. As probabilidades vêm
+# do mesmo modelo, mas em lotes de composição diferente, e isso mexe na última
+# casa do ponto flutuante.
+TOLERANCIA = 1e-6
+
+# Amostragens por comentário no modo enumeracao, e quantos erros padrão da média
+# delas a enumeração pode ficar. As amostragens saem quase todas do cache: cada
+# máscara sorteada é uma das que a enumeração já inferiu.
+SEMENTES = 10
+ERROS_PADRAO = 4.0
+
+
+def corpus():
+    vistos = []
+    for comentarios in COMMENTS.values():
+        vistos.extend(c for c in comentarios if c not in vistos)
+    return vistos
+
+
+def _explicador(semente=42):
+    return LimeTextExplainer(class_names=list(services.CLASSES), random_state=semente)
+
+
+def comparar_mascaras(textos):
+    # Um explicador para cada caminho, os dois com a mesma semente. Cada um
+    # consome o próprio gerador na mesma sequência de comentários, como um
+    # processo novo faria.
+    referencia, mascaras = _explicador(), _explicador()
+    divergentes = 0
+
+    print(f'{"palavras":>8} {"máx. dif.":>10} {"ordem":>6}   comentário')
+    print('-' * 72)
+    for texto in textos:
+        esperado = referencia.explain_instance(
+            texto, services._predict_proba, labels=[services.POS_IDX],
+            num_features=services.NUM_PALAVRAS_LIME,
+            num_samples=services.NUM_AMOSTRAS_LIME,
+        ).as_list(label=services.POS_IDX)
+        obtido = services._lime_por_mascaras(
+            texto, mascaras, services.NUM_AMOSTRAS_LIME, services.NUM_PALAVRAS_LIME,
+        )
+
+        mesma_ordem = [p for p, _ in esperado] == [p for p, _ in obtido]
+        diferenca = max(
+            (abs(a - b) for (_, a), (_, b) in zip(esperado, obtido)), default=0.0,
+        )
+        if not mesma_ordem or diferenca > TOLERANCIA:
+            divergentes += 1
+
+        print(f'{len(esperado):>8} {diferenca:>10.2e} {"ok" if mesma_ordem else "NÃO":>6}   '
+              f'{texto[:40]}')
+
+    print(f'\n{len(textos) - divergentes} de {len(textos)} comentários com os mesmos pesos.')
+    return divergentes == 0
+
+
+def comparar_enumeracao(textos):
+    curtos = [t for t in textos if services.modo_lime(t) == services.LIME_ENUMERACAO]
+    divergentes = 0
+
+    print(f'{"palavras":>8} {"máscaras":>9} {"máx. dif.":>10} {"máx. z":>7} '
+          f'{"top-10":>7}   comentário')
+    print('-' * 80)
+    for texto in curtos:
+        palavras = services.lime_por_mascaras.indexar(services.lime_explainer, texto).num_words()
+        exato = dict(services._lime_por_mascaras(
+            texto, _explicador(), services.NUM_AMOSTRAS_LIME, services.NUM_PALAVRAS_LIME,
+            modo=services.LIME_ENUMERACAO,
+        ))
+        amostras = [
+            dict(services._lime_por_mascaras(
+                texto, _explicador(semente), services.NUM_AMOSTRAS_LIME,
+                services.NUM_PALAVRAS_LIME,
+            ))
+            for semente in range(SEMENTES)
+        ]
+
+        # Palavra que ficou fora das dez de uma amostragem conta como peso zero
+        # nela, que é como a tela a trataria.
+        vocabulario = sorted(set(exato).union(*amostras))
+        matriz = np.array([[a.get(p, 0.0) for p in vocabulario] for a in amostras])
+        media = matriz.mean(axis=0)
+        erro_padrao = matriz.std(axis=0, ddof=1) / np.sqrt(SEMENTES)
+        diferenca = np.abs(np.array([exato.get(p, 0.0) for p in vocabulario]) - media)
+
+        z = np.max(diferenca / np.maximum(erro_padrao, TOLERANCIA))
+        concordancia = services.concordancia_top(exato, dict(zip(vocabulario, media)))
+        if z > ERROS_PADRAO:
+            divergentes += 1
+
+        print(f'{palavras:>8} {2 ** palavras:>9} {diferenca.max():>10.2e} {z:>7.2f} '
+              f'{concordancia:>7.0%}   {texto[:32]}')
+
+    print(f'\n{len(curtos) - divergentes} de {len(curtos)} comentários curtos dentro de '
+          f'{ERROS_PADRAO:g} erros padrão da média de {SEMENTES} amostragens '
+          f'(limite de enumeração: {services.LIME_ENUMERACAO_ATE} palavras).')
+    return divergentes == 0
+
+
+def comparar_shap(textos):
+    avaliacoes_antes = 0
+
+    def _contando(lote):
+        nonlocal avaliacoes_antes
+        avaliacoes_antes += len(lote)
+        return services._predict_proba(lote)
+
+    anterior = shap.Explainer(_contando, services.shap_masker, output_names=list(services.CLASSES))
+
+    # Cada comentário é medido primeiro pelo caminho novo, com o cache frio para
+    # ele, e depois pelo anterior. Os dois usam o mesmo _predict_proba; o que o
+    # segundo encontra no cache é mérito do primeiro e conta só no tempo.
+    totais = {'antes': 0.0, 'agora': 0.0, 'aval_antes': 0, 'aval_agora': 0}
+    print(f'{"tokens":>6} {"modo":>8} {"aval. antes":>11} {"aval. agora":>11} '
+          f'{"s antes":>8} {"s agora":>8} {"top-10":>7}   comentário')
+    print('-' * 90)
+    for texto in textos:
+        modo, orcamento = services.orcamento_shap(texto)
+
+        inicio = time.perf_counter()
+        if modo == services.SHAP_EXATO:
+            tokens, valores, avaliacoes_agora = services._shap_exato(texto)
+        else:
+            tokens, valores, avaliacoes_agora = services._shap_particao(texto, orcamento)
+        agora = services._somar_por_palavra(tokens, valores)
+        tempo_agora = time.perf_counter() - inicio
+
+        avaliacoes_antes = 0
+        inicio = time.perf_counter()
+        try:
+            valores_antes = anterior([texto])
+            antes = services._somar_por_palavra(
+                valores_antes.data[0], valores_antes.values[0, :, services.POS_IDX],
+            )
+        except ValueError:
+            # O Partition explainer não monta a árvore de um texto de um token só.
+            antes = None
+        tempo_antes = time.perf_counter() - inicio
+
+        totais['antes'] += tempo_antes
+        totais['agora'] += tempo_agora
+        totais['aval_antes'] += avaliacoes_antes
+        totais['aval_agora'] += avaliacoes_agora
+
+        concordancia = (
+            f'{services.concordancia_top(antes, agora):>7.0%}' if antes is not None else f'{"falhou":>7}'
+        )
+        print(f'{len(tokens):>6} {modo:>8} {avaliacoes_antes:>11} {avaliacoes_agora:>11} '
+              f'{tempo_antes:>8.2f} {tempo_agora:>8.2f} {concordancia}   {texto[:28]}')
+
+    print(f"\nTotal: {totais['aval_antes']} avaliações em {totais['antes']:.1f}s antes, "
+          f"{totais['aval_agora']} em {totais['agora']:.1f}s agora.")
+    return True
+
+
+def _maior_diferenca(a, b):
+    if a is None or b is None or set(a) != set(b):
+        return float('inf')
+    return max((abs(a[p] - b[p]) for p in a), default=0.0)
+
+
+def comparar_lote(textos):
+    from sklearn.utils import check_random_state
+
+    services.lime_explainer.random_state = check_random_state(42)
+    inicio = time.perf_counter()
+    um_a_um = [services.explicar_em_paralelo(texto) for texto in textos]
+    tempo_um_a_um = time.perf_counter() - inicio
+
+    services.lime_explainer.random_state = check_random_state(42)
+    inicio = time.perf_counter()
+    em_lote = services.explicar_em_lote(textos)
+    tempo_em_lote = time.perf_counter() - inicio
+
+    divergentes = 0
+    print(f'{"lime":>10} {"shap":>10}   comentário')
+    print('-' * 60)
+    for texto, antes, agora in zip(textos, um_a_um, em_lote):
+        lime = _maior_diferenca(antes['lime'][0], agora['lime'][0])
+        shap_ = _maior_diferenca(antes['shap'][0], agora['shap'][0])
+        # Os pesos gravados são arredondados em quatro casas, e a última pode
+        # virar para um lado ou outro com a diferença de ponto flutuante.
+        if max(lime, shap_) > 1e-4 + TOLERANCIA:
+            divergentes += 1
+        print(f'{lime:>10.2e} {shap_:>10.2e}   {texto[:40]}')
+
+    print(f'\n{len(textos) - divergentes} de {len(textos)} comentários iguais. '
+          f'Um a um: {tempo_um_a_um:.1f}s; em lote: {tempo_em_lote:.1f}s '
+          f'({tempo_um_a_um / tempo_em_lote:.1f}x).')
+    return divergentes == 0
+
+
+def comparar_previa(textos):
+    # As cinco que a tela destaca; ver MAXIMO_DE_DESTAQUES no wordHighlight.js.
+    destaques = 5
+    totais = {'previa': 0.0, 'lime': 0.0, 'entradas': 0}
+    concordancias, concordancias_tela = [], []
+
+    print(f'{"palavras":>8} {"entradas":>8} {"s prévia":>9} {"s lime":>7} '
+          f'{"top-10":>7} {"top-5":>6}   comentário')
+    print('-' * 80)
+    for texto in textos:
+        palavras = services.lime_por_mascaras.indexar(services.lime_explainer, texto).num_words()
+        if palavras > services.PREVIA_MAX_PALAVRAS:
+            print(f'{palavras:>8} {"sem prévia":>35}   {texto[:32]}')
+            continue
+
+        inicio = time.perf_counter()
+        previa = services.previa_por_oclusao(texto)
+        tempo_previa = time.perf_counter() - inicio
+
+        inicio = time.perf_counter()
+        lime = services.explain_sentiment_lime(texto)
+        tempo_lime = time.perf_counter() - inicio
+
+        concordancia = services.concordancia_top(previa, lime)
+        concordancia_tela = services.concordancia_top(previa, lime, k=destaques)
+        concordancias.append(concordancia)
+        concordancias_tela.append(concordancia_tela)
+        totais['previa'] += tempo_previa
+        totais['lime'] += tempo_lime
+        totais['entradas'] += palavras + 1
+
+        print(f'{palavras:>8} {palavras + 1:>8} {tempo_previa:>9.2f} {tempo_lime:>7.2f} '
+              f'{concordancia:>7.0%} {concordancia_tela:>6.0%}   {texto[:32]}')
+
+    if concordancias:
+        print(f"\nConcordância com o LIME em {len(concordancias)} comentários: top-10 média "
+              f"{np.mean(concordancias):.0%} (mínima {min(concordancias):.0%}), top-{destaques} "
+              f"média {np.mean(concordancias_tela):.0%}. Prévia: {totais['entradas']} entradas em "
+              f"{totais['previa']:.1f}s; LIME: {totais['lime']:.1f}s.")
+    return True
+
+
+def comparar_etapas(textos):
+    sorteados = [t for t in textos if services.modo_lime(t) == services.LIME_AMOSTRAGEM]
+    divergentes = 0
+
+    print(f'{"etapas (amostras: s, estabilidade, top-10 com o final)":<60} {"final":>9}   comentário')
+    print('-' * 90)
+    for texto in sorteados:
+        etapas = []
+        inicio = time.perf_counter()
+
+        def _etapa(posicao, amostras, pesos, estabilidade):
+            etapas.append((amostras, time.perf_counter() - inicio, estabilidade, pesos))
+
+        em_etapas = services.explicar_em_lote([texto], ao_etapa=_etapa)[0]['lime'][0]
+        de_uma_vez = services.explain_sentiment_lime(texto)
+
+        diferenca = _maior_diferenca(em_etapas, de_uma_vez)
+        if diferenca > 1e-4 + TOLERANCIA:
+            divergentes += 1
+        resumo = ' '.join(
+            f'{amostras}:{segundos:.1f}s,'
+            f'{"-" if estabilidade is None else f"{estabilidade:.0%}"},'
+            f'{services.concordancia_top(pesos, de_uma_vez):.0%}'
+            for amostras, segundos, estabilidade, pesos in etapas
+        )
+        print(f'{resumo:<60} {diferenca:>9.2e}   {texto[:28]}')
+
+    print(f'\n{len(sorteados) - divergentes} de {len(sorteados)} comentários sorteados com o '
+          f'mesmo resultado final (etapas: {", ".join(map(str, services.LIME_ETAPAS))}).')
+    return divergentes == 0
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('comparacao', choices=['mascaras', 'enumeracao', 'shap', 'lote', 'previa', 'etapas'])
+    args = p.parse_args()
+
+    textos = corpus()
+    if args.comparacao == 'mascaras':
+        ok = comparar_mascaras(textos)
+    elif args.comparacao == 'enumeracao':
+        ok = comparar_enumeracao(textos)
+    elif args.comparacao == 'shap':
+        ok = comparar_shap(textos)
+    elif args.comparacao == 'lote':
+        ok = comparar_lote(textos)
+    elif args.comparacao == 'previa':
+        ok = comparar_previa(textos)
+    elif args.comparacao == 'etapas':
+        ok = comparar_etapas(textos)
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
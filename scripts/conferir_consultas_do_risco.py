@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""Confere que o /students-at-risk faz as mesmas consultas com qualquer volume.
+
+A rota fazia uma consulta por disciplina do professor e mais duas por linha,
+para carregar aluno e disciplina no to_dict. Agora promete uma consulta ao
+risco por página, com o nome do aluno e o da disciplina por JOIN (ver
+feedbacks.get_students_at_risk). Esta é a conferência da promessa: sobe o app
+num SQLite temporário, sem o modelo, cria análises de risco em volumes
+crescentes e conta, com um ouvinte before_cursor_execute do SQLAlchemy, as
+instruções que cada pedido manda ao banco.
+
+    python scripts/conferir_consultas_do_risco.py
+    python scripts/conferir_consultas_do_risco.py --alunos 50 500 5000 --limite 100
+
+Para o professor, com cinco disciplinas, e para o coordenador, em cada volume:
+a lista inteira, sem `limit`, e depois todas as páginas pelo X-Next-Cursor. Tem
+de valer, senão sai com código 1:
+
+  - uma instrução sobre student_risk_analysis por pedido, página ou não;
+  - o mesmo total de instruções por pedido em todos os volumes e páginas (o
+    resto é o usuário do token, as disciplinas dele e a lista de revogados);
+  - as páginas, juntas, iguais à lista inteira.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask                                        # noqa: E402
+from flask_jwt_extended import create_access_token             # noqa: E402
+from sqlalchemy import event, insert                           # noqa: E402
+
+from app import register_blueprints, register_extensions       # noqa: E402
+from app.models import StudentRiskAnalysis, Subject, User, db  # noqa: E402
+from app.models import user_subjects                           # noqa: E402
+
+DISCIPLINAS = 10
+DO_PROFESSOR = 5
+NIVEIS = ('baixo', 'medio', 'alto')
+
+
+def criar_app(arquivo):
+    """Só o banco, o JWT e as rotas: sem create_app, que recusa SQLite em
+    produção e semeia, com o modelo, em desenvolvimento."""
+    app = Flask(__name__)
+    app.config.update(
+        SQLALCHEMY_DATABASE_URI=f'sqlite:///{arquivo}',
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        SECRET_KEY='conferencia-local-das-consultas-do-risco',
+        JWT_SECRET_KEY='conferencia-local-das-consultas-do-risco-jwt',
+    )
+    register_extensions(app)
+    register_blueprints(app)
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def povoar(alunos):
+    """Cada aluno com uma análise em cada disciplina. Devolve os tokens."""
+    agora = datetime.utcnow()
+    db.session.execute(insert(Subject), [
+        {'id': d, 'name': f'Disciplina {d}'} for d in range(1, DISCIPLINAS + 1)
+    ])
+    db.session.execute(insert(User), [
+        {'id': i, 'username': f'aluno{i}', 'password': '-', 'role': User.ALUNO,
+         'first_name': 'Aluno', 'last_name': str(i), 'must_change_password': False}
+        for i in range(1, alunos + 1)
+    ] + [
+        {'id': alunos + 1, 'username': 'professor', 'password': '-', 'role': User.PROFESSOR,
+         'must_change_password': False},
+        {'id': alunos + 2, 'username': 'coordenador', 'password': '-', 'role': User.COORDENADOR,
+         'must_change_password': False},
+    ])
+    db.session.execute(insert(user_subjects), [
+        {'user_id': alunos + 1, 'subject_id': d} for d in range(1, DO_PROFESSOR + 1)
+    ])
+    linhas = []
+    for aluno in range(1, alunos + 1):
+        for disciplina in range(1, DISCIPLINAS + 1):
+            # Risco repetido de propósito: o desempate pelo id é parte do cursor.
+            risco = ((aluno * 7 + disciplina * 13) % 100) / 100
+            linhas.append({
+                'student_id': aluno, 'subject_id': disciplina, 'average_score': 1 - risco,
+                'average_sentiment': None, 'feedback_count': 3, 'risk_score': risco,
+                'risk_level': NIVEIS[min(2, int(risco / 0.3))], 'last_updated': agora,
+            })
+    db.session.execute(insert(StudentRiskAnalysis), linhas)
+    db.session.commit()
+
+    return {
+        'professor': create_access_token(identity=str(alunos + 1),
+                                         additional_claims={'role': User.PROFESSOR}),
+        'coordenador': create_access_token(identity=str(alunos + 2),
+                                           additional_claims={'role': User.COORDENADOR}),
+    }
+
+
+def conferir(alunos, limite):
+    """Pedidos de cada papel num banco com `alunos` alunos.
+
+    Devolve [(papel, pedido, instruções, instruções no risco, linhas)] e as
+    falhas de ordem ou de paginação.
+    """
+    with tempfile.TemporaryDirectory() as pasta:
+        app = criar_app(os.path.join(pasta, 'risco.sqlite3'))
+        with app.app_context():
+            tokens = povoar(alunos)
+            instrucoes = []
+            event.listen(db.engine, 'before_cursor_execute',
+                         lambda conexao, cursor, instrucao, *_: instrucoes.append(instrucao))
+
+        cliente = app.test_client()
+        medidas, falhas = [], []
+
+        def pedir(papel, pedido, **parametros):
+            instrucoes.clear()
+            resposta = cliente.get('/students-at-risk', query_string=parametros,
+                                   headers={'Authorization': f'Bearer {tokens[papel]}'})
+            if resposta.status_code != 200:
+                raise SystemExit(f'{papel} {pedido}: HTTP {resposta.status_code} {resposta.json}')
+            no_risco = sum('student_risk_analysis' in instrucao for instrucao in instrucoes)
+            medidas.append((papel, pedido, len(instrucoes), no_risco, len(resposta.json)))
+            return resposta
+
+        for papel in tokens:
+            inteira = pedir(papel, 'tudo', min_risk='baixo').json
+            paginas, cursor, numero = [], None, 0
+            while True:
+                numero += 1
+                parametros = {'min_risk': 'baixo', 'limit': limite}
+                if cursor:
+                    parametros['cursor'] = cursor
+                resposta = pedir(papel, f'página {numero}', **parametros)
+                paginas += resposta.json
+                cursor = resposta.headers.get('X-Next-Cursor')
+                if not cursor:
+                    break
+            if [a['id'] for a in paginas] != [a['id'] for a in inteira]:
+                falhas.append(f'{alunos} alunos, {papel}: as páginas não reproduzem a lista inteira')
+        return medidas, falhas
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--alunos', nargs='+', type=int, default=[20, 200, 2000],
+                   help='volumes conferidos, em alunos; cada um com %s análises' % DISCIPLINAS)
+    p.add_argument('--limite', type=int, default=250, help='o limit de cada página')
+    args = p.parse_args()
+
+    totais, falhas = set(), []
+    print(f'{"alunos":>7} {"papel":12} {"pedido":12} {"instruções":>10} {"no risco":>9} {"linhas":>7}')
+    print('-' * 62)
+    for alunos in args.alunos:
+        medidas, falhas_do_volume = conferir(alunos, args.limite)
+        falhas += falhas_do_volume
+        for papel, pedido, instrucoes, no_risco, linhas in medidas:
+            totais.add(instrucoes)
+            if no_risco != 1:
+                falhas.append(f'{alunos} alunos, {papel}, {pedido}: '
+                              f'{no_risco} instruções no risco, e não uma')
+        # A primeira e a última página de cada papel bastam na tabela.
+        for indice, (papel, pedido, instrucoes, no_risco, linhas) in enumerate(medidas):
+            ultima = indice + 1 == len(medidas) or medidas[indice + 1][0] != papel
+            if pedido in ('tudo', 'página 1') or ultima:
+                print(f'{alunos:>7} {papel:12} {pedido:12} {instrucoes:>10} {no_risco:>9} {linhas:>7}')
+
+    if len(totais) != 1:
+        falhas.append(f'o total de instruções por pedido variou: {sorted(totais)}')
+
+    print()
+    for falha in falhas:
+        print(f'FALHOU  {falha}')
+    if not falhas:
+        print(f'ok: {totais.pop()} instruções por pedido em todos os volumes e páginas, '
+              'uma delas no risco.')
+    sys.exit(1 if falhas else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""Confere que o `flask recalcular-risco` grava o mesmo que o cálculo par a par.
+
+O recálculo de todos os pares (feedbacks.recalcular_riscos) faz uma consulta
+agregada, o risco de todos de uma vez pelo NumPy (riscos_em_lote) e um UPSERT em
+lote, e apaga as linhas de quem ficou sem feedback ativo. O caminho de
+referência é o de sempre, feedbacks.update_student_risk_analysis, um par por
+vez. Esta é a conferência de que os dois chegam ao mesmo banco: sobe o app num
+SQLite temporário, sem o modelo, semeia feedbacks e análises, copia o arquivo e
+roda um caminho em cada cópia.
+
+    python scripts/conferir_recalculo_do_risco.py
+    python scripts/conferir_recalculo_do_risco.py --alunos 50 500 --semente 7
+
+A semeadura cobre o que costuma desencontrar os dois: feedback sem sentimento
+(compound nulo), feedback retirado (deleted_at), par só com feedbacks retirados,
+análise órfã de par que nunca teve feedback e análise com números velhos. Tem de
+valer, senão sai com código 1:
+
+  - os mesmos pares nas duas cópias;
+  - em cada par, a mesma contagem, as mesmas médias, o mesmo risco e o mesmo
+    nível, comparados exatamente.
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask                                                  # noqa: E402
+from sqlalchemy import insert, select                                    # noqa: E402
+
+from app import register_blueprints, register_extensions                 # noqa: E402
+from app.feedbacks import recalcular_riscos, update_student_risk_analysis  # noqa: E402
+from app.models import Feedback, StudentRiskAnalysis, Subject, User, db  # noqa: E402
+
+DISCIPLINAS = 4
+NIVEIS = ('baixo', 'medio', 'alto')
+RESPOSTAS = ('active_participation', 'task_completion', 'motivation_interest',
+             'welcoming_environment', 'comprehension_effort', 'content_connection')
+COLUNAS = ('feedback_count', 'average_score', 'average_sentiment', 'risk_score', 'risk_level')
+
+
+def criar_app(arquivo):
+    """Só o banco e as rotas: sem create_app, que recusa SQLite em produção e
+    semeia, com o modelo, em desenvolvimento."""
+    app = Flask(__name__)
+    app.config.update(
+        SQLALCHEMY_DATABASE_URI=f'sqlite:///{arquivo}',
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        SECRET_KEY='conferencia-local-do-recalculo-do-risco',
+        JWT_SECRET_KEY='conferencia-local-do-recalculo-do-risco-jwt',
+    )
+    register_extensions(app)
+    register_blueprints(app)
+    return app
+
+
+def povoar(alunos, sorteio):
+    """Feedbacks e análises de `alunos` alunos. Devolve todos os pares com
+    alguma das duas coisas, que é o que o caminho par a par precisa visitar."""
+    agora = datetime.utcnow()
+    db.session.execute(insert(Subject), [
+        {'id': d, 'name': f'Disciplina {d}'} for d in range(1, DISCIPLINAS + 1)
+    ])
+    db.session.execute(insert(User), [
+        {'id': i, 'username': f'aluno{i}', 'password': '-', 'role': User.ALUNO,
+         'first_name': 'Aluno', 'last_name': str(i), 'must_change_password': False}
+        for i in range(1, alunos + 1)
+    ])
+
+    feedbacks, analises, pares = [], [], set()
+    for aluno in range(1, alunos + 1):
+        for disciplina in range(1, DISCIPLINAS + 1):
+            quantos = sorteio.choice((0, 0, 1, 2, 3, 5, 8))
+            retirados = sorteio.randint(0, quantos) if sorteio.random() < 0.3 else 0
+            for indice in range(quantos):
+                respostas = {coluna: sorteio.randint(1, 5) for coluna in RESPOSTAS}
+                feedbacks.append({
+                    'student_id': aluno, 'subject_id': disciplina, **respostas,
+                    'additional_comment': f'comentário {aluno}-{disciplina}-{indice}',
+                    'compound': None if sorteio.random() < 0.2 else sorteio.uniform(-1, 1),
+                    'overall_score': sum(respostas.values()) / (5 * len(RESPOSTAS)),
+                    'deleted_at': agora if indice < retirados else None,
+                })
+            # Análise já existente: velha para parte dos pares com feedback,
+            # órfã para parte dos sem nenhum feedback ativo.
+            com_analise = sorteio.random() < (0.5 if quantos else 0.3)
+            if com_analise:
+                risco = sorteio.random()
+                analises.append({
+                    'student_id': aluno, 'subject_id': disciplina, 'average_score': 1 - risco,
+                    'average_sentiment': None, 'feedback_count': 99, 'risk_score': risco,
+                    'risk_level': NIVEIS[min(2, int(risco / 0.3))], 'last_updated': agora,
+                })
+            if quantos or com_analise:
+                pares.add((aluno, disciplina))
+    db.session.execute(insert(Feedback), feedbacks)
+    if analises:
+        db.session.execute(insert(StudentRiskAnalysis), analises)
+    db.session.commit()
+    return sorted(pares), len(feedbacks), len(analises)
+
+
+def analises_gravadas():
+    linhas = db.session.execute(select(
+        StudentRiskAnalysis.student_id, StudentRiskAnalysis.subject_id,
+        *(getattr(StudentRiskAnalysis, coluna) for coluna in COLUNAS),
+    )).all()
+    return {(linha[0], linha[1]): tuple(linha[2:]) for linha in linhas}
+
+
+def conferir(alunos, semente):
+    """Os dois caminhos sobre o mesmo banco de `alunos` alunos.
+
+    Devolve (pares, feedbacks, análises semeadas, linhas no fim, falhas).
+    """
+    with tempfile.TemporaryDirectory() as pasta:
+        original = os.path.join(pasta, 'risco.sqlite3')
+        copia = os.path.join(pasta, 'risco-em-lote.sqlite3')
+
+        app = criar_app(original)
+        with app.app_context():
+            db.create_all()
+            pares, feedbacks, semeadas = povoar(alunos, random.Random(semente))
+            db.engine.dispose()
+        shutil.copyfile(original, copia)
+
+        with app.app_context():
+            for aluno, disciplina in pares:
+                update_student_risk_analysis(aluno, disciplina, commit=False)
+            db.session.commit()
+            par_a_par = analises_gravadas()
+            db.engine.dispose()
+
+        with criar_app(copia).app_context():
+            resumo = recalcular_riscos()
+            em_lote = analises_gravadas()
+            db.engine.dispose()
+
+    falhas = []
+    for par in sorted(par_a_par.keys() | em_lote.keys()):
+        if par_a_par.get(par) != em_lote.get(par):
+            falhas.append(f'{alunos} alunos, aluno {par[0]}, disciplina {par[1]}: '
+                          f'par a par {par_a_par.get(par)}, em lote {em_lote.get(par)}')
+    if resumo['pares'] != len(em_lote):
+        falhas.append(f'{alunos} alunos: o recálculo diz {resumo["pares"]} pares '
+                      f'e gravou {len(em_lote)}')
+    return len(pares), feedbacks, semeadas, len(em_lote), falhas
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--alunos', nargs='+', type=int, default=[20, 200, 2000],
+                   help='volumes conferidos, em alunos; cada um em %s disciplinas' % DISCIPLINAS)
+    p.add_argument('--semente', type=int, default=0, help='semente da semeadura')
+    args = p.parse_args()
+
+    falhas = []
+    print(f'{"alunos":>7} {"pares":>7} {"feedbacks":>10} {"análises":>9} {"no fim":>7} {"falhas":>7}')
+    print('-' * 52)
+    for alunos in args.alunos:
+        pares, feedbacks, semeadas, no_fim, falhas_do_volume = conferir(alunos, args.semente)
+        falhas += falhas_do_volume
+        print(f'{alunos:>7} {pares:>7} {feedbacks:>10} {semeadas:>9} {no_fim:>7} '
+              f'{len(falhas_do_volume):>7}')
+
+    print()
+    for falha in falhas[:20]:
+        print(f'FALHOU  {falha}')
+    if len(falhas) > 20:
+        print(f'... e mais {len(falhas) - 20}')
+    if not falhas:
+        print('ok: o recálculo em lote gravou, em todos os pares, o mesmo que o par a par.')
+    sys.exit(1 if falhas else 0)
+
+
+if __name__ == '__main__':
+    main()
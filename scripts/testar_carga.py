@@ -11,7 +11,7 @@ O que ele cronometra, por aluno:
 
   login        autenticação, que paga a partida a frio se houver
   envio        POST /analyze, o caminho crítico: é aqui que o feedback é gravado
-  explicação   até o destaque por palavra aparecer, consultando como a tela faz
+  explicação   até o destaque por palavra ficar pronto, pelo long-poll do andamento
 
 O envio é o número que importa para a coleta. A explicação é conforto: ela
 acontece em segundo plano e o feedback já está salvo antes de ela começar.
@@ -33,6 +33,7 @@ Depois, apague as linhas de teste do banco. Elas não podem entrar na análise.
 
 import argparse
 import json
+import random
 import ssl
 import statistics
 import sys
@@ -131,8 +132,17 @@ def um_aluno(url, usuario, senha, disciplina, comentario, aguardar_explicacao):
         'additional_comment': comentario,
     }
 
+    # Recusado por falta de vaga, espera o Retry-After e repete, como a tela,
+    # por até um minuto somando as esperas. O envio conta o tempo todo.
     inicio = time.perf_counter()
-    status, corpo = pedir(url, '/analyze', envio, token=token)
+    resultado['recusas'] = 0
+    while True:
+        status, corpo = pedir(url, '/analyze', envio, token=token)
+        espera = (corpo or {}).get('retry_after') if status == 503 else None
+        if not espera or time.perf_counter() - inicio + espera > 60:
+            break
+        resultado['recusas'] += 1
+        time.sleep(espera + random.random())
     resultado['envio'] = time.perf_counter() - inicio
 
     if status == 409:
@@ -162,18 +172,31 @@ def um_aluno(url, usuario, senha, disciplina, comentario, aguardar_explicacao):
     except Exception as e:
         falar(f'  {usuario}: pedido da explicação não respondeu ({e}), passando a consultar')
 
-    for _ in range(60):
+    # O fim vem pelo long-poll do andamento: cada pedido fica parado no
+    # servidor até algo mudar, e a carga medida não inclui uma turma inteira
+    # buscando a lista de feedbacks a cada dez segundos.
+    versao = None
+    while time.perf_counter() - inicio < 600:
         try:
-            st, lista = pedir(url, '/my-feedbacks', token=token, timeout=60)
-            atual = next((f for f in (lista or []) if f['id'] == corpo['id']), None)
-            if atual and (atual.get('token_attributions') or atual.get('shap_attributions')):
+            caminho = f'/feedbacks/{corpo["id"]}/explicacao/estado?espera=25'
+            if versao is not None:
+                caminho += f'&versao={versao}'
+            st, andamento = pedir(url, caminho, token=token, timeout=60)
+            if st == 503:
+                time.sleep((andamento or {}).get('retry_after', 5) + random.random())
+                continue
+            versao = andamento['versao']
+            if andamento['estado'] == 'concluida':
                 resultado['explicacao'] = time.perf_counter() - inicio
                 return resultado
+            if andamento['estado'] in ('falhou', 'cancelada'):
+                resultado['explicacao'] = None
+                resultado['erro'] = f'explicação {andamento["estado"]}'
+                return resultado
         except Exception:
             # Falha de rede numa consulta não encerra o acompanhamento, pelo
             # mesmo motivo: o cálculo segue do lado do servidor.
-            pass
-        time.sleep(10)
+            time.sleep(10)
 
     resultado['explicacao'] = None
     resultado['erro'] = 'explicação não ficou pronta em 10 minutos'
@@ -244,6 +267,10 @@ def main():
 
     gravados = sum(1 for r in resultados if r.get('id'))
     print(f'\n{gravados} de {len(contas)} feedbacks gravados, tudo em {total:.1f}s')
+    recusas = sum(r.get('recusas', 0) for r in resultados)
+    if recusas:
+        print(f'{recusas} envio(s) recusado(s) com 503 por falta de vaga e repetido(s) '
+              f'depois do Retry-After')
 
     piores = [r['envio'] for r in resultados if 'envio' in r]
     if piores and max(piores) > 60:
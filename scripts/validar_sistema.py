@@ -101,15 +101,32 @@ def envio(disciplina, comentario, **extra):
 
 
 def aguardar_explicacao(url, token, id_fb, limite=420):
-    """Acompanha como a tela faz, sem segurar a requisição aberta."""
+    """Pede a explicação e espera o fim pelo long-poll do andamento.
+
+    Cada pedido fica parado no servidor até o andamento mudar, em vez de
+    buscar a lista de feedbacks a cada dez segundos; a lista só é lida uma
+    vez, no fim.
+    """
     inicio = time.time()
     pedir(url, f'/feedbacks/{id_fb}/explicacao', {}, token=token, timeout=150)
+    versao = None
     while time.time() - inicio < limite:
-        _, lista = pedir(url, '/my-feedbacks', token=token, timeout=60)
-        atual = next((f for f in (lista or []) if f['id'] == id_fb), None)
-        if atual and (atual.get('token_attributions') or atual.get('shap_attributions')):
-            return atual, time.time() - inicio
-        time.sleep(10)
+        caminho = f'/feedbacks/{id_fb}/explicacao/estado?espera=25'
+        if versao is not None:
+            caminho += f'&versao={versao}'
+        st, andamento = pedir(url, caminho, token=token, timeout=60)
+        if st == 503:
+            time.sleep((andamento or {}).get('retry_after', 5))
+            continue
+        if st != 200:
+            break
+        versao = andamento['versao']
+        if andamento['estado'] in ('concluida', 'falhou', 'cancelada'):
+            break
+    _, lista = pedir(url, '/my-feedbacks', token=token, timeout=60)
+    atual = next((f for f in (lista or []) if f['id'] == id_fb), None)
+    if atual and (atual.get('token_attributions') or atual.get('shap_attributions')):
+        return atual, time.time() - inicio
     return None, time.time() - inicio
 
 
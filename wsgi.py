@@ -1,9 +1,42 @@
-"""Entrada de produção, usada pelo gunicorn.
+"""Entrada de produção, usada pelo gunicorn (ver gunicorn.conf.py).
 
 O perfil vem de FLASK_CONFIG, que o create_app assume como 'production' quando
-não definido.
+não definido. Com EXPLICACOES_NO_PROCESSO ligado (o padrão), o próprio servidor
+também calcula as explicações da fila; desligado, quem calcula é o
+`flask worker-explicacoes`, em outro processo ou outra máquina.
+
+O modelo carrega numa thread depois do boot (ver app/prontidao.py): o worker
+começa a atender o /health e o /login antes, e o /ready diz quando ele ficou
+pronto para analisar.
+
+Com o gunicorn em --preload, este módulo roda uma vez no processo mestre, antes
+do fork, e ali o modelo é carregado na hora, para que os workers o herdem. O que
+não atravessa fork, conexões ao banco, a thread trabalhadora e o aquecimento,
+fica para `apos_bifurcar`, que o gunicorn chama em cada worker.
 """
 
-from app import create_app
+import os
+
+from app import create_app, prontidao
+from app.models import db
+from app.tarefas import iniciar_no_processo
 
 app = create_app()
+
+if os.environ.get('SERVIDOR_PRELOAD') == '1':
+    prontidao.carregar_modelo().preparar_para_bifurcar()
+    with app.app_context():
+        db.engine.dispose()
+else:
+    prontidao.iniciar_no_processo()
+    iniciar_no_processo(app)
+
+
+def apos_bifurcar(processos):
+    """Prepara um worker recém-criado: núcleos, conexões, aquecimento e trabalhador embutido."""
+    if os.environ.get('SERVIDOR_PRELOAD') == '1':
+        prontidao.carregar_modelo().apos_bifurcar(processos)
+        with app.app_context():
+            db.engine.dispose(close=False)
+    prontidao.iniciar_no_processo()
+    iniciar_no_processo(app)